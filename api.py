@@ -4,8 +4,12 @@ from fastapi.responses import RedirectResponse
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
 
-from oauth import get_auth_url, exchange_code, renovar_access_token
-from sales import get_full_sales as get_sales
+from db import SessionLocal, engine
+from oauth import CLIENT_ID, get_auth_url, exchange_code, renovar_access_token
+from jobs import PRIORIDADES, enfileirar, listar_jobs, obter_job
+from ml_api import estatisticas_http_processos
+from sync_state import progresso
+import notifications
 
 # Carrega variáveis de ambiente
 load_dotenv()
@@ -33,6 +37,39 @@ def home():
 def health_check():
     return {"status": "ok"}
 
+@app.get("/stats/ml-http")
+def ml_http_stats(minutos: int = 60):
+    """
+    Reuso de conexões e latência por endpoint das chamadas ao Mercado Livre
+    de todos os processos (o worker faz quase todas), somados e por
+    processo. Cada processo grava o seu retrato junto com o ledger.
+    """
+    with engine.connect() as conn:
+        return estatisticas_http_processos(conn, minutos)
+
+@app.post("/notifications")
+def ml_notification(evento: dict = Body(...)):
+    """
+    Callback de notificações do Mercado Livre (orders_v2, shipments).
+    Só valida e enfileira; o worker (jobs.py) busca e grava os
+    pedidos afetados. O ML reenvia enquanto não recebe 200, por isso
+    eventos ignorados também respondem 200.
+    """
+    normalizado = notifications.validar(evento, CLIENT_ID)
+    if normalizado is None:
+        return {"status": "ignored"}
+    with engine.begin() as conn:
+        notifications.enfileirar(conn, normalizado)
+    return {"status": "queued"}
+
+@app.get("/notifications/stats")
+def ml_notification_stats(horas: int = Query(1, ge=1, le=168)):
+    """
+    Fila pendente e lag por evento (envio pelo ML → venda gravada).
+    """
+    with engine.connect() as conn:
+        return notifications.estatisticas(conn, horas)
+
 @app.get("/ml-login")
 def mercado_livre_login():
     """
@@ -44,7 +81,7 @@ def mercado_livre_login():
 def auth_callback(code: str = Query(None)):
     """
     Recebe o callback de autorização do Mercado Livre, realiza a troca do code pelo access token
-    e persiste as vendas no banco de dados.
+    e enfileira a importação do histórico de vendas.
     """
     # 1️⃣ valida o code
     if not code:
@@ -56,23 +93,63 @@ def auth_callback(code: str = Query(None)):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Erro ao trocar code: {e}")
 
-    # 3️⃣ busca e persiste todo o histórico de vendas via get_sales
+    # 3️⃣ importação do histórico vai para a fila; o worker (jobs.py) executa
     try:
-        ml_user_id    = str(token_payload["user_id"])
-        access_token  = token_payload["access_token"]
-
-        # 🔄 Aqui chamamos a versão paginada que criamos
-        vendas_coletadas = get_sales(ml_user_id, access_token)
-
-        # 🔍 Log para saber quantas foram coletadas
-        print(f"✅ Vendas salvas com sucesso: {vendas_coletadas}")
+        ml_user_id = str(token_payload["user_id"])
+        job_id = enfileirar("full", ml_user_id)
+        print(f"📥 Importação histórica de {ml_user_id} enfileirada (job {job_id})")
     except Exception as e:
         # Loga o erro mas não impede o redirect
-        print(f"⚠️ Erro ao buscar e persistir vendas históricas: {e}")
+        print(f"⚠️ Erro ao enfileirar importação histórica: {e}")
 
     # 4️⃣ redireciona de volta ao dashboard autenticado
     return RedirectResponse(f"{FRONTEND_URL}/?cyberdock_auth=success")
 
+@app.get("/sync/status/{ml_user_id}")
+def sync_status(ml_user_id: str):
+    """
+    Progresso da importação do histórico da conta: páginas, pedidos
+    salvos, vazão e ETA, além do último job da fila.
+    """
+    db = SessionLocal.session_factory()
+    try:
+        atual = progresso(db, ml_user_id)
+    finally:
+        db.close()
+    jobs = listar_jobs(ml_user_id, limite=1)
+    if atual is None and not jobs:
+        raise HTTPException(status_code=404, detail="Nenhuma importação para esta conta")
+    return {"progresso": atual, "job": jobs[0] if jobs else None}
+
+@app.get("/reconcile/cobertura")
+def reconcile_cobertura(user_id: str | None = Query(None)):
+    """
+    Cobertura da verificação contínua por conta: vendas nunca verificadas,
+    verificadas no ciclo atual e a verificação mais antiga.
+    """
+    from reconcile import cobertura
+
+    with engine.connect() as conn:
+        return cobertura(conn, user_id)
+
+@app.get("/reconcile/drift")
+def reconcile_drift(
+    dias: int = Query(30, ge=1, le=365),
+    user_id: str | None = Query(None),
+    run_id: str | None = Query(None),
+):
+    """
+    Divergências encontradas pelas reconciliações (inclusive simuladas):
+    frequência por coluna e resumo por conta.
+    """
+    from reconcile import drift_por_coluna, drift_por_conta
+
+    with engine.connect() as conn:
+        return {
+            "por_coluna": drift_por_coluna(conn, dias, user_id, run_id),
+            "por_conta":  drift_por_conta(conn, dias),
+        }
+
 @app.post("/auth/refresh")
 def auth_refresh(payload: dict = Body(...)):
     """
@@ -85,3 +162,34 @@ def auth_refresh(payload: dict = Body(...)):
     if not token:
         raise HTTPException(status_code=404, detail="Falha na renovação do token")
     return {"access_token": token}
+
+@app.post("/jobs")
+def criar_job(payload: dict = Body(...)):
+    """
+    Enfileira um job (full, incremental, review, reconcile, verify, fees) para uma conta.
+    """
+    tipo = payload.get("tipo")
+    if tipo not in PRIORIDADES:
+        raise HTTPException(status_code=400, detail=f"tipo deve ser um de {sorted(PRIORIDADES)}")
+    ml_user_id = payload.get("user_id")
+    if not ml_user_id:
+        raise HTTPException(status_code=400, detail="user_id não fornecido")
+    job_id = enfileirar(tipo, str(ml_user_id), payload.get("params"), payload.get("prioridade"))
+    return {"job_id": job_id}
+
+@app.get("/jobs/{job_id}")
+def status_job(job_id: int):
+    """
+    Status, tentativas e tempos de um job.
+    """
+    job = obter_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job não encontrado")
+    return job
+
+@app.get("/jobs")
+def jobs_recentes(user_id: str = Query(None), limite: int = Query(50, ge=1, le=500)):
+    """
+    Jobs mais recentes, opcionalmente de uma conta.
+    """
+    return listar_jobs(user_id, limite)
@@ -31,7 +31,7 @@ st.set_page_config(
 )
 
 # 3) Depois de set_page_config, importe tudo o mais que precisar
-from sales import sync_all_accounts, get_full_sales, revisar_banco_de_dados, get_incremental_sales, traduzir_status
+from sales import get_full_sales, revisar_banco_de_dados, get_incremental_sales, traduzir_status
 from streamlit_cookies_manager import EncryptedCookieManager
 import pandas as pd
 import plotly.express as px
@@ -48,7 +48,7 @@ import io
 from datetime import datetime, timedelta
 from utils import engine, DATA_INICIO, buscar_ml_fee
 import time
-from reconcile import reconciliar_vendas
+from jobs import enfileirar, enfileirar_contas, listar_jobs
 from dateutil.relativedelta import relativedelta
 
 
@@ -329,15 +329,13 @@ def format_currency(value):
 def mostrar_dashboard():
     import time
 
-    # --- sincroniza as vendas automaticamente apenas 1x ao carregar ---
+    # --- enfileira a sincronização apenas 1x ao carregar (o worker executa) ---
     if "vendas_sincronizadas" not in st.session_state:
-        with st.spinner("🔄 Sincronizando vendas..."):
-            count = sync_all_accounts()
-            st.cache_data.clear()
+        job_ids = enfileirar_contas("incremental")
         placeholder = st.empty()
         with placeholder:
-            st.success(f"{count} vendas novas sincronizadas com sucesso!")
-            time.sleep(3)
+            st.info(f"🔄 Sincronização de {len(job_ids)} contas em segundo plano.")
+            time.sleep(2)
         placeholder.empty()
         st.session_state["vendas_sincronizadas"] = True
 
@@ -869,7 +867,6 @@ import streamlit as st
 from sqlalchemy import text
 
 from db import engine
-from reconcile import reconciliar_vendas
 
 def mostrar_contas_cadastradas():
     st.markdown(
@@ -938,6 +935,17 @@ def mostrar_contas_cadastradas():
         key="contas"
     )
 
+    por_busca = st.checkbox(
+        "🔎 Comparar pelas páginas da busca (detalha só os pedidos divergentes)",
+        value=True,
+        key="reconciliar_por_busca"
+    )
+    dry_run = st.checkbox(
+        "🧪 Só simular: registra as divergências sem alterar as vendas",
+        value=False,
+        key="reconciliar_dry_run"
+    )
+
     # — 4) Botão único para executar —
     if st.button("🧹 Reconciliar", use_container_width=True):
         if not contas_selecionadas:
@@ -952,26 +960,81 @@ def mostrar_contas_cadastradas():
             desde = datetime.combine(data_unica, datetime.min.time())
             ate   = datetime.combine(data_unica, datetime.max.time())
 
-        # Loop de reconciliação
+        # Um job de reconciliação por conta; o worker (jobs.py) executa
         contas_df = df[df["nickname"].isin(contas_selecionadas)]
-        total = len(contas_df)
-        progresso = st.progress(0, text="🔁 Iniciando...")
-        atualizadas = erros = 0
-
-        for i, row in enumerate(contas_df.itertuples(index=False), start=1):
-            st.write(f"🔍 Conta **{row.nickname}**")
-            res = reconciliar_vendas(
-                ml_user_id=str(row.ml_user_id),
-                desde=desde,
-                ate=ate
-            )
-            atualizadas += res["atualizadas"]
-            erros       += res["erros"]
-            progresso.progress(i/total, text=f"⏳ {i}/{total}")
-            time.sleep(0.05)
+        params = {
+            "desde": desde.isoformat(),
+            "ate": ate.isoformat(),
+            "modo": "busca" if por_busca else "pedido",
+            "dry_run": dry_run,
+        }
+        for row in contas_df.itertuples(index=False):
+            enfileirar("reconcile", str(row.ml_user_id), params)
+        st.success(f"✅ Reconciliação enfileirada para {len(contas_df)} contas.")
+
+    # — 5) Status dos jobs —
+    jobs = listar_jobs(limite=20)
+    if jobs:
+        st.markdown("### 📋 Jobs recentes")
+        nomes = dict(zip(df["ml_user_id"].astype(str), df["nickname"]))
+        st.dataframe(
+            pd.DataFrame([
+                {
+                    "Job": j["id"],
+                    "Tipo": j["tipo"],
+                    "Conta": nomes.get(str(j["ml_user_id"]), j["ml_user_id"]),
+                    "Status": j["status"],
+                    "Tentativas": f"{j['tentativas']}/{j['max_tentativas']}",
+                    "Espera (s)": j.get("espera_segundos"),
+                    "Duração (s)": round(j["segundos"], 1) if j["segundos"] is not None else None,
+                    "Erro": j["erro"],
+                }
+                for j in jobs
+            ]),
+            use_container_width=True,
+            hide_index=True,
+        )
+
+    # — 6) Cobertura da verificação contínua (jobs "verify", de hora em hora) —
+    from reconcile import CICLO_DIAS, cobertura, drift_por_coluna
+    with engine.connect() as conn:
+        cob = cobertura(conn)
+        drift = drift_por_coluna(conn, dias=CICLO_DIAS)
+    if cob:
+        st.markdown(f"### 🎯 Cobertura da verificação (últimos {CICLO_DIAS} dias)")
+        nomes = dict(zip(df["ml_user_id"].astype(str), df["nickname"]))
+        st.dataframe(
+            pd.DataFrame([
+                {
+                    "Conta": nomes.get(str(c["ml_user_id"]), c["ml_user_id"]),
+                    "Vendas": c["vendas"],
+                    "Nunca verificadas": c["nunca"],
+                    "Verificadas no ciclo": c["no_ciclo"],
+                    "Cobertura (%)": c["cobertura_pct"],
+                    "Verificação mais antiga": c["mais_antiga"],
+                }
+                for c in cob
+            ]),
+            use_container_width=True,
+            hide_index=True,
+        )
 
-        progresso.empty()
-        st.success(f"✅ Concluído: {atualizadas} atualizações, {erros} erros.")
+    # — 7) Colunas que mais divergem (reconciliações e simulações) —
+    if drift:
+        st.markdown(f"### 🧮 Divergências por coluna (últimos {CICLO_DIAS} dias)")
+        st.dataframe(
+            pd.DataFrame([
+                {
+                    "Coluna": d["coluna"],
+                    "Pedidos divergentes": d["pedidos"],
+                    "Execuções": d["execucoes"],
+                    "Frequência (%)": d["frequencia_pct"],
+                }
+                for d in drift
+            ]),
+            use_container_width=True,
+            hide_index=True,
+        )
 
     # --- Seção por conta individual ---
     for row in df.itertuples(index=False):
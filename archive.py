@@ -0,0 +1,96 @@
+# archive.py – arquivo comprimido dos payloads brutos da API
+from __future__ import annotations
+
+import os
+import json
+import zlib
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from dateutil.tz import tzutc
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from models import SalePayload
+
+# ---------------- Configurações --------------- #
+NIVEL_ZLIB = 6
+ATIVO      = os.getenv("ML_ARQUIVAR_PAYLOADS", "1") == "1"
+
+
+def comprimir(bundle: Dict[str, Any]) -> bytes:
+    bruto = json.dumps(bundle, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return zlib.compress(bruto.encode("utf-8"), NIVEL_ZLIB)
+
+
+def descomprimir(dados: bytes) -> Dict[str, Any]:
+    return json.loads(zlib.decompress(dados).decode("utf-8"))
+
+
+def arquivar(db, ml_user_id: str, bundles: List[Dict[str, Any]]) -> int:
+    """
+    Guarda o bundle {"order", "shipment", "sla"} de cada pedido na mesma
+    transação de quem chama (o commit fica com o writer). Só reescreve a
+    linha se o conteúdo comprimido mudou.
+    """
+    if not ATIVO:
+        return 0
+    agora = datetime.now(tzutc())
+    linhas = {
+        int(b["order"]["id"]): {
+            "order_id":   int(b["order"]["id"]),
+            "ml_user_id": int(ml_user_id),
+            "payload":    comprimir(b),
+            "updated_at": agora,
+        }
+        for b in bundles if b and (b.get("order") or {}).get("id")
+    }
+    if not linhas:
+        return 0
+
+    tabela = SalePayload.__table__
+    stmt = pg_insert(tabela).values(list(linhas.values()))
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[tabela.c.order_id],
+        set_={"payload": stmt.excluded.payload, "updated_at": stmt.excluded.updated_at},
+        where=tabela.c.payload.is_distinct_from(stmt.excluded.payload),
+    )
+    db.execute(stmt)
+    return len(linhas)
+
+
+def iterar_arquivo(
+    db,
+    ml_user_id: Optional[str] = None,
+    lote: int = 1_000,
+) -> Iterator[List[Tuple[int, Dict[str, Any]]]]:
+    """Lê o arquivo em lotes de (ml_user_id, bundle), com cursor no servidor."""
+    tabela = SalePayload.__table__
+    stmt = select(tabela.c.ml_user_id, tabela.c.payload).order_by(tabela.c.order_id)
+    if ml_user_id is not None:
+        stmt = stmt.where(tabela.c.ml_user_id == int(ml_user_id))
+
+    resultado = db.connection().execution_options(stream_results=True, yield_per=lote).execute(stmt)
+    for linhas in resultado.partitions(lote):
+        yield [(uid, descomprimir(payload)) for uid, payload in linhas]
+
+
+def atualizar_bundles(db, mudancas: Dict[int, Dict[str, Any]]) -> int:
+    """
+    Aplica atualizações parciais (ex.: {"shipment": ..., "sla": ...}) aos
+    bundles já arquivados, sem commit. Pedidos sem bundle são ignorados.
+    """
+    if not ATIVO or not mudancas:
+        return 0
+    tabela = SalePayload.__table__
+    linhas = db.execute(
+        select(tabela.c.order_id, tabela.c.ml_user_id, tabela.c.payload)
+        .where(tabela.c.order_id.in_([int(oid) for oid in mudancas]))
+    ).all()
+
+    por_conta: Dict[int, List[Dict[str, Any]]] = {}
+    for order_id, uid, payload in linhas:
+        bundle = descomprimir(payload)
+        bundle.update(mudancas[int(order_id)])
+        por_conta.setdefault(uid, []).append(bundle)
+    return sum(arquivar(db, str(uid), bundles) for uid, bundles in por_conta.items())
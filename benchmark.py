@@ -0,0 +1,198 @@
+# benchmark.py – vazão dos caminhos de ingestão contra a API falsa (fake_ml.py)
+#
+#   DB_URL=postgresql://.../cyberdock_bench python benchmark.py --pedidos 5000 --latencia 30
+#
+# Use um banco descartável: as vendas dos vendedores sintéticos são apagadas
+# antes de cada rodada. Para cada caminho (full, incremental, review,
+# reconcile, reconcile_busca) mostra pedidos/s, chamadas à API por pedido e escritas no banco
+# por pedido.
+from __future__ import annotations
+
+import os
+import sys
+import time
+import json
+import argparse
+import subprocess
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List
+
+import requests
+
+CAMINHOS = ("full", "incremental", "review", "reconcile", "reconcile_busca")
+SELLER_BASE = 990_000_001   # ids sintéticos, longe das contas reais
+TABELAS_LIMPAS = ("sales", "sale_payloads", "sync_state", "sync_progress", "import_checkpoints", "fee_tentativas")
+
+
+def _args() -> argparse.Namespace:
+    p = argparse.ArgumentParser(description="Benchmark da ingestão contra fake_ml.py")
+    p.add_argument("--pedidos", type=int, default=2_000, help="pedidos por vendedor")
+    p.add_argument("--vendedores", type=int, default=1)
+    p.add_argument("--dias", type=int, default=365)
+    p.add_argument("--latencia", type=float, default=30, help="latência média em ms")
+    p.add_argument("--taxa-429", type=float, default=0.0)
+    p.add_argument("--taxa-erro", type=float, default=0.0)
+    p.add_argument("--mutar", type=float, default=0.05, help="fração de pedidos alterados antes do review/reconcile")
+    p.add_argument("--porta", type=int, default=9001)
+    p.add_argument("--caminhos", default=",".join(CAMINHOS))
+    p.add_argument("--json", action="store_true", help="imprime o resultado em JSON")
+    return p.parse_args()
+
+
+def _subir_servidor(args, vendedores: List[int]) -> subprocess.Popen:
+    env = dict(
+        os.environ,
+        FAKE_ML_VENDEDORES=",".join(f"{uid}:{args.pedidos}" for uid in vendedores),
+        FAKE_ML_DIAS=str(args.dias),
+        FAKE_ML_LATENCIA_MS=str(args.latencia),
+        FAKE_ML_TAXA_429=str(args.taxa_429),
+        FAKE_ML_TAXA_ERRO=str(args.taxa_erro),
+    )
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "fake_ml:app", "--port", str(args.porta), "--log-level", "warning"],
+        env=env,
+    )
+    for _ in range(100):
+        try:
+            requests.get(f"{os.environ['ML_API_ROOT']}/_stats", timeout=1).raise_for_status()
+            return proc
+        except requests.RequestException:
+            time.sleep(0.2)
+    proc.terminate()
+    raise RuntimeError("fake_ml não subiu")
+
+
+class ContadorEscritas:
+    """INSERT/UPDATE/DELETE enviados ao banco (fora o ledger de chamadas)."""
+
+    def __init__(self, engines):
+        from sqlalchemy import event
+
+        self.comandos = 0
+        for engine in engines:
+            event.listen(engine, "before_cursor_execute", self._contar)
+
+    def _contar(self, conn, cursor, statement, parameters, context, executemany):
+        inicio = statement.lstrip()[:6].upper()
+        if inicio in ("INSERT", "UPDATE", "DELETE") and "ml_api_ledger" not in statement:
+            self.comandos += 1
+
+
+def _tuplas_escritas(engine) -> int:
+    """Linhas inseridas/alteradas/apagadas segundo pg_stat (aproximado: a estatística tem atraso)."""
+    from sqlalchemy import text
+
+    time.sleep(1.0)
+    with engine.connect() as conn:
+        conn.execute(text("SELECT pg_stat_clear_snapshot()"))
+        return int(conn.execute(text("""
+            SELECT coalesce(sum(n_tup_ins + n_tup_upd + n_tup_del), 0)
+            FROM pg_stat_user_tables WHERE relname <> 'ml_api_ledger'
+        """)).scalar())
+
+
+def main() -> None:
+    args = _args()
+    os.environ["ML_API_ROOT"] = f"http://127.0.0.1:{args.porta}"
+    for chave in ("ML_CLIENT_ID", "ML_CLIENT_SECRET", "BACKEND_URL"):
+        os.environ.setdefault(chave, "benchmark")
+    if not os.getenv("DB_URL"):
+        raise SystemExit("❌ Defina DB_URL apontando para um banco descartável")
+
+    vendedores = [SELLER_BASE + i for i in range(args.vendedores)]
+    servidor = _subir_servidor(args, vendedores)
+    api = os.environ["ML_API_ROOT"]
+
+    # Só agora: API_ROOT e as conexões são lidos no import
+    from sqlalchemy import text
+    import db as db_mod
+    import utils
+    from sales import get_full_sales, get_incremental_sales, revisar_banco_de_dados
+    from reconcile import reconciliar_por_busca, reconciliar_vendas
+
+    engine = db_mod.engine
+    escritas = ContadorEscritas({engine, utils.engine})
+
+    with engine.begin() as conn:
+        for tabela in TABELAS_LIMPAS:
+            conn.execute(text(f"DELETE FROM {tabela} WHERE ml_user_id = ANY(:ids)"), {"ids": vendedores})
+        for uid in vendedores:
+            conn.execute(text("""
+                INSERT INTO user_tokens (id, ml_user_id, access_token, refresh_token, expires_at)
+                VALUES (:uid, :uid, :token, :refresh, :expira)
+                ON CONFLICT (ml_user_id) DO UPDATE
+                  SET access_token = EXCLUDED.access_token, refresh_token = EXCLUDED.refresh_token,
+                      expires_at = EXCLUDED.expires_at
+            """), {
+                "uid": uid, "token": f"fake-access-{uid}-0", "refresh": f"fake-refresh-{uid}",
+                "expira": datetime.utcnow() + timedelta(hours=6),
+            })
+
+    agora = datetime.utcnow()
+    passos: Dict[str, Callable[[str, str], Any]] = {
+        "full":        lambda uid, tok: get_full_sales(uid, tok),
+        "incremental": lambda uid, tok: get_incremental_sales(uid, tok),
+        "review":      lambda uid, tok: revisar_banco_de_dados(uid, tok),
+        "reconcile":   lambda uid, tok: reconciliar_vendas(
+            uid, desde=agora - timedelta(days=args.dias + 1), ate=agora + timedelta(days=1),
+        ),
+        "reconcile_busca": lambda uid, tok: reconciliar_por_busca(
+            uid, desde=agora - timedelta(days=args.dias + 1), ate=agora + timedelta(days=1),
+        ),
+    }
+
+    resultados: List[Dict[str, Any]] = []
+    try:
+        for caminho in [c.strip() for c in args.caminhos.split(",") if c.strip()]:
+            if caminho in ("review", "reconcile", "reconcile_busca") and args.mutar:
+                requests.post(f"{api}/_mutar", params={"fracao": args.mutar}).raise_for_status()
+            requests.post(f"{api}/_reset").raise_for_status()
+            comandos_antes = escritas.comandos
+            tuplas_antes = _tuplas_escritas(engine)
+
+            inicio = time.monotonic()
+            for uid in vendedores:
+                passos[caminho](str(uid), f"fake-access-{uid}-0")
+            segundos = time.monotonic() - inicio
+
+            stats = requests.get(f"{api}/_stats").json()
+            pedidos = stats["pedidos_vistos"]
+            if not pedidos:
+                # reconcile não usa a busca: conta as vendas do escopo
+                with engine.connect() as conn:
+                    pedidos = conn.execute(
+                        text("SELECT count(*) FROM sales WHERE ml_user_id = ANY(:ids)"), {"ids": vendedores}
+                    ).scalar()
+            comandos = escritas.comandos - comandos_antes
+            tuplas = _tuplas_escritas(engine) - tuplas_antes
+            resultados.append({
+                "caminho":           caminho,
+                "pedidos":           pedidos,
+                "segundos":          round(segundos, 2),
+                "pedidos_por_seg":   round(pedidos / segundos, 1) if segundos else None,
+                "chamadas_api":      stats["total"],
+                "chamadas_por_pedido": round(stats["total"] / pedidos, 3) if pedidos else None,
+                "comandos_por_pedido": round(comandos / pedidos, 3) if pedidos else None,
+                "tuplas_por_pedido":   round(tuplas / pedidos, 3) if pedidos else None,
+                "por_endpoint":      stats["chamadas"],
+            })
+    finally:
+        servidor.terminate()
+        servidor.wait(timeout=10)
+
+    if args.json:
+        print(json.dumps(resultados, indent=2))
+        return
+
+    print(f"\n🏁 {args.vendedores} vendedor(es) × {args.pedidos} pedidos, latência {args.latencia} ms, "
+          f"429 {args.taxa_429:.0%}, 5xx {args.taxa_erro:.0%}")
+    print(f"{'caminho':<16}{'pedidos':>9}{'s':>9}{'ped/s':>9}{'API/ped':>9}{'cmd/ped':>9}{'tup/ped':>9}")
+    for r in resultados:
+        print(
+            f"{r['caminho']:<16}{r['pedidos']:>9}{r['segundos']:>9}{r['pedidos_por_seg'] or 0:>9}"
+            f"{r['chamadas_por_pedido'] or 0:>9}{r['comandos_por_pedido'] or 0:>9}{r['tuplas_por_pedido'] or 0:>9}"
+        )
+
+
+if __name__ == "__main__":
+    main()
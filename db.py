@@ -1,6 +1,6 @@
 # database/db.py (otimizado)
 import os
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
 from sqlalchemy.orm import sessionmaker, scoped_session
 from dotenv import load_dotenv
 from models import Base
@@ -25,9 +25,39 @@ SessionLocal = scoped_session(
     sessionmaker(autocommit=False, autoflush=False, bind=engine)
 )
 
+# create_all não altera tabelas que já existem: colunas e índices novos entram
+# aqui. Só viram DDL quando faltam no catálogo, então o import não pede lock
+# ACCESS EXCLUSIVE em `sales` toda vez
+COLUNAS_NOVAS = [
+    ("sales", "content_hash", "VARCHAR(32)"),
+    ("sales", "last_verified_at", "TIMESTAMPTZ"),
+    ("sales", "shipments_refreshed_at", "TIMESTAMPTZ"),
+]
+INDICES_NOVOS = [
+    ("sales", "ix_sales_verificacao", "CREATE INDEX IF NOT EXISTS ix_sales_verificacao ON sales (ml_user_id, last_verified_at)"),
+    ("sync_jobs", "uq_sync_jobs_executando",
+     "CREATE UNIQUE INDEX IF NOT EXISTS uq_sync_jobs_executando ON sync_jobs (ml_user_id) WHERE status = 'executando'"),
+]
+
 def init_db():
-    """Cria as tabelas no banco de dados."""
+    """Cria as tabelas no banco de dados e adiciona só as colunas/índices que faltam."""
+    from sqlalchemy import inspect
+
     Base.metadata.create_all(bind=engine)
+    insp = inspect(engine)
+    colunas = {t: {c["name"] for c in insp.get_columns(t)} for t, _, _ in COLUNAS_NOVAS}
+    indices = {t: {i["name"] for i in insp.get_indexes(t)} for t, _, _ in INDICES_NOVOS}
+
+    ddls = [
+        f"ALTER TABLE {t} ADD COLUMN IF NOT EXISTS {c} {tipo}"
+        for t, c, tipo in COLUNAS_NOVAS if c not in colunas[t]
+    ] + [ddl for t, nome, ddl in INDICES_NOVOS if nome not in indices[t]]
+    if not ddls:
+        return
+    with engine.begin() as conn:
+        for ddl in ddls:
+            print(f"🛠️ {ddl}")
+            conn.execute(text(ddl))
 
 # Inicializa as tabelas ao importar
 init_db()
@@ -0,0 +1,278 @@
+# fake_ml.py – API falsa do Mercado Livre para benchmarks locais
+#
+#   FAKE_ML_VENDEDORES="1001:5000,1002:300" uvicorn fake_ml:app --port 9001
+#   ML_API_ROOT=http://127.0.0.1:9001 python benchmark.py
+#
+# Vendedores e pedidos são sintéticos e determinísticos (mesma semente,
+# mesmos dados). Latência, taxa de 429 e de erros 5xx são configuráveis.
+from __future__ import annotations
+
+import os
+import random
+import asyncio
+import threading
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from dateutil import parser
+from dateutil.tz import tzutc
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+# ---------------- Configurações --------------- #
+VENDEDORES      = os.getenv("FAKE_ML_VENDEDORES", "1001:2000")   # seller:pedidos,...
+DIAS_HISTORICO  = int(os.getenv("FAKE_ML_DIAS", "365"))
+LATENCIA_MS     = float(os.getenv("FAKE_ML_LATENCIA_MS", "30"))   # média (exponencial)
+TAXA_429        = float(os.getenv("FAKE_ML_TAXA_429", "0"))
+TAXA_ERRO       = float(os.getenv("FAKE_ML_TAXA_ERRO", "0"))      # 5xx
+TAXA_INCOMPLETO = float(os.getenv("FAKE_ML_TAXA_INCOMPLETO", "0.02"))  # busca sem payments
+TAXA_SEM_FEE    = float(os.getenv("FAKE_ML_TAXA_SEM_FEE", "0.01"))
+TOKEN_SEG       = int(os.getenv("FAKE_ML_TOKEN_SEG", "21600"))
+SEMENTE         = int(os.getenv("FAKE_ML_SEED", "42"))
+LIMITE_OFFSET   = 10_000
+
+STATUS_ENVIO = ("ready_to_ship", "shipped", "delivered", "delivered", "delivered", "not_delivered")
+LOGISTICA    = ("fulfillment", "cross_docking", "drop_off", "self_service")
+SKUS         = [f"SKU-{i:04d}" for i in range(200)]
+
+
+# ------------------ Dados sintéticos ------------------ #
+class Vendedor:
+    """Pedidos de um vendedor, ordenados por date_closed."""
+
+    def __init__(self, seller_id: int, quantidade: int, fim: datetime):
+        rnd = random.Random(SEMENTE * 1_000_003 + seller_id)
+        inicio = fim - timedelta(days=DIAS_HISTORICO)
+        passo = (fim - inicio) / max(quantidade, 1)
+
+        self.seller_id = seller_id
+        self.pedidos: List[Dict[str, Any]] = []
+        for i in range(quantidade):
+            fechado = inicio + passo * i + timedelta(seconds=rnd.randint(0, max(1, int(passo.total_seconds()) - 1)))
+            self.pedidos.append({
+                "id":          seller_id * 10_000_000 + i,
+                "date_closed": fechado,
+                "sku":         rnd.choice(SKUS),
+                "quantidade":  rnd.randint(1, 3),
+                "preco":       round(rnd.uniform(20, 400), 2),
+                "status":      "cancelled" if rnd.random() < 0.05 else "paid",
+                "envio":       rnd.choice(STATUS_ENVIO),
+                "logistica":   rnd.choice(LOGISTICA),
+                "sem_fee":     rnd.random() < TAXA_SEM_FEE,
+                "incompleto":  rnd.random() < TAXA_INCOMPLETO,
+                "versao":      0,
+            })
+        self.datas = [p["date_closed"] for p in self.pedidos]
+        self.por_id = {p["id"]: p for p in self.pedidos}
+
+
+def _iso(valor: datetime) -> str:
+    return valor.isoformat(timespec="milliseconds")
+
+
+def _pagamentos(p: Dict[str, Any]) -> List[Dict[str, Any]]:
+    total = round(p["preco"] * p["quantidade"], 2)
+    return [{
+        "id":              p["id"] + 5_000_000_000,
+        "status":          "approved",
+        "transaction_amount": total,
+        "marketplace_fee": None if p["sem_fee"] else round(total * 0.14, 2),
+    }]
+
+
+def _pedido(p: Dict[str, Any], seller_id: int, busca: bool = False) -> Dict[str, Any]:
+    total = round(p["preco"] * p["quantidade"], 2)
+    pedido = {
+        "id":           p["id"],
+        "status":       p["status"],
+        "date_closed":  _iso(p["date_closed"]),
+        "total_amount": total,
+        "seller":       {"id": seller_id},
+        "buyer":        {"id": p["id"] % 9_999_991, "nickname": f"COMPRADOR{p['id'] % 997}"},
+        "shipping":     {"id": p["id"] + 40_000_000_000},
+        "order_items":  [{
+            "item":       {"id": f"MLB{p['id'] % 10_000_000}", "title": f"Produto {p['sku']}", "seller_sku": p["sku"]},
+            "quantity":   p["quantidade"],
+            "unit_price": p["preco"],
+        }],
+        "payments":     _pagamentos(p),
+    }
+    if busca and p["incompleto"]:
+        pedido["payments"] = None
+    return pedido
+
+
+def _envio(p: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "id":            p["id"] + 40_000_000_000,
+        "order_id":      p["id"],
+        "status":        p["envio"],
+        "substatus":     None if p["versao"] == 0 else f"v{p['versao']}",
+        "last_updated":  _iso(p["date_closed"] + timedelta(days=2, hours=p["versao"])),
+        "mode":          "me2",
+        "logistic_type": p["logistica"],
+        "order_cost":    round(p["preco"] * p["quantidade"], 2),
+        "base_cost":     19.9,
+        "shipping_option": {"list_cost": 24.9, "cost": 0 if p["preco"] > 79 else 19.9, "delivery_type": "estimated"},
+        "receiver_address": {"receiver_name": f"Cliente {p['id'] % 1009}"},
+    }
+
+
+app = FastAPI(title="Fake Mercado Livre")
+_fim = datetime.now(tzutc())
+_vendedores: Dict[int, Vendedor] = {}
+for trecho in filter(None, VENDEDORES.split(",")):
+    sid, qtd = trecho.split(":")
+    _vendedores[int(sid)] = Vendedor(int(sid), int(qtd), _fim)
+_pedidos = {oid: (v, p) for v in _vendedores.values() for oid, p in v.por_id.items()}
+
+_lock = threading.Lock()
+_chamadas: Counter = Counter()
+_vistos: set = set()
+_rnd = random.Random(SEMENTE)
+
+
+def _endpoint(path: str) -> str:
+    partes = ["{id}" if parte.isdigit() else parte for parte in path.strip("/").split("/")]
+    return "/" + "/".join(partes)
+
+
+@app.middleware("http")
+async def _simular_rede(request: Request, call_next):
+    path = request.url.path
+    if path.startswith("/_"):
+        return await call_next(request)
+    with _lock:
+        _chamadas[_endpoint(path)] += 1
+        sorteio = _rnd.random()
+        espera = _rnd.expovariate(1000 / LATENCIA_MS) if LATENCIA_MS > 0 else 0
+    if espera:
+        await asyncio.sleep(espera)
+    if sorteio < TAXA_429:
+        return JSONResponse({"message": "too_many_requests"}, status_code=429, headers={"Retry-After": "1"})
+    if sorteio < TAXA_429 + TAXA_ERRO:
+        return JSONResponse({"message": "internal_error"}, status_code=503)
+    if path != "/oauth/token" and not request.headers.get("authorization", "").startswith("Bearer "):
+        return JSONResponse({"message": "invalid_token"}, status_code=401)
+    return await call_next(request)
+
+
+# ------------------- Endpoints ------------------- #
+@app.get("/orders/search")
+def orders_search(request: Request):
+    q = request.query_params
+    vendedor = _vendedores.get(int(q.get("seller", 0)))
+    offset, limit = int(q.get("offset", 0)), min(int(q.get("limit", 50)), 51)
+    if offset >= LIMITE_OFFSET:
+        return JSONResponse({"message": f"offset must be lower than {LIMITE_OFFSET}"}, status_code=400)
+    if vendedor is None:
+        return {"results": [], "paging": {"total": 0, "offset": offset, "limit": limit}}
+
+    desde = parser.isoparse(q["order.date_closed.from"]) if q.get("order.date_closed.from") else None
+    ate = parser.isoparse(q["order.date_closed.to"]) if q.get("order.date_closed.to") else None
+    i = bisect_left(vendedor.datas, desde) if desde else 0
+    j = bisect_right(vendedor.datas, ate) if ate else len(vendedor.datas)
+    faixa = vendedor.pedidos[i:j]
+    if q.get("sort") == "date_desc":
+        faixa = faixa[::-1]
+
+    pagina = faixa[offset:offset + limit]
+    with _lock:
+        _vistos.update(p["id"] for p in pagina)
+    return {
+        "results": [_pedido(p, vendedor.seller_id, busca=True) for p in pagina],
+        "paging":  {"total": len(faixa), "offset": offset, "limit": limit},
+    }
+
+
+@app.get("/orders/{order_id}")
+def order(order_id: int):
+    achado = _pedidos.get(order_id)
+    if achado is None:
+        return JSONResponse({"message": "order not found"}, status_code=404)
+    vendedor, p = achado
+    return _pedido(p, vendedor.seller_id)
+
+
+@app.get("/orders/{order_id}/payments")
+def order_payments(order_id: int):
+    achado = _pedidos.get(order_id)
+    if achado is None:
+        return JSONResponse({"message": "order not found"}, status_code=404)
+    return _pagamentos(achado[1])
+
+
+def _pedido_do_envio(shipment_id: int) -> Optional[Dict[str, Any]]:
+    achado = _pedidos.get(shipment_id - 40_000_000_000)
+    return achado[1] if achado else None
+
+
+@app.get("/shipments/{shipment_id}")
+def shipment(shipment_id: int):
+    p = _pedido_do_envio(shipment_id)
+    if p is None:
+        return JSONResponse({"message": "shipment not found"}, status_code=404)
+    return _envio(p)
+
+
+@app.get("/shipments/{shipment_id}/sla")
+def shipment_sla(shipment_id: int):
+    p = _pedido_do_envio(shipment_id)
+    if p is None:
+        return JSONResponse({"message": "shipment not found"}, status_code=404)
+    return {"status": "on_time", "expected_date": _iso(p["date_closed"] + timedelta(days=1, hours=p["versao"]))}
+
+
+@app.post("/oauth/token")
+async def oauth_token(request: Request):
+    form = await request.form()
+    uid = next(iter(_vendedores), 0)
+    refresh = form.get("refresh_token") or ""
+    if refresh.startswith("fake-refresh-"):
+        uid = int(refresh.rsplit("-", 1)[1])
+    with _lock:
+        n = _rnd.randint(0, 10**9)
+    return {
+        "access_token":  f"fake-access-{uid}-{n}",
+        "refresh_token": f"fake-refresh-{uid}",
+        "expires_in":    TOKEN_SEG,
+        "user_id":       uid,
+        "token_type":    "Bearer",
+    }
+
+
+# ------------------- Controle do benchmark ------------------- #
+@app.get("/_stats")
+def stats():
+    with _lock:
+        return {
+            "chamadas":       dict(_chamadas),
+            "total":          sum(_chamadas.values()),
+            "pedidos_vistos": len(_vistos),
+            "vendedores":     {sid: len(v.pedidos) for sid, v in _vendedores.items()},
+        }
+
+
+@app.post("/_reset")
+def reset():
+    with _lock:
+        _chamadas.clear()
+        _vistos.clear()
+    return {"ok": True}
+
+
+@app.post("/_mutar")
+def mutar(fracao: float = 0.05, seller: Optional[int] = None):
+    """Altera status/envio/SLA de uma fração dos pedidos (diferenças para revisão e reconcile)."""
+    alvos = [v for sid, v in _vendedores.items() if seller is None or sid == seller]
+    alterados = 0
+    with _lock:
+        for v in alvos:
+            for p in v.pedidos:
+                if _rnd.random() < fracao:
+                    p["versao"] += 1
+                    p["envio"] = "delivered" if p["envio"] != "delivered" else "not_delivered"
+                    alterados += 1
+    return {"alterados": alterados}
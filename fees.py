@@ -0,0 +1,168 @@
+# fees.py – preenchimento em lote das ml_fee pendentes
+from __future__ import annotations
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+from dateutil.tz import tzutc
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from models import FeeTentativa
+from ml_api import API_ROOT, RunCache, get_json
+
+# ---------------- Configurações --------------- #
+MAX_WORKERS       = 10
+LOTE_UPDATE       = 5_000    # pares (order_id, fee) por UPDATE ... FROM (VALUES ...)
+MAX_TENTATIVAS    = int(os.getenv("ML_FEE_MAX_TENTATIVAS", "3"))
+INTERVALO_RETENTA = timedelta(days=1)
+
+API_ORDER    = f"{API_ROOT}/orders/{{}}"
+API_PAYMENTS = f"{API_ROOT}/orders/{{}}/payments"
+
+# Pendentes, menos os que já falharam MAX_TENTATIVAS vezes
+# ou que foram tentados há menos de INTERVALO_RETENTA
+_SQL_PENDENTES = text("""
+    SELECT s.order_id
+    FROM sales s
+    LEFT JOIN fee_tentativas f ON f.order_id = s.order_id
+    WHERE s.ml_user_id = :uid
+      AND s.ml_fee IS NULL
+      AND s.date_closed >= :inicio
+      AND (f.order_id IS NULL
+           OR (f.tentativas < :max_tentativas AND f.ultima_tentativa < :retentar_antes))
+""")
+
+
+def _fee_dos_payments(payments: Any) -> Optional[Any]:
+    """Mesmo critério de `_build_sale`: marketplace_fee do primeiro payment."""
+    if isinstance(payments, list) and payments:
+        return (payments[0] or {}).get("marketplace_fee")
+    return None
+
+
+def _fee_em_cache(cache: RunCache, order_id: int) -> Optional[Any]:
+    """ml_fee a partir do que a execução já baixou (/orders/{id} ou /payments)."""
+    for url in (API_ORDER.format(order_id), API_PAYMENTS.format(order_id)):
+        dados = cache.get(url)
+        if isinstance(dados, dict):
+            dados = dados.get("payments")
+        fee = _fee_dos_payments(dados)
+        if fee is not None:
+            return fee
+    return None
+
+
+def _aplicar_fees(conn, fees: List[Tuple[int, Any]]) -> int:
+    """Grava todas as fees com UPDATE ... FROM (VALUES ...), em blocos de LOTE_UPDATE."""
+    atualizadas = 0
+    for inicio in range(0, len(fees), LOTE_UPDATE):
+        bloco = fees[inicio:inicio + LOTE_UPDATE]
+        valores = ", ".join(
+            f"(CAST(:o{i} AS BIGINT), CAST(:f{i} AS NUMERIC))" for i in range(len(bloco))
+        )
+        params: Dict[str, Any] = {}
+        for i, (order_id, fee) in enumerate(bloco):
+            params[f"o{i}"] = order_id
+            params[f"f{i}"] = fee
+        res = conn.execute(text(f"""
+            UPDATE sales AS s SET ml_fee = v.fee
+            FROM (VALUES {valores}) AS v(order_id, fee)
+            WHERE s.order_id = v.order_id AND s.ml_fee IS NULL
+        """), params)
+        atualizadas += res.rowcount
+    return atualizadas
+
+
+def _registrar_sem_fee(conn, ml_user_id: str, order_ids: List[int]) -> None:
+    """Conta mais uma tentativa sem fee para cada pedido."""
+    if not order_ids:
+        return
+    agora = datetime.now(tzutc())
+    tabela = FeeTentativa.__table__
+    stmt = pg_insert(tabela).values([
+        {"order_id": oid, "ml_user_id": int(ml_user_id), "tentativas": 1, "ultima_tentativa": agora}
+        for oid in order_ids
+    ])
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[tabela.c.order_id],
+        set_={
+            "tentativas":       tabela.c.tentativas + 1,
+            "ultima_tentativa": stmt.excluded.ultima_tentativa,
+        },
+    )
+    conn.execute(stmt)
+
+
+def preencher_fees(
+    ml_user_id: str,
+    access_token: str,
+    cache: Optional[RunCache] = None,
+    max_workers: int = MAX_WORKERS,
+) -> Dict[str, int]:
+    """
+    Completa ml_fee das vendas pendentes da conta. Usa primeiro os payloads
+    já baixados na execução (`cache`) e só então /orders/{id}/payments.
+    Pedidos em que a API respondeu sem fee ficam em fee_tentativas e não
+    são rebuscados a cada sync.
+    Retorna {"pendentes", "do_cache", "da_api", "atualizadas", "sem_fee"}.
+    """
+    from db import engine
+    from utils import DATA_INICIO
+
+    totais = {"pendentes": 0, "do_cache": 0, "da_api": 0, "atualizadas": 0, "sem_fee": 0}
+
+    with engine.connect() as conn:
+        pendentes = [row[0] for row in conn.execute(_SQL_PENDENTES, {
+            "uid":            int(ml_user_id),
+            "inicio":         DATA_INICIO,
+            "max_tentativas": MAX_TENTATIVAS,
+            "retentar_antes": datetime.now(tzutc()) - INTERVALO_RETENTA,
+        })]
+    totais["pendentes"] = len(pendentes)
+    if not pendentes:
+        print(f"📭 Nenhuma venda pendente para atualizar fees de {ml_user_id}.")
+        return totais
+
+    if cache is None:
+        cache = RunCache(conta=ml_user_id, job="fees")
+
+    fees: List[Tuple[int, Any]] = []
+    faltam: List[int] = []
+    for order_id in pendentes:
+        fee = _fee_em_cache(cache, order_id)
+        if fee is not None:
+            fees.append((order_id, fee))
+        else:
+            faltam.append(order_id)
+    totais["do_cache"] = len(fees)
+
+    sem_fee: List[int] = []
+    if faltam:
+        print(f"📦 {len(faltam)} vendas sem fee fora do cache. Buscando payments com até {max_workers} threads...")
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            respostas = list(executor.map(
+                lambda oid: get_json(API_PAYMENTS.format(oid), access_token, cache=cache), faltam
+            ))
+        for order_id, payments in zip(faltam, respostas):
+            if payments is None:
+                continue  # falha de rede/HTTP: tenta de novo no próximo sync
+            fee = _fee_dos_payments(payments)
+            if fee is not None:
+                fees.append((order_id, fee))
+                totais["da_api"] += 1
+            else:
+                sem_fee.append(order_id)
+
+    with engine.begin() as conn:
+        totais["atualizadas"] = _aplicar_fees(conn, fees)
+        _registrar_sem_fee(conn, ml_user_id, sem_fee)
+    totais["sem_fee"] = len(sem_fee)
+
+    print(
+        f"✅ Fees de {ml_user_id}: {totais['atualizadas']}/{len(pendentes)} atualizadas "
+        f"({totais['do_cache']} do cache, {totais['da_api']} da API, {totais['sem_fee']} sem fee)"
+    )
+    return totais
@@ -0,0 +1,432 @@
+# ingestion.py – motor assíncrono de ingestão de vendas
+from __future__ import annotations
+
+import os
+import asyncio
+import logging
+from dataclasses import dataclass, replace
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+import requests
+from dateutil.relativedelta import relativedelta
+
+from db import SessionLocal
+from models import Sale
+from ml_api import API_ROOT, RUNCACHE_MAX, RunCache, estatisticas_http, ledger, requisitar
+from sku_cache import catalogo_sku
+from archive import arquivar
+
+# ---------------- Configurações --------------- #
+MAX_IN_FLIGHT = int(os.getenv("ML_MAX_IN_FLIGHT", "16"))
+PAGE_SIZE     = 50
+LIMITE_OFFSET = 10_000                 # a busca não pagina além disso
+JANELA_MINIMA = timedelta(minutes=1)   # abaixo disso não divide mais
+
+API_SEARCH   = f"{API_ROOT}/orders/search"
+API_ORDER    = f"{API_ROOT}/orders/{{}}"
+API_PAYMENTS = f"{API_ROOT}/orders/{{}}/payments"
+API_SHIPMENT = f"{API_ROOT}/shipments/{{}}"
+API_SLA      = f"{API_ROOT}/shipments/{{}}/sla"
+
+# writer(db, vendas_da_pagina) -> contadores somados ao resultado final
+Writer = Callable[[Any, List[Sale]], Dict[str, int]]
+# triagem(db, pedidos_da_busca) -> só os pedidos que precisam ser detalhados e gravados
+Triagem = Callable[[Any, List[Dict[str, Any]]], List[Dict[str, Any]]]
+
+
+@dataclass
+class Janela:
+    """Intervalo de date_closed varrido com /orders/search."""
+    desde: datetime
+    ate: Optional[datetime] = None
+    sort: str = "date_asc"
+    max_paginas: Optional[int] = None
+    somente_busca: bool = False
+    estimado: Optional[int] = None  # paging.total visto no planejamento
+    offset_inicial: int = 0         # retomada a partir de um checkpoint
+
+
+def janelas_mensais(data_min: datetime, data_max: datetime, sort: str = "date_asc") -> List[Janela]:
+    """
+    Quebra [data_min, data_max] em janelas de um mês, da mais recente
+    para a mais antiga (mesma ordem dos loops originais).
+    """
+    inicio_min = data_min.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    atual      = data_max.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    janelas: List[Janela] = []
+    while atual >= inicio_min:
+        fim = (atual + relativedelta(months=1)) - timedelta(milliseconds=1)
+        janelas.append(Janela(desde=atual, ate=fim, sort=sort))
+        atual -= relativedelta(months=1)
+    return janelas
+
+
+# ------------ Cliente HTTP assíncrono ------------- #
+class _Fetcher:
+    """
+    Executa os GETs bloqueantes (ml_api.requisitar) num pool de threads,
+    limitando as requisições simultâneas com um semáforo. GETs de
+    entidades (sem params) passam pelo `RunCache` e por um mapa de
+    requisições em andamento, então cada URL é baixada uma única vez.
+    """
+
+    def __init__(
+        self,
+        access_token: str,
+        max_in_flight: int,
+        renovar_token: Optional[Callable[[str], Optional[str]]] = None,
+        cache: Optional[RunCache] = None,
+    ):
+        self.access_token  = access_token
+        self.renovar_token = renovar_token
+        self.cache         = cache if cache is not None else RunCache()
+        self._sem          = asyncio.Semaphore(max_in_flight)
+        self._executor     = ThreadPoolExecutor(max_workers=max_in_flight)
+        self._pendentes: Dict[str, asyncio.Future] = {}
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False)
+
+    async def _get(self, url: str, token: str, params: Optional[dict] = None) -> requests.Response:
+        loop = asyncio.get_running_loop()
+        async with self._sem:
+            return await loop.run_in_executor(
+                self._executor,
+                lambda: requisitar(
+                    "GET", url, conta=self.cache.conta, job=self.cache.job,
+                    access_token=token, params=params,
+                ),
+            )
+
+    async def get_json(self, url: str, params: Optional[dict] = None) -> Any:
+        if params is not None:
+            return await self._baixar(url, params)
+
+        hit = self.cache.get(url)
+        if hit is not None:
+            return hit
+        pendente = self._pendentes.get(url)
+        if pendente is not None:
+            return await pendente
+
+        tarefa = asyncio.ensure_future(self._baixar(url, None))
+        self._pendentes[url] = tarefa
+        try:
+            dados = await tarefa
+        finally:
+            self._pendentes.pop(url, None)
+        if dados is not None:
+            self.cache.put(url, dados)
+        return dados
+
+    async def _baixar(self, url: str, params: Optional[dict]) -> Any:
+        try:
+            token = self.access_token
+            self.cache.contar(url)
+            resp = await self._get(url, token, params)
+            if resp.status_code == 401 and self.renovar_token:
+                # Vários 401 simultâneos viram uma única renovação no gerenciador
+                novo = await asyncio.get_running_loop().run_in_executor(
+                    self._executor, self.renovar_token, token
+                )
+                if novo and novo != token:
+                    self.access_token = novo
+                    self.cache.contar(url)
+                    resp = await self._get(url, novo, params)
+            if not resp.ok:
+                logging.warning(f"⚠️ Falha {resp.status_code} em {url}")
+                return None
+            return resp.json()
+        except requests.RequestException as e:
+            logging.warning(f"⚠️ Req error ({url}): {e}")
+            return None
+
+    async def order_bundle(self, order_id: str) -> Optional[Dict[str, Any]]:
+        """Ordem completa + payments (fallback), shipment e SLA em paralelo."""
+        order = await self.get_json(API_ORDER.format(order_id))
+        if order is None:
+            print(f"⚠️ Falha ao buscar ordem completa {order_id}")
+            return None
+        return await self.enriquecer(order)
+
+    async def enriquecer(self, order: Dict[str, Any]) -> Dict[str, Any]:
+        """Completa um pedido já em mãos com payments, shipment e SLA."""
+        order_id = order.get("id")
+        shipment_id = (order.get("shipping") or {}).get("id")
+
+        async def _vazio():
+            return None
+
+        payments, shipment, sla = await asyncio.gather(
+            self.get_json(API_PAYMENTS.format(order_id)) if not order.get("payments") else _vazio(),
+            self.get_json(API_SHIPMENT.format(shipment_id)) if shipment_id else _vazio(),
+            self.get_json(API_SLA.format(shipment_id)) if shipment_id else _vazio(),
+        )
+        if isinstance(payments, list) and payments:
+            order["payments"] = payments
+
+        return {"order": order, "shipment": shipment or {}, "sla": sla or {}}
+
+
+# --------------- Planejamento das janelas -------------- #
+def _iso(valor: datetime) -> str:
+    return valor.isoformat(timespec="milliseconds")
+
+
+def _params_busca(ml_user_id: str, janela: Janela, offset: int, limit: int = PAGE_SIZE) -> dict:
+    params = {
+        "seller": ml_user_id,
+        "offset": offset,
+        "limit": limit,
+        "sort": janela.sort,
+        "order.date_closed.from": _iso(janela.desde),
+    }
+    if janela.ate is not None:
+        params["order.date_closed.to"] = _iso(janela.ate)
+    return params
+
+
+async def _planejar(fetcher: _Fetcher, janela: Janela, ml_user_id: str) -> List[Janela]:
+    """
+    Conta os pedidos da janela (paging.total) e a divide ao meio,
+    recursivamente e em paralelo, até cada parte caber em LIMITE_OFFSET.
+    Janelas vazias são descartadas sem nenhuma busca de página.
+    """
+    if janela.ate is None:
+        janela = replace(janela, ate=datetime.now(janela.desde.tzinfo))
+
+    pagina = await fetcher.get_json(API_SEARCH, _params_busca(ml_user_id, janela, 0, limit=1))
+    if pagina is None:
+        return [janela]
+    total = (pagina.get("paging") or {}).get("total")
+    if total is None:
+        return [janela]
+    if total == 0:
+        return []
+    if total <= LIMITE_OFFSET:
+        return [replace(janela, estimado=total)]
+    if janela.ate - janela.desde <= JANELA_MINIMA:
+        logging.warning(f"⚠️ {total} pedidos em {janela.desde} – {janela.ate}; só {LIMITE_OFFSET} serão lidos")
+        return [replace(janela, estimado=LIMITE_OFFSET)]
+
+    meio = janela.desde + (janela.ate - janela.desde) / 2
+    metades = await asyncio.gather(
+        _planejar(fetcher, replace(janela, ate=meio - timedelta(milliseconds=1)), ml_user_id),
+        _planejar(fetcher, replace(janela, desde=meio), ml_user_id),
+    )
+    return metades[0] + metades[1]
+
+
+# --------------- Varredura das janelas -------------- #
+async def _varrer_janela(
+    fetcher: _Fetcher,
+    janela: Janela,
+    ml_user_id: str,
+    db,
+    writer: Writer,
+    totais: Dict[str, int],
+    acompanhar: bool = False,
+    checkpoint: bool = False,
+    triagem: Optional[Triagem] = None,
+    falhas: Optional[List[Dict[str, Any]]] = None,
+) -> None:
+    from sales import _build_sale, pedido_da_busca_completo
+    from sync_state import registrar_progresso, salvar_checkpoint
+
+    def _params(offset: int) -> dict:
+        return _params_busca(ml_user_id, janela, offset)
+
+    offset  = janela.offset_inicial
+    paginas = 0
+    pagina_task = asyncio.ensure_future(fetcher.get_json(API_SEARCH, _params(offset)))
+
+    while pagina_task is not None:
+        pagina = await pagina_task
+        pagina_task = None
+        if pagina is None:
+            print(f"❌ Falha ao buscar pedidos no intervalo {janela.desde.date()} (offset {offset})")
+            break
+
+        orders = pagina.get("results", [])
+        if not orders:
+            if checkpoint:
+                salvar_checkpoint(db, ml_user_id, janela.desde, offset, None, concluida=True)
+                db.commit()
+            break
+        paginas += 1
+        offset_pagina = offset
+        lidos, ultimo_id = len(orders), orders[-1].get("id")
+
+        # Pré-busca a próxima página enquanto os pedidos desta são detalhados
+        tem_proxima = lidos >= PAGE_SIZE and offset + PAGE_SIZE < LIMITE_OFFSET and (
+            janela.max_paginas is None or paginas < janela.max_paginas
+        )
+        if tem_proxima:
+            offset += PAGE_SIZE
+            pagina_task = asyncio.ensure_future(fetcher.get_json(API_SEARCH, _params(offset)))
+
+        if triagem is not None:
+            # Só o que a busca não confirma segue para os endpoints individuais
+            totais["verificados"] = totais.get("verificados", 0) + lidos
+            orders = triagem(db, orders)
+
+        if janela.somente_busca:
+            # Modo rápido: usa o próprio payload da busca e só baixa
+            # /orders/{id} quando falta algum campo obrigatório
+            completos = [pedido_da_busca_completo(o) for o in orders]
+            fallbacks = completos.count(False)
+            if fallbacks:
+                totais["fallback_pedido"] = totais.get("fallback_pedido", 0) + fallbacks
+            bundles = await asyncio.gather(*(
+                fetcher.enriquecer(o) if ok else fetcher.order_bundle(str(o["id"]))
+                for o, ok in zip(orders, completos)
+            ))
+        else:
+            bundles = await asyncio.gather(*(fetcher.order_bundle(str(o["id"])) for o in orders))
+
+        falhos = [o for o, b in zip(orders, bundles) if b is None]
+        if falhos:
+            # Antes do writer: quem grava a página já sabe o que ficou de fora
+            totais["falhas"] = totais.get("falhas", 0) + len(falhos)
+            if falhas is not None:
+                falhas.extend(falhos)
+        bundles = [b for b in bundles if b is not None]
+        vendas = [_build_sale(b, ml_user_id, db) for b in bundles]
+        totais["pedidos"] = totais.get("pedidos", 0) + len(vendas)
+        if checkpoint:
+            # Checkpoint, payloads e vendas da página saem no mesmo commit
+            salvar_checkpoint(
+                db, ml_user_id, janela.desde, offset_pagina + lidos,
+                ultimo_id, concluida=not tem_proxima,
+            )
+        if vendas:
+            # Payloads brutos vão na mesma transação da página (commit no writer)
+            arquivar(db, ml_user_id, bundles)
+            for chave, valor in writer(db, vendas).items():
+                totais[chave] = totais.get(chave, 0) + valor
+        elif checkpoint:
+            db.commit()
+        if acompanhar:
+            registrar_progresso(ml_user_id, paginas=1, pedidos=len(vendas))
+
+    if acompanhar:
+        registrar_progresso(ml_user_id, janelas=1)
+
+
+async def _ingerir(
+    ml_user_id: str,
+    access_token: str,
+    janelas: List[Janela],
+    writer: Writer,
+    max_in_flight: int,
+    renovar_token: Optional[Callable[[str], Optional[str]]],
+    cache: Optional[RunCache],
+    job: str,
+    planejar: bool,
+    paralelo: bool,
+    acompanhar: bool,
+    checkpoint: bool,
+    triagem: Optional[Triagem],
+    falhas: Optional[List[Dict[str, Any]]],
+) -> Dict[str, int]:
+    from sync_state import iniciar_progresso, registrar_progresso, finalizar_progresso, salvar_plano
+
+    if cache is None:
+        # Ninguém relê este cache depois da execução: limitado
+        cache = RunCache(conta=ml_user_id, job=job, max_itens=RUNCACHE_MAX)
+    fetcher = _Fetcher(access_token, max_in_flight, renovar_token, cache)
+    db = SessionLocal()
+    totais: Dict[str, int] = {}
+    if acompanhar:
+        iniciar_progresso(ml_user_id, job)
+    try:
+        catalogo_sku.atualizar(db, imediato=True)
+        if planejar:
+            planos = await asyncio.gather(*(_planejar(fetcher, j, ml_user_id) for j in janelas))
+            janelas = [j for plano in planos for j in plano]
+            totais["janelas"] = len(janelas)
+        if checkpoint:
+            salvar_plano(db, ml_user_id, janelas)
+            db.commit()
+        if acompanhar:
+            estimados = [j.estimado for j in janelas]
+            registrar_progresso(
+                ml_user_id, janelas_total=len(janelas),
+                pedidos_estimados=(
+                    sum(max(0, j.estimado - j.offset_inicial) for j in janelas)
+                    if None not in estimados else None
+                ),
+            )
+        if paralelo:
+            await asyncio.gather(*(
+                _varrer_janela(fetcher, j, ml_user_id, db, writer, totais, acompanhar, checkpoint, triagem, falhas)
+                for j in janelas
+            ))
+        else:
+            for j in janelas:
+                await _varrer_janela(fetcher, j, ml_user_id, db, writer, totais, acompanhar, checkpoint, triagem, falhas)
+    except Exception as e:
+        db.rollback()
+        if acompanhar:
+            finalizar_progresso(ml_user_id, erro=str(e)[:1000])
+        raise
+    finally:
+        db.close()
+        fetcher.close()
+        ledger.flush()
+
+    if acompanhar:
+        finalizar_progresso(ml_user_id)
+    totais["chamadas_api"] = fetcher.cache.total_chamadas
+    print(fetcher.cache.resumo(totais.get("pedidos", 0)))
+    print(catalogo_sku.resumo())
+    http = estatisticas_http()
+    print(f"🔌 HTTP: {http['requisicoes']} requisições, {http['conexoes_novas']} conexões novas ({http['reuso_pct']}% reuso)")
+    if any(j.somente_busca for j in janelas):
+        print(f"🔎 Fallback para /orders/{{id}}: {totais.get('fallback_pedido', 0)} pedidos")
+    return totais
+
+
+# --------------- Função principal -------------- #
+def ingerir_vendas(
+    ml_user_id: str,
+    access_token: str,
+    janelas: List[Janela],
+    writer: Writer,
+    max_in_flight: int = MAX_IN_FLIGHT,
+    renovar_token: Optional[Callable[[str], Optional[str]]] = None,
+    cache: Optional[RunCache] = None,
+    job: str = "sync",
+    planejar: bool = True,
+    paralelo: bool = True,
+    acompanhar: bool = False,
+    checkpoint: bool = False,
+    triagem: Optional[Triagem] = None,
+    falhas: Optional[List[Dict[str, Any]]] = None,
+) -> Dict[str, int]:
+    """
+    Varre as janelas em paralelo, busca ordem/payments/shipment/SLA
+    com no máximo `max_in_flight` requisições simultâneas e grava cada
+    página de 50 pedidos com `writer`. Retorna os contadores somados,
+    incluindo "pedidos" e "chamadas_api". Todas as chamadas passam pelo
+    limitador global de ml_api e são lançadas no ledger como `job`.
+    Com `planejar`, janelas acima do limite de offset da busca são
+    divididas antes da varredura (nenhum pedido fica de fora). Sem
+    `paralelo`, as janelas são lidas uma após a outra, na ordem dada.
+    Com `acompanhar`, páginas, pedidos e o total estimado ficam em
+    sync_progress (consultado por /sync/status). Com `checkpoint`, o
+    plano de janelas e o offset de cada página gravada ficam em
+    import_checkpoints, no mesmo commit da página. Com `triagem`, cada
+    página da busca passa primeiro por ela e só os pedidos devolvidos são
+    detalhados e gravados ("verificados" conta todos os lidos). Pedidos
+    da busca cujo detalhe falhou entram em `falhas` (quando informada)
+    antes do writer da página ser chamado; "falhas" conta todos.
+    """
+    return asyncio.run(
+        _ingerir(
+            ml_user_id, access_token, janelas, writer, max_in_flight,
+            renovar_token, cache, job, planejar, paralelo, acompanhar, checkpoint, triagem, falhas,
+        )
+    )
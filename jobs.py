@@ -0,0 +1,379 @@
+# jobs.py – fila de jobs de sincronização no Postgres e worker
+from __future__ import annotations
+
+import os
+import json
+import time
+import socket
+import logging
+import threading
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional
+
+from dateutil import parser
+from dateutil.tz import tzutc
+from sqlalchemy import select, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from models import SyncJob
+
+# ---------------- Configurações --------------- #
+JOBS_PARALELOS     = int(os.getenv("SYNC_JOBS_PARALELOS", "4"))
+MAX_TENTATIVAS     = 3
+BACKOFF_BASE       = 30                      # segundos; dobra a cada tentativa
+HEARTBEAT_SEG      = 30
+JOB_ABANDONADO     = timedelta(minutes=5)    # sem heartbeat por esse tempo → volta para a fila
+INTERVALO_OCIOSO   = 2.0
+CICLO_ENVIOS       = timedelta(minutes=int(os.getenv("ML_CICLO_ENVIOS_MIN", "10")))
+CICLO_VERIFICACAO  = timedelta(minutes=int(os.getenv("ML_CICLO_VERIFICACAO_MIN", "60")))
+
+# Maior prioridade sai primeiro
+PRIORIDADES = {
+    "full":        80,   # conta recém-conectada
+    "incremental": 50,
+    "shipments":   40,
+    "fees":        30,
+    "reconcile":   20,
+    "verify":      15,   # verificação contínua por risco, com orçamento por hora
+    "review":      10,
+}
+
+_SQL_RESERVAR = text("""
+    UPDATE sync_jobs j
+    SET status = 'executando', tentativas = j.tentativas + 1, worker = :worker,
+        iniciado_em = now(), heartbeat_em = now(), concluido_em = NULL, erro = NULL
+    FROM (
+        SELECT c.id FROM sync_jobs c
+        WHERE c.status = 'pendente' AND c.disponivel_em <= now()
+          -- no máximo um job por conta de cada vez; o NOT EXISTS só enxerga o
+          -- que já foi commitado, quem garante é o índice uq_sync_jobs_executando
+          AND NOT EXISTS (
+              SELECT 1 FROM sync_jobs r
+              WHERE r.status = 'executando' AND r.ml_user_id = c.ml_user_id
+          )
+        ORDER BY c.prioridade DESC, c.id
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
+    ) sel
+    WHERE j.id = sel.id
+    RETURNING j.id, j.tipo, j.ml_user_id, j.params, j.tentativas, j.max_tentativas
+""")
+
+_SQL_CONCLUIR = text("""
+    UPDATE sync_jobs
+    SET status = 'concluido', concluido_em = now(), resultado = CAST(:resultado AS JSONB),
+        segundos = EXTRACT(EPOCH FROM now() - iniciado_em)
+    WHERE id = :id
+""")
+
+# Volta para a fila com backoff, a menos que as tentativas tenham acabado
+# ou que já exista um job pendente equivalente (mesma chave)
+_SQL_FALHAR = text("""
+    UPDATE sync_jobs j
+    SET status = CASE
+            WHEN j.tentativas >= j.max_tentativas THEN 'falhou'
+            WHEN EXISTS (SELECT 1 FROM sync_jobs p WHERE p.chave = j.chave AND p.status = 'pendente') THEN 'falhou'
+            ELSE 'pendente'
+        END,
+        erro = :erro, concluido_em = now(),
+        segundos = EXTRACT(EPOCH FROM now() - iniciado_em),
+        disponivel_em = now() + make_interval(secs => :espera)
+    WHERE id = :id
+""")
+
+_SQL_HEARTBEAT = text("UPDATE sync_jobs SET heartbeat_em = now() WHERE id = ANY(:ids)")
+
+_SQL_RECUPERAR = text("""
+    UPDATE sync_jobs j
+    SET status = CASE
+            WHEN EXISTS (SELECT 1 FROM sync_jobs p WHERE p.chave = j.chave AND p.status = 'pendente') THEN 'falhou'
+            ELSE 'pendente'
+        END,
+        erro = 'worker parou de responder', disponivel_em = now()
+    WHERE j.status = 'executando' AND j.heartbeat_em < now() - make_interval(secs => :limite)
+""")
+
+
+# ------------------- Fila ---------------------- #
+def _chave(tipo: str, ml_user_id: Optional[str], params: Optional[Dict[str, Any]]) -> str:
+    """Identidade do job para o dedupe de pendentes: tipo, conta e params (em qualquer ordem)."""
+    chave = f"{tipo}:{ml_user_id or '-'}"
+    if params:
+        chave += ":" + json.dumps(params, sort_keys=True, default=str)
+    return chave
+
+
+def enfileirar(
+    tipo: str,
+    ml_user_id: Optional[str] = None,
+    params: Optional[Dict[str, Any]] = None,
+    prioridade: Optional[int] = None,
+    max_tentativas: int = MAX_TENTATIVAS,
+) -> int:
+    """
+    Coloca um job na fila e devolve o id. Se já existe um job pendente
+    equivalente (mesmo tipo, conta e params), devolve o id dele.
+    """
+    from db import engine
+
+    if tipo not in PRIORIDADES:
+        raise ValueError(f"Tipo de job desconhecido: {tipo}")
+    chave = _chave(tipo, ml_user_id, params)
+    agora = datetime.now(tzutc())
+
+    tabela = SyncJob.__table__
+    stmt = pg_insert(tabela).values(
+        tipo=tipo,
+        ml_user_id=int(ml_user_id) if ml_user_id else None,
+        chave=chave,
+        params=params,
+        prioridade=PRIORIDADES[tipo] if prioridade is None else prioridade,
+        status="pendente",
+        tentativas=0,
+        max_tentativas=max_tentativas,
+        criado_em=agora,
+        disponivel_em=agora,
+    ).on_conflict_do_nothing(
+        index_elements=[tabela.c.chave], index_where=text("status = 'pendente'"),
+    ).returning(tabela.c.id)
+
+    with engine.begin() as conn:
+        job_id = conn.execute(stmt).scalar()
+        if job_id is None:
+            job_id = conn.execute(
+                select(tabela.c.id).where(tabela.c.chave == chave, tabela.c.status == "pendente")
+            ).scalar()
+    return job_id
+
+
+def enfileirar_contas(tipo: str, params: Optional[Dict[str, Any]] = None) -> List[int]:
+    """Um job por conta cadastrada; contas com menos pedidos na última execução primeiro."""
+    from db import engine
+
+    with engine.connect() as conn:
+        contas = [row[0] for row in conn.execute(text("""
+            SELECT t.ml_user_id
+            FROM user_tokens t
+            LEFT JOIN sync_state s ON s.ml_user_id = t.ml_user_id
+            ORDER BY COALESCE(s.last_run_orders, 0), t.ml_user_id
+        """))]
+    return [enfileirar(tipo, str(uid), params) for uid in contas]
+
+
+def _como_dict(row) -> Dict[str, Any]:
+    job = dict(row._mapping)
+    if job["iniciado_em"] is not None:
+        job["espera_segundos"] = round((job["iniciado_em"] - job["criado_em"]).total_seconds(), 2)
+    return job
+
+
+def obter_job(job_id: int) -> Optional[Dict[str, Any]]:
+    from db import engine
+
+    tabela = SyncJob.__table__
+    with engine.connect() as conn:
+        row = conn.execute(select(tabela).where(tabela.c.id == job_id)).first()
+    return _como_dict(row) if row else None
+
+
+def listar_jobs(ml_user_id: Optional[str] = None, limite: int = 50) -> List[Dict[str, Any]]:
+    from db import engine
+
+    tabela = SyncJob.__table__
+    consulta = select(tabela).order_by(tabela.c.id.desc()).limit(limite)
+    if ml_user_id:
+        consulta = consulta.where(tabela.c.ml_user_id == int(ml_user_id))
+    with engine.connect() as conn:
+        return [_como_dict(row) for row in conn.execute(consulta)]
+
+
+# ------------------ Handlers ------------------- #
+def _token(ml_user_id: str) -> str:
+    from oauth import tokens
+
+    token = tokens.obter(ml_user_id)
+    if not token:
+        raise LookupError(f"Conta {ml_user_id} sem token válido")
+    return token
+
+
+def _job_full(uid: str, params: Dict[str, Any], max_in_flight: int) -> Dict[str, Any]:
+    from sales import get_full_sales
+    # {"somente_busca": true}: importação em massa só pela busca (ver get_full_sales)
+    return {"vendas": get_full_sales(
+        uid, _token(uid), somente_busca=bool(params.get("somente_busca")), max_in_flight=max_in_flight,
+    )}
+
+
+def _job_incremental(uid: str, params: Dict[str, Any], max_in_flight: int) -> Dict[str, Any]:
+    from sales import get_incremental_sales
+    return {"vendas": get_incremental_sales(uid, _token(uid), max_in_flight=max_in_flight)}
+
+
+def _job_review(uid: str, params: Dict[str, Any], max_in_flight: int) -> Dict[str, Any]:
+    from sales import revisar_banco_de_dados
+    return revisar_banco_de_dados(uid, _token(uid))
+
+
+def _job_reconcile(uid: str, params: Dict[str, Any], max_in_flight: int) -> Dict[str, Any]:
+    from reconcile import reconciliar_por_busca, reconciliar_vendas
+    desde = parser.isoparse(params["desde"]) if params.get("desde") else None
+    ate = parser.isoparse(params["ate"]) if params.get("ate") else None
+    dry_run = bool(params.get("dry_run"))
+    # A simulação usa o diff completo (pedido a pedido), que é o que gera o relatório
+    if params.get("modo") == "busca" and not dry_run:
+        return reconciliar_por_busca(uid, desde=desde, ate=ate, max_in_flight=max_in_flight)
+    return reconciliar_vendas(uid, desde=desde, ate=ate, dry_run=dry_run)
+
+
+def _job_verify(uid: str, params: Dict[str, Any], max_in_flight: int) -> Dict[str, Any]:
+    from reconcile import verificar_por_risco
+    return verificar_por_risco(uid, orcamento=params.get("orcamento"), max_workers=max_in_flight)
+
+
+def _job_fees(uid: str, params: Dict[str, Any], max_in_flight: int) -> Dict[str, Any]:
+    from fees import preencher_fees
+    return preencher_fees(uid, _token(uid))
+
+
+def _job_shipments(uid: str, params: Dict[str, Any], max_in_flight: int) -> Dict[str, Any]:
+    from shipments import atualizar_envios
+    return atualizar_envios(uid)
+
+
+HANDLERS: Dict[str, Callable[[str, Dict[str, Any], int], Dict[str, Any]]] = {
+    "full":        _job_full,
+    "incremental": _job_incremental,
+    "shipments":   _job_shipments,
+    "review":      _job_review,
+    "reconcile":   _job_reconcile,
+    "verify":      _job_verify,
+    "fees":        _job_fees,
+}
+
+
+# ------------------- Worker -------------------- #
+class _Ativos:
+    """Ids dos jobs em execução neste processo (para o heartbeat)."""
+
+    def __init__(self):
+        self._ids: set = set()
+        self._lock = threading.Lock()
+
+    def add(self, job_id: int) -> None:
+        with self._lock:
+            self._ids.add(job_id)
+
+    def discard(self, job_id: int) -> None:
+        with self._lock:
+            self._ids.discard(job_id)
+
+    def lista(self) -> List[int]:
+        with self._lock:
+            return list(self._ids)
+
+
+def _heartbeat(ativos: _Ativos, parar: threading.Event) -> None:
+    """Heartbeat dos jobs em execução, recuperação de abandonados e ciclos de envios e verificação."""
+    from db import engine
+
+    proximo_envios = proximo_verificacao = time.monotonic()
+    while not parar.wait(HEARTBEAT_SEG):
+        try:
+            with engine.begin() as conn:
+                ids = ativos.lista()
+                if ids:
+                    conn.execute(_SQL_HEARTBEAT, {"ids": ids})
+                conn.execute(_SQL_RECUPERAR, {"limite": JOB_ABANDONADO.total_seconds()})
+            if time.monotonic() >= proximo_envios:
+                # Jobs pendentes iguais são deduplicados pela chave
+                enfileirar_contas("shipments")
+                proximo_envios = time.monotonic() + CICLO_ENVIOS.total_seconds()
+            if time.monotonic() >= proximo_verificacao:
+                # Cada job gasta só o que sobra da cota da hora da sua conta
+                enfileirar_contas("verify")
+                proximo_verificacao = time.monotonic() + CICLO_VERIFICACAO.total_seconds()
+        except Exception as e:
+            logging.warning(f"⚠️ Heartbeat dos jobs falhou: {e}")
+
+
+def executar_um(worker: str, ativos: _Ativos, max_in_flight: int) -> bool:
+    """Reserva e executa um job. Devolve False se a fila estava vazia."""
+    from db import engine
+
+    try:
+        with engine.begin() as conn:
+            job = conn.execute(_SQL_RESERVAR, {"worker": worker}).first()
+    except IntegrityError:
+        # Outro worker reservou um job da mesma conta ao mesmo tempo: o dele
+        # vale, este volta a tentar já enxergando a reserva commitada
+        logging.info(f"🔁 {worker}: conta já em execução por outro worker, reservando outro job")
+        return True
+    if job is None:
+        return False
+
+    ativos.add(job.id)
+    inicio = time.monotonic()
+    print(f"▶️ Job {job.id} ({job.tipo}, conta {job.ml_user_id}) – tentativa {job.tentativas}/{job.max_tentativas}")
+    try:
+        resultado = HANDLERS[job.tipo](str(job.ml_user_id), job.params or {}, max_in_flight)
+        with engine.begin() as conn:
+            conn.execute(_SQL_CONCLUIR, {"id": job.id, "resultado": json.dumps(resultado, default=str)})
+        print(f"✅ Job {job.id} ({job.tipo}) concluído em {time.monotonic() - inicio:.1f}s: {resultado}")
+    except Exception as e:
+        logging.exception(f"❌ Job {job.id} ({job.tipo}) falhou: {e}")
+        with engine.begin() as conn:
+            conn.execute(_SQL_FALHAR, {
+                "id": job.id, "erro": str(e)[:1000],
+                "espera": BACKOFF_BASE * 2 ** (job.tentativas - 1),
+            })
+    finally:
+        ativos.discard(job.id)
+    return True
+
+
+def _laco(worker: str, ativos: _Ativos, parar: threading.Event, max_in_flight: int) -> None:
+    while not parar.is_set():
+        try:
+            ocupado = executar_um(worker, ativos, max_in_flight)
+        except Exception as e:
+            logging.exception(f"❌ Erro no worker {worker}: {e}")
+            ocupado = False
+        if not ocupado:
+            parar.wait(INTERVALO_OCIOSO)
+
+
+def executar_worker(threads: int = JOBS_PARALELOS, notificacoes: bool = True) -> None:
+    """
+    Processo worker: `threads` jobs em paralelo, cada um com sua fatia de
+    ML_MAX_IN_FLIGHT, mais o consumo da fila de notificações.
+    """
+    from ingestion import MAX_IN_FLIGHT
+
+    nome = f"{socket.gethostname()}:{os.getpid()}"
+    por_job = max(2, MAX_IN_FLIGHT // max(1, threads))
+    ativos = _Ativos()
+    parar = threading.Event()
+
+    tarefas = [threading.Thread(target=_heartbeat, args=(ativos, parar), daemon=True)]
+    tarefas += [
+        threading.Thread(target=_laco, args=(f"{nome}/{i}", ativos, parar, por_job), daemon=True)
+        for i in range(threads)
+    ]
+    if notificacoes:
+        from notifications import executar_worker as worker_notificacoes
+        tarefas.append(threading.Thread(target=worker_notificacoes, daemon=True))
+
+    print(f"🛠️ Worker {nome} iniciado: {threads} jobs em paralelo, {por_job} requisições por job")
+    for t in tarefas:
+        t.start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        parar.set()
+
+
+if __name__ == "__main__":
+    executar_worker()
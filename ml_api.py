@@ -0,0 +1,518 @@
+# ml_api.py – acesso às APIs do Mercado Livre
+from __future__ import annotations
+
+import os
+import re
+import time
+import socket
+import atexit
+import random
+import logging
+import threading
+from collections import Counter, OrderedDict, deque
+from datetime import datetime
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# ---------------- Configurações --------------- #
+API_ROOT    = os.getenv("ML_API_ROOT", "https://api.mercadolibre.com").rstrip("/")  # ex.: fake_ml.py
+API_TIMEOUT = 10
+
+RATE_GLOBAL        = float(os.getenv("ML_RATE_GLOBAL", "20"))  # req/s do processo
+RATE_CONTA         = float(os.getenv("ML_RATE_CONTA", "8"))    # req/s por conta
+MAX_CONCORRENCIA   = int(os.getenv("ML_MAX_CONCORRENCIA", "32"))
+BACKOFF_PADRAO     = 2    # s de pausa num 429 sem Retry-After
+TENTATIVAS_429     = 2    # novas tentativas após um 429
+TENTATIVAS_GET     = 3    # novas tentativas de GET após 5xx/erro de rede
+BACKOFF_BASE       = 0.5  # s; espera = uniforme(0, base * 2^tentativa)
+LEDGER_FLUSH_SEG   = 30
+RUNCACHE_MAX       = int(os.getenv("ML_RUNCACHE_MAX", "2000"))  # respostas em caches limitados (LRU)
+
+# (connect, read) por endpoint; o resto usa TIMEOUT_PADRAO
+TIMEOUT_PADRAO = (3.05, API_TIMEOUT)
+TIMEOUTS = {
+    "/orders/search":       (3.05, 20),
+    "/orders/{id}":         (3.05, 10),
+    "/orders/{id}/payments": (3.05, 10),
+    "/shipments/{id}":      (3.05, 10),
+    "/shipments/{id}/sla":  (3.05, 5),
+    "/oauth/token":         (3.05, 15),
+}
+_STATUS_REPETIVEIS = {500, 502, 503, 504}
+
+_RE_ID = re.compile(r"/\d+")
+
+
+def endpoint_de(url: str) -> str:
+    """Normaliza a URL para o endpoint, ex.: /shipments/{id}/sla."""
+    caminho = url.split("?", 1)[0].replace(API_ROOT, "")
+    return _RE_ID.sub("/{id}", caminho)
+
+
+# ------------ Limitador de taxa ------------- #
+class TokenBucket:
+    """Balde de tokens com reserva: quem pega o token sabe quanto esperar."""
+
+    def __init__(self, taxa: float, capacidade: Optional[float] = None):
+        self.taxa = taxa
+        self.capacidade = capacidade or max(1.0, taxa)
+        self._tokens = self.capacidade
+        self._ts = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reservar(self) -> float:
+        """Consome um token e devolve os segundos de espera até ele existir."""
+        with self._lock:
+            agora = time.monotonic()
+            self._tokens = min(self.capacidade, self._tokens + (agora - self._ts) * self.taxa)
+            self._ts = agora
+            self._tokens -= 1
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.taxa
+
+
+class LimiteAdaptativo:
+    """
+    Limite de requisições simultâneas do processo (AIMD): cai pela metade
+    a cada 429/5xx, sobe devagar a cada sucesso e respeita o Retry-After
+    pausando todo mundo até o prazo.
+    """
+
+    def __init__(self, maximo: int):
+        self.maximo = maximo
+        self.limite = float(maximo)
+        self._em_uso = 0
+        self._pausa_ate = 0.0
+        self._cond = threading.Condition()
+
+    def entrar(self) -> None:
+        with self._cond:
+            while True:
+                espera = self._pausa_ate - time.monotonic()
+                if espera > 0:
+                    self._cond.wait(espera)
+                elif self._em_uso >= int(self.limite):
+                    self._cond.wait()
+                else:
+                    break
+            self._em_uso += 1
+
+    def sair(self, status: Optional[int], retry_after: Optional[float]) -> None:
+        with self._cond:
+            self._em_uso -= 1
+            if status is None or status == 429 or status >= 500:
+                self.limite = max(1.0, self.limite / 2)
+                if status == 429:
+                    pausa = retry_after if retry_after is not None else BACKOFF_PADRAO
+                    self._pausa_ate = max(self._pausa_ate, time.monotonic() + pausa)
+            else:
+                self.limite = min(float(self.maximo), self.limite + 1.0 / self.limite)
+            self._cond.notify_all()
+
+
+class _Limitador:
+    """Balde global + um balde por conta + limite adaptativo de concorrência."""
+
+    def __init__(self):
+        self.global_ = TokenBucket(RATE_GLOBAL)
+        self.concorrencia = LimiteAdaptativo(MAX_CONCORRENCIA)
+        self._contas: Dict[str, TokenBucket] = {}
+        self._lock = threading.Lock()
+
+    def _balde(self, conta: str) -> TokenBucket:
+        with self._lock:
+            if conta not in self._contas:
+                self._contas[conta] = TokenBucket(RATE_CONTA)
+            return self._contas[conta]
+
+    def aguardar(self, conta: Optional[str]) -> None:
+        espera = self.global_.reservar()
+        if conta:
+            espera = max(espera, self._balde(conta).reservar())
+        if espera > 0:
+            time.sleep(espera)
+        self.concorrencia.entrar()
+
+
+# ------------ Orçamento por execução ------------- #
+class OrcamentoEsgotado(requests.RequestException):
+    """A cota da execução acabou antes da requisição sair."""
+
+
+class Orcamento:
+    """
+    Chamadas que uma execução ainda pode fazer. `requisitar` consome uma
+    antes de cada tentativa (inclusive repetições após 429/5xx e o GET
+    repetido depois de renovar o token), então a cota não é ultrapassada
+    nem com várias requisições em voo.
+    """
+
+    def __init__(self, chamadas: int):
+        self.restante = max(0, chamadas)
+        self._lock = threading.Lock()
+
+    def consumir(self) -> bool:
+        with self._lock:
+            if self.restante <= 0:
+                return False
+            self.restante -= 1
+            return True
+
+    @property
+    def esgotado(self) -> bool:
+        return self.restante <= 0
+
+
+# ------------ Ledger de consumo ------------- #
+class Ledger:
+    """
+    Conta as chamadas por (hora, endpoint, job, conta) em memória e
+    descarrega na tabela ml_api_ledger a cada LEDGER_FLUSH_SEG segundos.
+    """
+
+    def __init__(self):
+        self._contagem: Counter = Counter()
+        self._lock = threading.Lock()
+        self._ultimo_flush = time.monotonic()
+
+    def registrar(self, endpoint: str, conta: Optional[str], job: str, status: Optional[int]) -> None:
+        hora = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+        chave = (hora, endpoint, job, int(conta or 0))
+        with self._lock:
+            self._contagem[chave + ("chamadas",)] += 1
+            if status == 429:
+                self._contagem[chave + ("limitadas",)] += 1
+            elif status is None or status >= 500:
+                self._contagem[chave + ("erros",)] += 1
+            vencido = time.monotonic() - self._ultimo_flush >= LEDGER_FLUSH_SEG
+        if vencido:
+            self.flush()
+
+    def flush(self) -> None:
+        with self._lock:
+            contagem, self._contagem = self._contagem, Counter()
+            self._ultimo_flush = time.monotonic()
+        if not contagem:
+            return
+
+        linhas: Dict[Tuple, Dict[str, Any]] = {}
+        for (hora, endpoint, job, conta, campo), n in contagem.items():
+            linha = linhas.setdefault((hora, endpoint, job, conta), {
+                "hora": hora, "endpoint": endpoint, "job": job, "ml_user_id": conta,
+                "chamadas": 0, "limitadas": 0, "erros": 0,
+            })
+            linha[campo] += n
+
+        from sqlalchemy.dialects.postgresql import insert as pg_insert
+        from db import engine
+        from models import MlApiLedger
+
+        tabela = MlApiLedger.__table__
+        stmt = pg_insert(tabela).values(list(linhas.values()))
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[tabela.c.hora, tabela.c.endpoint, tabela.c.job, tabela.c.ml_user_id],
+            set_={c: tabela.c[c] + stmt.excluded[c] for c in ("chamadas", "limitadas", "erros")},
+        )
+        # Conexão própria: SessionLocal é scoped e pode ser a sessão de quem chamou
+        try:
+            with engine.begin() as conn:
+                conn.execute(stmt)
+                _gravar_estatisticas_http(conn)
+        except Exception as e:
+            logging.warning(f"⚠️ Falha ao gravar ledger da API: {e}")
+
+
+limitador = _Limitador()
+ledger = Ledger()
+atexit.register(ledger.flush)
+
+
+def consumo_por_hora(db, horas: int = 24) -> List[Any]:
+    """Chamadas por hora e job nas últimas `horas` (para ver o gasto da cota)."""
+    from sqlalchemy import text
+    return db.execute(text("""
+        SELECT hora, job, sum(chamadas) AS chamadas, sum(limitadas) AS limitadas, sum(erros) AS erros
+        FROM ml_api_ledger
+        WHERE hora >= (now() at time zone 'utc') - make_interval(hours => :horas)
+        GROUP BY hora, job
+        ORDER BY hora DESC, chamadas DESC
+    """), {"horas": horas}).fetchall()
+
+
+# ------------ Transporte HTTP ------------- #
+class _Latencias:
+    """Últimas latências por endpoint, para média e p95."""
+
+    def __init__(self, janela: int = 500):
+        self._amostras: Dict[str, Deque[float]] = {}
+        self._lock = threading.Lock()
+        self._janela = janela
+
+    def registrar(self, endpoint: str, segundos: float) -> None:
+        with self._lock:
+            self._amostras.setdefault(endpoint, deque(maxlen=self._janela)).append(segundos)
+
+    def resumo(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            copia = {ep: sorted(a) for ep, a in self._amostras.items()}
+        return {
+            ep: {
+                "n":        len(a),
+                "media_ms": round(1000 * sum(a) / len(a), 1),
+                "p95_ms":   round(1000 * a[min(len(a) - 1, int(len(a) * 0.95))], 1),
+            }
+            for ep, a in copia.items() if a
+        }
+
+
+def _nova_sessao() -> requests.Session:
+    """Sessão única com pool de conexões keep-alive do tamanho da concorrência."""
+    sessao = requests.Session()
+    adaptador = HTTPAdapter(pool_connections=4, pool_maxsize=MAX_CONCORRENCIA, pool_block=False)
+    sessao.mount("https://", adaptador)
+    sessao.mount("http://", adaptador)
+    return sessao
+
+
+sessao = _nova_sessao()
+latencias = _Latencias()
+
+
+def estatisticas_http() -> Dict[str, Any]:
+    """Reuso de conexões (dados do pool urllib3) e latência por endpoint."""
+    requisicoes = conexoes = 0
+    for adaptador in set(sessao.adapters.values()):
+        for chave in list(adaptador.poolmanager.pools.keys()):
+            pool = adaptador.poolmanager.pools.get(chave)
+            if pool is not None:
+                requisicoes += pool.num_requests
+                conexoes += pool.num_connections
+    return {
+        "requisicoes":    requisicoes,
+        "conexoes_novas": conexoes,
+        "reuso_pct":      round(100 * (1 - conexoes / requisicoes), 1) if requisicoes else 0.0,
+        "latencia":       latencias.resumo(),
+    }
+
+
+def _gravar_estatisticas_http(conn) -> None:
+    """Retrato deste processo em ml_http_stats (o worker faz as chamadas, a API lê)."""
+    from sqlalchemy.dialects.postgresql import insert as pg_insert
+    from models import MlHttpStats
+
+    http = estatisticas_http()
+    linha = {
+        "processo":       f"{socket.gethostname()}:{os.getpid()}",  # pid lido agora: workers forkados
+        "atualizado_em":  datetime.now().astimezone(),
+        "requisicoes":    http["requisicoes"],
+        "conexoes_novas": http["conexoes_novas"],
+        "latencia":       http["latencia"],
+    }
+    tabela = MlHttpStats.__table__
+    stmt = pg_insert(tabela).values(**linha)
+    conn.execute(stmt.on_conflict_do_update(
+        index_elements=[tabela.c.processo],
+        set_={k: stmt.excluded[k] for k in linha if k != "processo"},
+    ))
+
+
+def estatisticas_http_processos(db, minutos: int = 60) -> Dict[str, Any]:
+    """
+    Reuso de conexões e latência de todos os processos que gravaram nos
+    últimos `minutos` (worker e API), com o total: média de latência
+    ponderada pelo número de amostras e p95 = o maior entre os processos.
+    """
+    from sqlalchemy import text
+    linhas = db.execute(text("""
+        SELECT processo, atualizado_em, requisicoes, conexoes_novas, latencia
+        FROM ml_http_stats
+        WHERE atualizado_em >= now() - make_interval(mins => :minutos)
+        ORDER BY requisicoes DESC
+    """), {"minutos": minutos}).mappings().all()
+
+    requisicoes = sum(l["requisicoes"] for l in linhas)
+    conexoes = sum(l["conexoes_novas"] for l in linhas)
+    latencia: Dict[str, Dict[str, float]] = {}
+    for l in linhas:
+        for ep, s in (l["latencia"] or {}).items():
+            total = latencia.setdefault(ep, {"n": 0, "media_ms": 0.0, "p95_ms": 0.0})
+            n = total["n"] + s["n"]
+            total["media_ms"] = round((total["media_ms"] * total["n"] + s["media_ms"] * s["n"]) / n, 1) if n else 0.0
+            total["p95_ms"] = max(total["p95_ms"], s["p95_ms"])
+            total["n"] = n
+    return {
+        "requisicoes":    requisicoes,
+        "conexoes_novas": conexoes,
+        "reuso_pct":      round(100 * (1 - conexoes / requisicoes), 1) if requisicoes else 0.0,
+        "latencia":       latencia,
+        "processos":      [dict(l) for l in linhas],
+    }
+
+
+def _retry_after(resp: requests.Response) -> Optional[float]:
+    valor = resp.headers.get("Retry-After")
+    try:
+        return float(valor) if valor is not None else None
+    except ValueError:
+        return None
+
+
+def requisitar(
+    metodo: str,
+    url: str,
+    conta: Optional[str] = None,
+    job: str = "outros",
+    access_token: Optional[str] = None,
+    orcamento: Optional[Orcamento] = None,
+    **kwargs,
+) -> requests.Response:
+    """
+    Toda chamada HTTP ao Mercado Livre passa por aqui: usa a sessão com
+    pool de conexões, timeout por endpoint e token no header
+    Authorization; respeita os baldes global e da conta e o limite
+    adaptativo de concorrência; repete após 429 (esperando o
+    Retry-After) e, só para GET, após 5xx/erro de rede com backoff
+    exponencial com jitter. Cada tentativa é registrada no ledger e,
+    com `orcamento`, consome uma chamada antes de sair (OrcamentoEsgotado
+    quando não há mais).
+    """
+    endpoint = endpoint_de(url)
+    kwargs.setdefault("timeout", TIMEOUTS.get(endpoint, TIMEOUT_PADRAO))
+    if access_token:
+        kwargs["headers"] = {**(kwargs.get("headers") or {}), "Authorization": f"Bearer {access_token}"}
+
+    idempotente = metodo.upper() == "GET"
+    tentativas_429 = tentativas_get = 0
+
+    while True:
+        if orcamento is not None and not orcamento.consumir():
+            raise OrcamentoEsgotado(f"Cota de chamadas esgotada antes de {endpoint}")
+        limitador.aguardar(conta)
+        status = retry_after = None
+        inicio = time.monotonic()
+        try:
+            resp = sessao.request(metodo, url, **kwargs)
+            status = resp.status_code
+            retry_after = _retry_after(resp)
+        except requests.RequestException:
+            if not idempotente or tentativas_get >= TENTATIVAS_GET:
+                raise
+            resp = None
+        finally:
+            latencias.registrar(endpoint, time.monotonic() - inicio)
+            limitador.concorrencia.sair(status, retry_after)
+            ledger.registrar(endpoint, conta, job, status)
+
+        if status == 429 and tentativas_429 < TENTATIVAS_429:
+            tentativas_429 += 1
+            logging.warning(f"⏳ 429 em {endpoint}, aguardando {retry_after or BACKOFF_PADRAO}s")
+            continue
+        if idempotente and (resp is None or status in _STATUS_REPETIVEIS) and tentativas_get < TENTATIVAS_GET:
+            time.sleep(random.uniform(0, BACKOFF_BASE * 2 ** tentativas_get))
+            tentativas_get += 1
+            continue
+        return resp
+
+
+# ------------ Cache por execução ------------- #
+class RunCache:
+    """
+    Cache de respostas de uma execução (sync, revisão, reconciliação).
+    Evita repetir GETs idênticos e conta as chamadas por endpoint.
+    `conta` e `job` identificam a execução no limitador e no ledger;
+    `orcamento`, quando existe, é cobrado em toda requisição feita com o cache.
+    Sem `max_itens` guarda tudo: o incremental entrega o cache ao
+    preencher_fees, que lê dele os /orders/{id} da execução. Varreduras
+    longas que ninguém relê depois (importação completa, reconciliação)
+    passam `max_itens` (LRU): repetições são quase sempre próximas
+    (carrinho com o mesmo shipment) e a memória não cresce com o período.
+    """
+
+    def __init__(
+        self,
+        conta: Optional[str] = None,
+        job: str = "outros",
+        max_itens: Optional[int] = None,
+        orcamento: Optional[Orcamento] = None,
+    ):
+        self.conta = conta
+        self.job = job
+        self.orcamento = orcamento
+        self.max_itens = max_itens
+        self._dados: "OrderedDict[str, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.chamadas: Counter = Counter()
+        self.hits = 0
+
+    def get(self, chave: str) -> Any:
+        with self._lock:
+            if chave in self._dados:
+                self.hits += 1
+                self._dados.move_to_end(chave)
+                return self._dados[chave]
+        return None
+
+    def put(self, chave: str, valor: Any) -> None:
+        with self._lock:
+            self._dados[chave] = valor
+            self._dados.move_to_end(chave)
+            while self.max_itens is not None and len(self._dados) > self.max_itens:
+                self._dados.popitem(last=False)
+
+    def contar(self, url: str) -> None:
+        with self._lock:
+            self.chamadas[endpoint_de(url)] += 1
+
+    @property
+    def total_chamadas(self) -> int:
+        return sum(self.chamadas.values())
+
+    def resumo(self, pedidos: int) -> str:
+        por_pedido = self.total_chamadas / pedidos if pedidos else 0.0
+        detalhes = ", ".join(f"{ep}={n}" for ep, n in self.chamadas.most_common())
+        return (
+            f"📊 {self.total_chamadas} chamadas à API para {pedidos} pedidos "
+            f"({por_pedido:.2f}/pedido, {self.hits} do cache) [{detalhes}]"
+        )
+
+
+def get_json(
+    url: str,
+    access_token: str,
+    params: Optional[dict] = None,
+    cache: Optional[RunCache] = None,
+) -> Any:
+    """
+    GET autenticado; devolve o JSON ou None em caso de falha.
+    Sem `params`, a resposta é reaproveitada via `cache`.
+    """
+    usa_cache = cache is not None and params is None
+    if usa_cache:
+        hit = cache.get(url)
+        if hit is not None:
+            return hit
+
+    try:
+        if cache is not None:
+            cache.contar(url)
+        resp = requisitar(
+            "GET",
+            url,
+            conta=cache.conta if cache is not None else None,
+            job=cache.job if cache is not None else "outros",
+            access_token=access_token,
+            orcamento=cache.orcamento if cache is not None else None,
+            params=params,
+        )
+        if not resp.ok:
+            logging.warning(f"⚠️ Falha {resp.status_code} em {endpoint_de(url)} ({url})")
+            return None
+        dados = resp.json()
+    except requests.RequestException as e:
+        logging.warning(f"⚠️ Req error ({url}): {e}")
+        return None
+
+    if usa_cache:
+        cache.put(url, dados)
+    return dados
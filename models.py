@@ -1,4 +1,5 @@
-from sqlalchemy import Column, Integer, String, DateTime, Float, BigInteger, Numeric
+from sqlalchemy import Column, Integer, String, DateTime, Float, BigInteger, Numeric, LargeBinary, Boolean, Index, text
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
@@ -54,4 +55,194 @@ class Sale(Base):
     base_cost     = Column(Numeric(10, 2), nullable=True)
     shipment_cost = Column(Numeric(10, 2), nullable=True)
 
+    # 🔽 Impressão digital dos campos derivados da API (ver sales.hash_venda)
+    content_hash  = Column(String(32), nullable=True)
 
+    # 🔽 Última busca de /shipments pelo refresher (shipments.py); NULL = nunca
+    shipments_refreshed_at = Column(DateTime(timezone=True), nullable=True)
+
+    # 🔽 Última conferência com a API (reconcile); NULL = nunca verificada
+    last_verified_at = Column(DateTime(timezone=True), nullable=True)
+
+
+
+
+class SyncState(Base):
+    """Marca d'água do sync incremental de cada conta."""
+    __tablename__ = "sync_state"
+
+    ml_user_id       = Column(BigInteger, primary_key=True)
+    high_water_mark  = Column(DateTime(timezone=True), nullable=True)   # maior date_closed já gravado
+    cursor_order_id  = Column(BigInteger, nullable=True)                # último pedido gravado
+    last_run_at      = Column(DateTime(timezone=True), nullable=True)
+    last_run_orders  = Column(Integer, nullable=True)
+
+
+class SyncProgresso(Base):
+    """Progresso da última importação acompanhada de cada conta (/sync/status)."""
+    __tablename__ = "sync_progress"
+
+    ml_user_id        = Column(BigInteger, primary_key=True)
+    job               = Column(String, nullable=False)
+    status            = Column(String, nullable=False)      # executando, concluido, falhou
+    iniciado_em       = Column(DateTime(timezone=True), nullable=False)
+    atualizado_em     = Column(DateTime(timezone=True), nullable=False)
+    concluido_em      = Column(DateTime(timezone=True), nullable=True)
+    janelas_total     = Column(Integer, nullable=True)
+    janelas_feitas    = Column(Integer, nullable=False, default=0)
+    paginas           = Column(Integer, nullable=False, default=0)
+    pedidos           = Column(Integer, nullable=False, default=0)
+    pedidos_estimados = Column(Integer, nullable=True)      # soma de paging.total das janelas
+    erro              = Column(String, nullable=True)
+
+
+class ImportCheckpoint(Base):
+    """
+    Plano da importação completa de uma conta: uma linha por janela,
+    com o offset da próxima página e o último pedido gravado.
+    """
+    __tablename__ = "import_checkpoints"
+
+    ml_user_id      = Column(BigInteger, primary_key=True)
+    desde           = Column(DateTime(timezone=True), primary_key=True)
+    ate             = Column(DateTime(timezone=True), nullable=False)
+    sort            = Column(String, nullable=False)
+    estimado        = Column(Integer, nullable=True)
+    proximo_offset  = Column(Integer, nullable=False, default=0)
+    last_order_id   = Column(BigInteger, nullable=True)
+    concluida       = Column(Boolean, nullable=False, default=False)
+    atualizado_em   = Column(DateTime(timezone=True), nullable=False)
+
+
+class MlApiLedger(Base):
+    """Chamadas às APIs do Mercado Livre por hora, endpoint, job e conta."""
+    __tablename__ = "ml_api_ledger"
+
+    hora        = Column(DateTime, primary_key=True)          # UTC, truncada na hora
+    endpoint    = Column(String, primary_key=True)            # ex.: /shipments/{id}/sla
+    job         = Column(String, primary_key=True)            # full, incremental, reconcile...
+    ml_user_id  = Column(BigInteger, primary_key=True)        # 0 = chamada sem conta
+    chamadas    = Column(Integer, nullable=False, default=0)
+    limitadas   = Column(Integer, nullable=False, default=0)  # respostas 429
+    erros       = Column(Integer, nullable=False, default=0)  # 5xx e falhas de rede
+
+
+class MlHttpStats(Base):
+    """
+    Último retrato do transporte HTTP (pool e latência) de cada processo
+    que chama o ML, gravado junto com o ledger; /stats/ml-http lê daqui.
+    """
+    __tablename__ = "ml_http_stats"
+
+    processo       = Column(String, primary_key=True)             # host:pid
+    atualizado_em  = Column(DateTime(timezone=True), nullable=False)
+    requisicoes    = Column(BigInteger, nullable=False, default=0)
+    conexoes_novas = Column(BigInteger, nullable=False, default=0)
+    latencia       = Column(JSONB, nullable=True)                 # {endpoint: {n, media_ms, p95_ms}}
+
+
+class SalePayload(Base):
+    """JSON bruto (order, shipment, SLA) de cada venda, comprimido com zlib."""
+    __tablename__ = "sale_payloads"
+
+    order_id    = Column(BigInteger, primary_key=True)
+    ml_user_id  = Column(BigInteger, index=True, nullable=False)
+    payload     = Column(LargeBinary, nullable=False)
+    updated_at  = Column(DateTime(timezone=True), nullable=False)
+
+
+class FeeTentativa(Base):
+    """Pedidos cuja ml_fee não veio da API: evita rebuscar a cada sync."""
+    __tablename__ = "fee_tentativas"
+
+    order_id          = Column(BigInteger, primary_key=True)
+    ml_user_id        = Column(BigInteger, index=True, nullable=False)
+    tentativas        = Column(Integer, nullable=False, default=0)
+    ultima_tentativa  = Column(DateTime(timezone=True), nullable=False)
+
+
+class MlNotificacao(Base):
+    """
+    Fila de notificações do ML (orders_v2, shipments). Uma linha por
+    recurso: eventos repetidos enquanto pendente são agrupados.
+    """
+    __tablename__ = "ml_notificacoes"
+
+    topic           = Column(String, primary_key=True)
+    resource_id     = Column(BigInteger, primary_key=True)
+    ml_user_id      = Column(BigInteger, index=True, nullable=False)
+    sent_at         = Column(DateTime(timezone=True), nullable=False)   # envio pelo ML (1º evento pendente)
+    received_at     = Column(DateTime(timezone=True), nullable=False)   # último evento recebido
+    eventos         = Column(Integer, nullable=False, default=1)
+    claimed_until   = Column(DateTime(timezone=True), nullable=True)
+    processed_at    = Column(DateTime(timezone=True), nullable=True, index=True)
+    lag_ms          = Column(Integer, nullable=True)                    # processed_at - sent_at
+    tentativas      = Column(Integer, nullable=False, default=0)
+    erro            = Column(String, nullable=True)
+
+
+class ReconcileRun(Base):
+    """Uma execução de reconciliação ou verificação (simulada ou não)."""
+    __tablename__ = "reconcile_runs"
+
+    run_id        = Column(String(32), primary_key=True)
+    ml_user_id    = Column(BigInteger, index=True, nullable=False)
+    tipo          = Column(String, nullable=False)                   # reconcile, verify
+    dry_run       = Column(Boolean, nullable=False, default=False)
+    iniciado_em   = Column(DateTime(timezone=True), nullable=False)
+    concluido_em  = Column(DateTime(timezone=True), nullable=True)
+    verificados   = Column(Integer, nullable=False, default=0)       # pedidos comparados
+    divergentes   = Column(Integer, nullable=False, default=0)       # pedidos com alguma coluna diferente
+    erro          = Column(String, nullable=True)
+
+
+class ReconcileDiff(Base):
+    """Uma coluna divergente de um pedido numa execução (valores já normalizados)."""
+    __tablename__ = "reconcile_diffs"
+
+    id          = Column(BigInteger, primary_key=True)
+    run_id      = Column(String(32), nullable=False)
+    ml_user_id  = Column(BigInteger, nullable=False)
+    order_id    = Column(BigInteger, nullable=False)
+    coluna      = Column(String, nullable=False)
+    antigo      = Column(String, nullable=True)   # banco
+    novo        = Column(String, nullable=True)   # API
+
+    __table_args__ = (
+        Index("ix_reconcile_diffs_run", "run_id", "coluna"),
+        Index("ix_reconcile_diffs_conta", "ml_user_id", "coluna"),
+    )
+
+
+class SyncJob(Base):
+    """
+    Fila de jobs de sincronização (full, incremental, review, reconcile,
+    fees) consumida pelo worker em jobs.py. Maior prioridade sai primeiro.
+    """
+    __tablename__ = "sync_jobs"
+
+    id            = Column(BigInteger, primary_key=True)
+    tipo          = Column(String, nullable=False)
+    ml_user_id    = Column(BigInteger, index=True, nullable=True)
+    chave         = Column(String, nullable=False)                     # dedupe de jobs pendentes
+    params        = Column(JSONB, nullable=True)
+    prioridade    = Column(Integer, nullable=False, default=0)
+    status        = Column(String, nullable=False, default="pendente")  # pendente, executando, concluido, falhou
+    tentativas    = Column(Integer, nullable=False, default=0)
+    max_tentativas = Column(Integer, nullable=False, default=3)
+    criado_em     = Column(DateTime(timezone=True), nullable=False)
+    disponivel_em = Column(DateTime(timezone=True), nullable=False)    # backoff entre tentativas
+    iniciado_em   = Column(DateTime(timezone=True), nullable=True)
+    heartbeat_em  = Column(DateTime(timezone=True), nullable=True)
+    concluido_em  = Column(DateTime(timezone=True), nullable=True)
+    segundos      = Column(Float, nullable=True)                       # duração da última tentativa
+    worker        = Column(String, nullable=True)
+    resultado     = Column(JSONB, nullable=True)
+    erro          = Column(String, nullable=True)
+
+    __table_args__ = (
+        Index("ix_sync_jobs_fila", "status", "prioridade", "disponivel_em"),
+        Index("uq_sync_jobs_pendente", "chave", unique=True, postgresql_where=text("status = 'pendente'")),
+        # no máximo um job em execução por conta (jobs sem conta ficam de fora: NULL não colide)
+        Index("uq_sync_jobs_executando", "ml_user_id", unique=True, postgresql_where=text("status = 'executando'")),
+    )
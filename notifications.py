@@ -0,0 +1,271 @@
+# notifications.py – notificações do Mercado Livre (orders_v2, shipments)
+from __future__ import annotations
+
+import os
+import re
+import time
+import logging
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+from dateutil import parser
+from dateutil.tz import tzutc
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from models import MlNotificacao
+
+# ---------------- Configurações --------------- #
+TOPICOS         = {"orders_v2", "shipments"}
+LOTE            = int(os.getenv("ML_NOTIF_LOTE", "50"))
+MAX_WORKERS     = 8
+MAX_TENTATIVAS  = 5
+RESERVA         = timedelta(minutes=5)    # tempo de posse de um evento pelo worker
+INTERVALO_OCIOSO = 2.0                    # segundos entre consultas com a fila vazia
+
+_RECURSO = re.compile(r"^/(orders|shipments)/(\d+)")
+
+
+# ------------------- Entrada ------------------- #
+def validar(evento: Dict[str, Any], application_id: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """
+    Normaliza o corpo enviado pelo ML. Devolve None para eventos que não
+    nos interessam (outro tópico, outra aplicação, recurso desconhecido).
+    """
+    topic = evento.get("topic")
+    if topic not in TOPICOS:
+        return None
+    if application_id and str(evento.get("application_id")) != str(application_id):
+        return None
+    m = _RECURSO.match(str(evento.get("resource") or ""))
+    if not m or not str(evento.get("user_id") or "").isdigit():
+        return None
+    if (m.group(1) == "orders") != (topic == "orders_v2"):
+        return None
+
+    agora = datetime.now(tzutc())
+    try:
+        enviado = parser.isoparse(evento["sent"]) if evento.get("sent") else agora
+    except (TypeError, ValueError):
+        enviado = agora
+    if enviado.tzinfo is None:
+        enviado = enviado.replace(tzinfo=tzutc())
+
+    return {
+        "topic":       topic,
+        "resource_id": int(m.group(2)),
+        "ml_user_id":  int(evento["user_id"]),
+        "sent_at":     min(enviado, agora),
+        "received_at": agora,
+    }
+
+
+def enfileirar(conn, evento: Dict[str, Any]) -> None:
+    """
+    Um único upsert. Enquanto o recurso está pendente, eventos repetidos
+    só incrementam `eventos` (o lag conta a partir do primeiro); depois
+    de processado, um novo evento o coloca de volta na fila.
+    """
+    tabela = MlNotificacao.__table__
+    stmt = pg_insert(tabela).values(eventos=1, tentativas=0, **evento)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[tabela.c.topic, tabela.c.resource_id],
+        set_={
+            "received_at":  stmt.excluded.received_at,
+            "sent_at":      text(
+                "CASE WHEN ml_notificacoes.processed_at IS NULL "
+                "THEN LEAST(ml_notificacoes.sent_at, excluded.sent_at) ELSE excluded.sent_at END"
+            ),
+            "eventos":      text(
+                "CASE WHEN ml_notificacoes.processed_at IS NULL "
+                "THEN ml_notificacoes.eventos + 1 ELSE 1 END"
+            ),
+            "tentativas":   text(
+                "CASE WHEN ml_notificacoes.processed_at IS NULL "
+                "THEN ml_notificacoes.tentativas ELSE 0 END"
+            ),
+            "processed_at":  None,
+            "claimed_until": None,  # um worker no meio do recurso não o conclui (received_at mudou)
+            "lag_ms":       None,
+            "erro":         None,
+        },
+    )
+    conn.execute(stmt)
+
+
+# ------------------- Worker -------------------- #
+_SQL_RESERVAR = text("""
+    UPDATE ml_notificacoes n
+    SET claimed_until = now() + make_interval(secs => :reserva)
+    FROM (
+        SELECT topic, resource_id FROM ml_notificacoes
+        WHERE processed_at IS NULL AND (claimed_until IS NULL OR claimed_until < now())
+        ORDER BY sent_at
+        LIMIT :lote
+        FOR UPDATE SKIP LOCKED
+    ) sel
+    WHERE n.topic = sel.topic AND n.resource_id = sel.resource_id
+    RETURNING n.topic, n.resource_id, n.ml_user_id, n.sent_at, n.received_at, n.tentativas
+""")
+
+# Só conclui se nenhum evento novo chegou durante o processamento
+_SQL_CONCLUIR = text("""
+    UPDATE ml_notificacoes
+    SET processed_at = now(),
+        lag_ms = (EXTRACT(EPOCH FROM now() - sent_at) * 1000)::int,
+        claimed_until = NULL, erro = :erro
+    WHERE topic = :topic AND resource_id = :resource_id AND received_at = :received_at
+""")
+
+_SQL_FALHA = text("""
+    UPDATE ml_notificacoes
+    SET tentativas = tentativas + 1, erro = :erro,
+        claimed_until = now() + make_interval(secs => :espera),
+        processed_at = CASE WHEN tentativas + 1 >= :max_tentativas THEN now() END
+    WHERE topic = :topic AND resource_id = :resource_id
+""")
+
+
+def _pedidos_do_evento(db, evento, cache) -> List[int]:
+    """order_ids afetados: o próprio pedido, ou os pedidos do shipment."""
+    from ml_api import API_ROOT, get_json
+    from oauth import tokens
+
+    if evento.topic == "orders_v2":
+        return [evento.resource_id]
+
+    ids = [int(r[0]) for r in db.execute(
+        text("SELECT order_id FROM sales WHERE shipping_id = :sid"), {"sid": str(evento.resource_id)}
+    )]
+    if ids:
+        return ids
+    # Shipment de um pedido que ainda não está no banco
+    shipment = get_json(
+        f"{API_ROOT}/shipments/{evento.resource_id}", tokens.obter(str(evento.ml_user_id)), cache=cache
+    ) or {}
+    return [int(shipment["order_id"])] if shipment.get("order_id") else []
+
+
+def _resolver(evento, cache) -> List[Dict[str, Any]]:
+    """Baixa os bundles dos pedidos afetados pelo evento."""
+    from db import SessionLocal
+    from oauth import tokens
+    from reconcile import _fetch_bundle
+
+    uid = str(evento.ml_user_id)
+    if not tokens.obter(uid):
+        raise LookupError(f"conta {uid} sem token")
+    db = SessionLocal.session_factory()
+    try:
+        order_ids = _pedidos_do_evento(db, evento, cache)
+    finally:
+        db.close()
+
+    bundles = []
+    for order_id in order_ids:
+        bundle = _fetch_bundle(str(order_id), uid, cache)
+        if bundle is None:
+            raise RuntimeError(f"falha ao baixar pedido {order_id}")
+        bundles.append(bundle)
+    return bundles
+
+
+def processar_pendentes(lote: int = LOTE, max_workers: int = MAX_WORKERS) -> Dict[str, int]:
+    """
+    Reserva até `lote` eventos, atualiza só os pedidos afetados (mesmo
+    caminho de `_order_to_sale`: bundle + `_build_sale`) e grava tudo
+    com um upsert por conta.
+    """
+    from db import SessionLocal, engine
+    from archive import arquivar
+    from ml_api import RunCache, ledger
+    from sales import _build_sale, upsert_vendas
+
+    with engine.begin() as conn:
+        eventos = conn.execute(_SQL_RESERVAR, {"reserva": RESERVA.total_seconds(), "lote": lote}).fetchall()
+    if not eventos:
+        return {"eventos": 0, "pedidos": 0, "erros": 0}
+
+    # Um cache por conta: limitador e ledger continuam atribuindo as chamadas
+    caches = {
+        str(e.ml_user_id): RunCache(conta=str(e.ml_user_id), job="notificacoes") for e in eventos
+    }
+
+    def _tentar(evento) -> Tuple[Any, Optional[List[Dict[str, Any]]], Optional[str]]:
+        try:
+            return evento, _resolver(evento, caches[str(evento.ml_user_id)]), None
+        except Exception as e:
+            return evento, None, str(e)[:500]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        resultados = list(executor.map(_tentar, eventos))
+
+    por_conta: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+    for evento, bundles, erro in resultados:
+        if bundles:
+            por_conta[str(evento.ml_user_id)].extend(bundles)
+
+    pedidos = erros = 0
+    db = SessionLocal()
+    try:
+        for uid, bundles in por_conta.items():
+            arquivar(db, uid, bundles)
+            upsert_vendas(db, [_build_sale(b, uid, db) for b in bundles], commit=False)
+            pedidos += len(bundles)
+
+        for evento, bundles, erro in resultados:
+            chave = {"topic": evento.topic, "resource_id": evento.resource_id}
+            if erro is None:
+                db.execute(_SQL_CONCLUIR, {**chave, "received_at": evento.received_at, "erro": None})
+            else:
+                erros += 1
+                logging.warning(f"⚠️ Notificação {evento.topic} {evento.resource_id}: {erro}")
+                db.execute(_SQL_FALHA, {
+                    **chave, "erro": erro, "max_tentativas": MAX_TENTATIVAS,
+                    "espera": 30 * 2 ** evento.tentativas,
+                })
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+        ledger.flush()
+
+    print(f"🔔 {len(eventos)} notificações: {pedidos} pedidos atualizados, {erros} com erro")
+    return {"eventos": len(eventos), "pedidos": pedidos, "erros": erros}
+
+
+def estatisticas(conn, horas: int = 1) -> Dict[str, Any]:
+    """Fila pendente e lag (envio pelo ML → venda gravada) das últimas `horas`."""
+    linha = conn.execute(text("""
+        SELECT
+            (SELECT count(*) FROM ml_notificacoes WHERE processed_at IS NULL)              AS pendentes,
+            count(*)                                                                        AS processadas,
+            coalesce(sum(eventos), 0)                                                       AS eventos,
+            percentile_cont(0.5)  WITHIN GROUP (ORDER BY lag_ms)                            AS lag_p50_ms,
+            percentile_cont(0.95) WITHIN GROUP (ORDER BY lag_ms)                            AS lag_p95_ms,
+            max(lag_ms)                                                                     AS lag_max_ms
+        FROM ml_notificacoes
+        WHERE processed_at >= now() - make_interval(hours => :horas) AND erro IS NULL
+    """), {"horas": horas}).mappings().one()
+    return dict(linha)
+
+
+def executar_worker(intervalo: float = INTERVALO_OCIOSO) -> None:
+    """Laço do worker: drena a fila e dorme quando ela esvazia."""
+    print("🔔 Worker de notificações iniciado")
+    while True:
+        try:
+            res = processar_pendentes()
+        except Exception as e:
+            logging.exception(f"❌ Erro no worker de notificações: {e}")
+            res = {"eventos": 0}
+        if not res["eventos"]:
+            time.sleep(intervalo)
+
+
+if __name__ == "__main__":
+    executar_worker()
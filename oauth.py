@@ -1,12 +1,14 @@
 # oauth.py
 
 import os
-import requests
+import threading
 from dotenv import load_dotenv
 from datetime import datetime, timedelta
+from typing import Dict, Optional, Tuple
 
 from db import SessionLocal
 from models import UserToken
+from ml_api import API_ROOT, requisitar
 
 # 1) Carregar .env e variáveis obrigatórias
 load_dotenv()
@@ -20,7 +22,10 @@ if not all([CLIENT_ID, CLIENT_SECRET, BACKEND_URL]):
 REDIRECT_URI = f"{BACKEND_URL}/auth/callback"
 
 # 3) URL para trocar code por token
-TOKEN_URL = "https://api.mercadolibre.com/oauth/token"
+TOKEN_URL = f"{API_ROOT}/oauth/token"
+
+# 4) Renova o token este tempo antes de expirar
+MARGEM_RENOVACAO = timedelta(minutes=5)
 
 
 def get_auth_url() -> str:
@@ -48,7 +53,7 @@ def exchange_code(code: str) -> dict:
         "code":          code,
         "redirect_uri": f"{BACKEND_URL}/?cyberdock_auth=success",
     }
-    resp = requests.post(TOKEN_URL, data=payload)
+    resp = requisitar("POST", TOKEN_URL, job="oauth", data=payload)
     data = resp.json()
     if resp.status_code != 200:
         raise Exception(f"Erro ao trocar code por token: {data}")
@@ -76,6 +81,7 @@ def exchange_code(code: str) -> dict:
             token.expires_at    = expires_at
 
         db.commit()
+        tokens.guardar(data["user_id"], data["access_token"], expires_at)
     except Exception:
         db.rollback()
         raise
@@ -85,40 +91,131 @@ def exchange_code(code: str) -> dict:
     return data
 
 
-def renovar_access_token(ml_user_id: int) -> str | None:
+def _trocar_refresh_token(refresh_token: str, ml_user_id: int) -> Optional[dict]:
+    """POST no /oauth/token com grant refresh_token; None em caso de falha."""
+    payload = {
+        "grant_type":    "refresh_token",
+        "client_id":     CLIENT_ID,
+        "client_secret": CLIENT_SECRET,
+        "refresh_token": refresh_token,
+    }
+    resp = requisitar("POST", TOKEN_URL, conta=str(ml_user_id), job="oauth", data=payload)
+    data = resp.json()
+    if resp.status_code != 200:
+        print(f"⚠️ Erro ao renovar token: {data}")
+        return None
+    return data
+
+
+class GerenciadorTokens:
     """
-    Renova o token usando o refresh_token gravado no banco.
-    Retorna o novo access_token ou None em caso de falha.
+    Cache de access tokens por conta, válido até `expires_at - margem`.
+
+    A renovação é single-flight: um lock por conta no processo e um
+    SELECT ... FOR UPDATE na linha de user_tokens entre processos. Quem
+    chega depois encontra o token já renovado e não chama o ML de novo.
     """
-    db = SessionLocal()
-    try:
-        token = db.query(UserToken).filter_by(ml_user_id=ml_user_id).first()
-        if not token:
-            print(f"⚠️ Usuário {ml_user_id} não encontrado no banco.")
-            return None
 
-        payload = {
-            "grant_type":    "refresh_token",
-            "client_id":     CLIENT_ID,
-            "client_secret": CLIENT_SECRET,
-            "refresh_token": token.refresh_token,
-        }
-        resp = requests.post(TOKEN_URL, data=payload)
-        data = resp.json()
-        if resp.status_code != 200:
-            print(f"⚠️ Erro ao renovar token: {data}")
+    def __init__(self, margem: timedelta = MARGEM_RENOVACAO):
+        self.margem = margem
+        self._tokens: Dict[int, Tuple[str, datetime]] = {}
+        self._locks: Dict[int, threading.Lock] = {}
+        self._lock = threading.Lock()
+        self.renovacoes = 0
+
+    def _lock_da_conta(self, uid: int) -> threading.Lock:
+        with self._lock:
+            return self._locks.setdefault(uid, threading.Lock())
+
+    def _valido(self, expires_at: Optional[datetime]) -> bool:
+        return expires_at is not None and expires_at - self.margem > datetime.utcnow()
+
+    def guardar(self, ml_user_id, access_token: str, expires_at: datetime) -> None:
+        self._tokens[int(ml_user_id)] = (access_token, expires_at)
+
+    def obter(self, ml_user_id) -> Optional[str]:
+        """Token válido da conta, renovando só se estiver perto de expirar."""
+        uid = int(ml_user_id)
+        atual = self._tokens.get(uid)
+        if atual and self._valido(atual[1]):
+            return atual[0]
+        with self._lock_da_conta(uid):
+            atual = self._tokens.get(uid)
+            if atual and self._valido(atual[1]):
+                return atual[0]
+            return self._renovar(uid, rejeitado=None)
+
+    def rejeitado(self, ml_user_id, token: Optional[str]) -> Optional[str]:
+        """
+        Chamado quando a API devolve 401 para `token`. Só a primeira
+        chamada renova; as demais recebem o token novo já em cache.
+        """
+        uid = int(ml_user_id)
+        with self._lock_da_conta(uid):
+            atual = self._tokens.get(uid)
+            if atual and atual[0] != token and self._valido(atual[1]):
+                return atual[0]
+            return self._renovar(uid, rejeitado=token)
+
+    def renovar(self, ml_user_id, forcar: bool = False) -> Optional[str]:
+        """
+        Token da conta lido da linha de user_tokens (não da cópia do
+        processo); com `forcar`, troca o refresh_token mesmo que o token
+        ainda seja válido.
+        """
+        uid = int(ml_user_id)
+        with self._lock_da_conta(uid):
+            return self._renovar(uid, rejeitado=None, forcar=forcar)
+
+    def _renovar(self, uid: int, rejeitado: Optional[str], forcar: bool = False) -> Optional[str]:
+        # Sessão própria (não a scoped) para o lock de linha não vazar para quem chamou
+        db = SessionLocal.session_factory()
+        try:
+            token = (
+                db.query(UserToken)
+                  .filter_by(ml_user_id=uid)
+                  .with_for_update()
+                  .first()
+            )
+            if not token:
+                print(f"⚠️ Usuário {uid} não encontrado no banco.")
+                return None
+
+            # Outro processo pode ter renovado enquanto esperávamos o lock
+            if not forcar and self._valido(token.expires_at) and token.access_token != rejeitado:
+                self.guardar(uid, token.access_token, token.expires_at)
+                db.commit()
+                return token.access_token
+
+            data = _trocar_refresh_token(token.refresh_token, uid)
+            if data is None:
+                db.rollback()
+                return None
+
+            token.access_token  = data["access_token"]
+            token.refresh_token = data["refresh_token"]
+            token.expires_at    = datetime.utcnow() + timedelta(seconds=data["expires_in"])
+            db.commit()
+            self.guardar(uid, token.access_token, token.expires_at)
+            self.renovacoes += 1
+            return token.access_token
+
+        except Exception as e:
+            db.rollback()
+            print(f"❌ Erro na renovação do token: {e}")
             return None
 
-        token.access_token  = data["access_token"]
-        token.refresh_token = data["refresh_token"]
-        token.expires_at    = datetime.utcnow() + timedelta(seconds=data["expires_in"])
-        db.commit()
-        return token.access_token
+        finally:
+            db.close()
 
-    except Exception as e:
-        db.rollback()
-        print(f"❌ Erro na renovação do token: {e}")
-        return None
 
-    finally:
-        db.close()
+tokens = GerenciadorTokens()
+
+
+def renovar_access_token(ml_user_id: int) -> str | None:
+    """
+    Renova o access_token da conta agora (POST /auth/refresh), com o
+    refresh_token lido do banco sob SELECT ... FOR UPDATE, e atualiza o
+    cache do processo. Retorna None em caso de falha.
+    """
+    return tokens.renovar(ml_user_id, forcar=True)
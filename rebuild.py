@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+# rebuild.py – recalcula as colunas de sales a partir do arquivo de payloads
+
+import time
+import argparse
+from collections import Counter
+from typing import Dict, Optional
+
+from db import SessionLocal
+from archive import iterar_arquivo
+from sales import _build_sale, upsert_vendas
+from sku_cache import catalogo_sku
+
+
+def reconstruir_vendas(ml_user_id: Optional[str] = None, lote: int = 1_000) -> Dict[str, int]:
+    """
+    Re-deriva todas as colunas de `sales` a partir de sale_payloads, sem
+    nenhuma chamada à API. Só as vendas cujo content_hash mudou (ex.: após
+    corrigir SLA, extração de SKU ou ml_fee em `_build_sale`) são gravadas.
+    """
+    # Leitura em cursor no servidor e escrita em sessões separadas:
+    # o commit de cada lote não pode fechar o cursor.
+    leitura = SessionLocal.session_factory()
+    db = SessionLocal()
+    totais: Counter = Counter()
+    inicio = time.monotonic()
+
+    try:
+        catalogo_sku.atualizar(db, imediato=True)
+        for bloco in iterar_arquivo(leitura, ml_user_id, lote):
+            vendas = [_build_sale(bundle, str(uid), db) for uid, bundle in bloco]
+            totais.update(upsert_vendas(db, vendas))
+            totais["pedidos"] += len(vendas)
+
+            decorrido = time.monotonic() - inicio
+            print(
+                f"♻️ {totais['pedidos']} pedidos reprocessados "
+                f"({totais['pedidos'] / decorrido:.0f}/s) | {totais['atualizadas']} atualizadas"
+            )
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        leitura.close()
+        db.close()
+
+    print(f"✅ Rebuild concluído em {time.monotonic() - inicio:.1f}s: {dict(totais)}")
+    print(catalogo_sku.resumo())
+    return dict(totais)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recalcula sales a partir do arquivo de payloads (sem API).")
+    parser.add_argument("--conta", help="ml_user_id; padrão: todas as contas")
+    parser.add_argument("--lote", type=int, default=1_000, help="pedidos por lote de escrita")
+    args = parser.parse_args()
+    reconstruir_vendas(args.conta, args.lote)
@@ -1,152 +1,796 @@
 # sales.py – nova rotina de reconciliação
 from __future__ import annotations
 
-import math
+import os
 import time
+import queue
 import logging
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import Dict, List, Any
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 import requests
 from dateutil.relativedelta import relativedelta
-from sqlalchemy import text, inspect
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from sqlalchemy import text
 
 from db import SessionLocal
-from models import Sale, UserToken
-from oauth import renovar_access_token
-from sales import _order_to_sale
+from models import Sale
+from oauth import tokens
+from sales import _build_sale, _sale_para_linha, enriquecer_pedido, upsert_vendas
+from sale_diff import Celula, diff_colunar
+from ml_api import API_ROOT, RUNCACHE_MAX, Orcamento, RunCache, estatisticas_http, ledger, requisitar
+from sku_cache import catalogo_sku
+from archive import arquivar
 
 # ---------------- Configurações --------------- #
 MAX_WORKERS       = 12
-CHUNK_SIZE        = 1_000
-NUMERIC_TOLERANCE = 0.01
-API_TIMEOUT       = 10
-BACKOFF_SEC       = 2
+CHUNK_SIZE        = 1_000   # linhas por flush do writer
+FLUSH_SEG         = 5.0     # ... ou a cada FLUSH_SEG segundos, o que vier antes
+FILA_MAX          = 4 * MAX_WORKERS
 
-API_ORDER      = "https://api.mercadolibre.com/orders/{}"
-API_ORDER_FULL = API_ORDER + "?access_token={}"
+# Verificação contínua (verificar_por_risco)
+ORCAMENTO_HORA     = int(os.getenv("ML_VERIFICACAO_ORCAMENTO_HORA", "3000"))  # chamadas/hora, todas as contas
+CHAMADAS_POR_PEDIDO = 3      # /orders/{id} + /shipments/{id} + /sla (só para escolher quantos pedidos)
+LOTE_VERIFICACAO   = 200
+RECENTE_DIAS       = 30
+CICLO_DIAS         = 30      # sem verificação há CICLO_DIAS → peso máximo de idade
+REVERIFICAR_APOS   = timedelta(hours=6)
+JOB_VERIFICACAO    = "verify"
+
+# Peso de cada sinal de risco de divergência
+PESOS_RISCO = {
+    "recente": 3.0,   # fechado nos últimos RECENTE_DIAS
+    "status":  3.0,   # pedido ainda pode mudar
+    "envio":   2.0,   # envio ativo ou sem dados de envio
+    "fee":     2.0,   # ml_fee ausente
+    "sku":     1.0,   # SKU ou custo ausente
+    "idade":   4.0,   # tempo desde a última verificação (nunca = máximo)
+}
+STATUS_FINAIS = ("paid", "cancelled", "invalid")
+
+# Relatórios de divergência (reconcile_runs / reconcile_diffs)
+RETENCAO_DIFFS     = timedelta(days=90)
+
+API_ORDER      = f"{API_ROOT}/orders/{{}}"
 
 # ------------ Utilidades internas ------------- #
-def _is_different(a: Any, b: Any) -> bool:
-    if a is None and b is None:
-        return False
-    if isinstance(a, (float, int)) and isinstance(b, (float, int)):
-        return abs(float(a) - float(b)) > NUMERIC_TOLERANCE
-    return a != b
-
-def _fetch_full_order(order_id: str, access_token: str) -> dict | None:
-    url = API_ORDER_FULL.format(order_id, access_token)
-    for attempt in range(3):
+def _fetch_full_order(order_id: str, access_token: str, cache: RunCache | None = None) -> dict | None:
+    # 429/5xx/erros de rede já são repetidos com backoff dentro de requisitar
+    url = API_ORDER.format(order_id)
+    conta = cache.conta if cache is not None else None
+    orcamento = cache.orcamento if cache is not None else None
+    try:
+        if cache is not None:
+            cache.contar(url)
+        resp = requisitar(
+            "GET", url, access_token=access_token, orcamento=orcamento,
+            conta=conta, job=cache.job if cache is not None else "reconcile",
+        )
+        if resp.status_code == 401 and conta:
+            # Renovação compartilhada: só o primeiro 401 chama o ML
+            novo = tokens.rejeitado(conta, access_token)
+            if novo and novo != access_token:
+                cache.contar(url)
+                resp = requisitar("GET", url, access_token=novo, conta=conta, job=cache.job, orcamento=orcamento)
+    except requests.RequestException as e:
+        logging.warning(f"⚠️ Req error ({order_id}): {e}")
+        return None
+    if resp.ok:
+        return resp.json()
+    logging.warning(f"⚠️ Falha {resp.status_code} para order {order_id}")
+    return None
+
+def _fetch_bundle(order_id: str, ml_user_id: str, cache: RunCache) -> dict | None:
+    """Baixa o pedido uma única vez e o enriquece com payments/shipment/SLA."""
+    access_token = tokens.obter(ml_user_id)
+    if not access_token:
+        return None
+    full_order = _fetch_full_order(order_id, access_token, cache)
+    if full_order is None:
+        return None
+    return enriquecer_pedido(full_order, tokens.obter(ml_user_id) or access_token, cache)
+
+# ------------ Diff em bloco com o banco ------------ #
+def _carregar_bloco(db, order_ids: List[int]) -> Dict[int, Dict[str, Any]]:
+    """Todas as linhas do bloco em uma única consulta, indexadas por order_id."""
+    from sqlalchemy import select
+
+    tabela = Sale.__table__
+    linhas = db.execute(select(tabela).where(tabela.c.order_id.in_(order_ids))).mappings()
+    return {int(l["order_id"]): dict(l) for l in linhas}
+
+
+def _atualizar_hashes(db, linhas: List[Dict[str, Any]]) -> None:
+    """Linhas iguais às do banco com content_hash velho: só o hash é regravado (sem commit)."""
+    if linhas:
+        db.execute(
+            text("UPDATE sales SET content_hash = :hash WHERE order_id = :order_id"),
+            [{"hash": l["content_hash"], "order_id": int(l["order_id"])} for l in linhas],
+        )
+
+
+# ------------ Relatório de divergências por execução ------------ #
+def _iniciar_run(ml_user_id: str, tipo: str, dry_run: bool) -> str:
+    """Registra a execução (conexão própria) e apaga relatórios além da retenção."""
+    import uuid
+    from db import engine
+
+    run_id = uuid.uuid4().hex
+    with engine.begin() as conn:
+        conn.execute(text("""
+            DELETE FROM reconcile_diffs WHERE run_id IN (
+                SELECT run_id FROM reconcile_runs WHERE iniciado_em < now() - make_interval(days => :dias)
+            )
+        """), {"dias": RETENCAO_DIFFS.days})
+        conn.execute(
+            text("DELETE FROM reconcile_runs WHERE iniciado_em < now() - make_interval(days => :dias)"),
+            {"dias": RETENCAO_DIFFS.days},
+        )
+        conn.execute(text("""
+            INSERT INTO reconcile_runs (run_id, ml_user_id, tipo, dry_run, iniciado_em, verificados, divergentes)
+            VALUES (:run_id, :uid, :tipo, :dry_run, now(), 0, 0)
+        """), {"run_id": run_id, "uid": int(ml_user_id), "tipo": tipo, "dry_run": dry_run})
+    return run_id
+
+
+def _finalizar_run(run_id: str, totais: Counter, erro: Optional[str] = None) -> None:
+    from db import engine
+
+    with engine.begin() as conn:
+        conn.execute(text("""
+            UPDATE reconcile_runs
+            SET concluido_em = now(), verificados = :verificados, divergentes = :divergentes, erro = :erro
+            WHERE run_id = :run_id
+        """), {
+            "run_id": run_id, "verificados": totais["verificados"],
+            "divergentes": totais["divergentes"], "erro": erro[:1000] if erro else None,
+        })
+
+
+def _registrar_diffs(db, run_id: str, ml_user_id: str, celulas: List[Celula]) -> None:
+    """Um INSERT em lote com as colunas divergentes do bloco (não faz commit)."""
+    from models import ReconcileDiff
+
+    if not celulas:
+        return
+    db.execute(ReconcileDiff.__table__.insert(), [
+        {
+            "run_id": run_id, "ml_user_id": int(ml_user_id), "order_id": oid, "coluna": coluna,
+            "antigo": None if antigo is None else str(antigo),
+            "novo": None if novo is None else str(novo),
+        }
+        for oid, coluna, antigo, novo in celulas
+    ])
+
+
+_FILTRO_RUNS = """
+    r.concluido_em IS NOT NULL
+    AND r.iniciado_em >= now() - make_interval(days => :dias)
+    AND (:uid IS NULL OR r.ml_user_id = :uid)
+    AND (:run_id IS NULL OR r.run_id = :run_id)
+"""
+
+
+def drift_por_coluna(
+    db, dias: int = 30, ml_user_id: Optional[str] = None, run_id: Optional[str] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Frequência de divergência por coluna nas execuções do período:
+    pedidos divergentes na coluna e % sobre os pedidos verificados.
+    """
+    params = {"dias": dias, "uid": int(ml_user_id) if ml_user_id else None, "run_id": run_id}
+    verificados = db.execute(
+        text(f"SELECT coalesce(sum(r.verificados), 0) FROM reconcile_runs r WHERE {_FILTRO_RUNS}"), params
+    ).scalar()
+    linhas = db.execute(text(f"""
+        SELECT d.coluna, count(*) AS pedidos, count(DISTINCT d.run_id) AS execucoes
+        FROM reconcile_diffs d
+        JOIN reconcile_runs r ON r.run_id = d.run_id
+        WHERE {_FILTRO_RUNS}
+        GROUP BY d.coluna
+        ORDER BY pedidos DESC
+    """), params).mappings()
+    return [
+        {**l, "frequencia_pct": round(100 * l["pedidos"] / verificados, 3) if verificados else None}
+        for l in linhas
+    ]
+
+
+def drift_por_conta(db, dias: int = 30) -> List[Dict[str, Any]]:
+    """Por conta: execuções, pedidos verificados, divergentes e as colunas que mais divergem."""
+    params = {"dias": dias, "uid": None, "run_id": None}
+    contas = db.execute(text(f"""
+        SELECT r.ml_user_id, count(*) AS execucoes, sum(r.verificados) AS verificados,
+               sum(r.divergentes) AS divergentes, max(r.iniciado_em) AS ultima
+        FROM reconcile_runs r
+        WHERE {_FILTRO_RUNS}
+        GROUP BY r.ml_user_id
+        ORDER BY r.ml_user_id
+    """), params).mappings().all()
+    colunas: Dict[int, Counter] = {}
+    for row in db.execute(text(f"""
+        SELECT d.ml_user_id, d.coluna, count(*) AS pedidos
+        FROM reconcile_diffs d
+        JOIN reconcile_runs r ON r.run_id = d.run_id
+        WHERE {_FILTRO_RUNS}
+        GROUP BY d.ml_user_id, d.coluna
+    """), params):
+        colunas.setdefault(int(row.ml_user_id), Counter())[row.coluna] = row.pedidos
+    return [
+        {
+            **c,
+            "divergentes_pct": round(100 * c["divergentes"] / c["verificados"], 3) if c["verificados"] else None,
+            "colunas": dict(colunas.get(int(c["ml_user_id"]), Counter()).most_common(5)),
+        }
+        for c in contas
+    ]
+
+
+# ------------ Pipeline (produtor → fetch → normalizador → writer) ------------ #
+_FIM = object()
+
+
+def _colocar(fila: queue.Queue, item: Any, parar: threading.Event) -> bool:
+    """put bloqueante que desiste se o pipeline foi abortado."""
+    while not parar.is_set():
+        try:
+            fila.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _retirar(fila: queue.Queue, parar: threading.Event) -> Any:
+    """get bloqueante; devolve _FIM se o pipeline foi abortado."""
+    while not parar.is_set():
+        try:
+            return fila.get(timeout=0.5)
+        except queue.Empty:
+            continue
+    return _FIM
+
+
+def _etapa(nome: str, fn: Callable[[], None], parar: threading.Event, falhas: List[BaseException]) -> threading.Thread:
+    def _rodar():
         try:
-            resp = requests.get(url, timeout=API_TIMEOUT)
-            if resp.ok:
-                return resp.json()
-            if resp.status_code in (429, 500, 502, 503):
-                time.sleep(BACKOFF_SEC * (attempt + 1))
+            fn()
+        except BaseException as e:  # derruba o pipeline inteiro
+            logging.exception(f"❌ Etapa {nome} da reconciliação falhou: {e}")
+            falhas.append(e)
+            parar.set()
+    t = threading.Thread(target=_rodar, name=f"reconcile-{nome}", daemon=True)
+    t.start()
+    return t
+
+
+def _produzir_ids(ml_user_id: str, desde: datetime, ate: Optional[datetime], saida: queue.Queue,
+                  parar: threading.Event, n_workers: int) -> None:
+    """Lê os order_ids do período em cursor no servidor (memória constante)."""
+    query = """
+        SELECT order_id
+        FROM sales
+        WHERE ml_user_id = :uid
+          AND date_closed >= :desde
+    """
+    params = {"uid": ml_user_id, "desde": desde}
+    if ate:
+        query += " AND date_closed <= :ate"
+        params["ate"] = ate
+
+    db = SessionLocal.session_factory()
+    try:
+        conn = db.connection().execution_options(stream_results=True, yield_per=CHUNK_SIZE)
+        for (order_id,) in conn.execute(text(query), params):
+            if not _colocar(saida, order_id, parar):
+                return
+    finally:
+        db.close()
+    for _ in range(n_workers):
+        _colocar(saida, _FIM, parar)
+
+
+def _buscar_bundles(ml_user_id: str, cache: RunCache, entrada: queue.Queue, saida: queue.Queue,
+                    parar: threading.Event) -> None:
+    while True:
+        order_id = _retirar(entrada, parar)
+        if order_id is _FIM:
+            _colocar(saida, _FIM, parar)
+            return
+        try:
+            bundle = _fetch_bundle(str(order_id), ml_user_id, cache)
+        except Exception as e:
+            logging.warning(f"⚠️ Falha ao buscar {order_id}: {e}")
+            bundle = None
+        if not _colocar(saida, bundle, parar):
+            return
+
+
+def _normalizar_bundles(ml_user_id: str, entrada: queue.Queue, saida: queue.Queue,
+                        parar: threading.Event, n_workers: int, contagem: Counter) -> None:
+    """Payload → Sale. Uma thread só, com sessão própria para o catálogo de SKU."""
+    db = SessionLocal.session_factory()
+    fins = 0
+    try:
+        while fins < n_workers:
+            bundle = _retirar(entrada, parar)
+            if bundle is _FIM:
+                if parar.is_set():
+                    return
+                fins += 1
                 continue
-            logging.warning(f"⚠️ Falha {resp.status_code} para order {order_id}")
-            return None
-        except requests.RequestException as e:
-            logging.warning(f"⚠️ Req error ({order_id}): {e}")
-            time.sleep(BACKOFF_SEC * (attempt + 1))
-    return None
+            if bundle is None:
+                contagem["erros"] += 1
+                continue
+            contagem["processadas"] += 1
+            if not _colocar(saida, (bundle, _build_sale(bundle, ml_user_id, db)), parar):
+                return
+    finally:
+        db.close()
+    _colocar(saida, _FIM, parar)
+
+
+def _marcar_verificadas(db, order_ids: List[int]) -> None:
+    """last_verified_at = agora para os pedidos conferidos (sem commit)."""
+    if order_ids:
+        db.execute(
+            text("UPDATE sales SET last_verified_at = now() WHERE order_id = ANY(:ids)"),
+            {"ids": order_ids},
+        )
+
+
+def _conferir_vendas(db, ml_user_id: str, vendas: List[Sale], divergencias: Counter,
+                     run_id: Optional[str] = None, dry_run: bool = False) -> Dict[str, Any]:
+    """
+    Uma consulta para as linhas do lote, diff por coluna, uma escrita e o
+    commit. Todas as vendas do lote ficam com last_verified_at = agora. Com
+    `run_id`, as colunas divergentes vão para reconcile_diffs no mesmo
+    commit; com `dry_run`, só elas são gravadas (sales fica intacta).
+    Retorna {"verificados", "divergentes", "so_hash", "inseridas", "atualizadas", "por_coluna"}.
+    """
+    linhas = list({int(v.order_id): _sale_para_linha(v) for v in vendas}.values())
+    ids = [int(l["order_id"]) for l in linhas]
+    banco = _carregar_bloco(db, ids)
+    celulas: Optional[List[Celula]] = [] if run_id else None
+    divergentes, so_hash, por_coluna = diff_colunar(linhas, banco, celulas)
+    divergencias.update(por_coluna)
+    resultado = {
+        "verificados": len(linhas), "divergentes": len(divergentes), "so_hash": len(so_hash),
+        "inseridas": 0, "atualizadas": 0, "por_coluna": por_coluna,
+    }
+
+    if run_id:
+        _registrar_diffs(db, run_id, ml_user_id, celulas)
+    if not dry_run:
+        res = upsert_vendas(
+            db, [v for v in vendas if int(v.order_id) in divergentes], commit=False, pular_iguais=False,
+        )
+        _atualizar_hashes(db, [l for l in linhas if int(l["order_id"]) in so_hash])
+        _marcar_verificadas(db, ids)
+        # Contagem real do upsert (linhas que de fato mudaram no banco)
+        resultado["inseridas"], resultado["atualizadas"] = res["inseridas"], res["atualizadas"]
+    db.commit()
+    return resultado
+
+
+def _gravar_bloco(db, ml_user_id: str, itens: List[Tuple[dict, Sale]], totais: Counter,
+                  divergencias: Counter, run_id: Optional[str] = None, dry_run: bool = False) -> None:
+    """Arquiva os payloads do bloco e o confere/grava com `_conferir_vendas`, no mesmo commit."""
+    if not dry_run:
+        arquivar(db, ml_user_id, [b for b, _ in itens])
+    res = _conferir_vendas(db, ml_user_id, [v for _, v in itens], divergencias, run_id, dry_run)
+    gravadas = res["inseridas"] + res["atualizadas"]
+    iguais = res["verificados"] - res["divergentes"]
+    totais["blocos"] += 1
+    totais["verificados"] += res["verificados"]
+    totais["divergentes"] += res["divergentes"]
+    totais["atualizadas"] += gravadas
+    colunas = ", ".join(f"{c}={n}" for c, n in res["por_coluna"].most_common(5))
+    if dry_run:
+        logging.info(f"🧪 Bloco {totais['blocos']} (simulação): {res['divergentes']} divergentes [{colunas}]")
+    else:
+        logging.info(
+            f"🔄 Bloco {totais['blocos']}: {res['divergentes']} divergentes ({gravadas} gravadas), "
+            f"{res['so_hash']} só com hash velho, {iguais} iguais [{colunas}]"
+        )
+
 
 # --------------- Função principal -------------- #
 def reconciliar_vendas(
     ml_user_id: str,
     desde: datetime | None = None,
     ate: datetime | None = None,
-    max_workers: int = MAX_WORKERS
-) -> Dict[str, int]:
+    max_workers: int = MAX_WORKERS,
+    dry_run: bool = False,
+) -> Dict[str, Any]:
     """
-    Verifica divergências entre DB e API e faz UPDATE em lote.
-    Retorna {"atualizadas": X, "erros": Y}.
+    Verifica divergências entre DB e API em um pipeline contínuo:
+    order_ids lidos em streaming → `max_workers` threads de fetch →
+    normalizador → writer único. As filas são limitadas, então a memória
+    não depende do tamanho do período. O writer grava a cada CHUNK_SIZE
+    linhas ou FLUSH_SEG segundos: uma consulta para as linhas do bloco,
+    diff coluna a coluna e um único upsert só das divergentes.
+    As colunas divergentes de cada pedido ficam em reconcile_diffs sob o
+    run_id da execução. Com `dry_run`, nada é gravado em sales: o custo
+    na API é o mesmo e o relatório mostra o que seria corrigido.
+    Retorna {"run_id", "dry_run", "divergentes", "atualizadas", "erros",
+    "divergencias": {coluna: n}}; "atualizadas" conta só as linhas que o
+    upsert de fato alterou (zero numa simulação).
     """
 
     if desde is None:
         desde = datetime.utcnow() - relativedelta(months=6)
 
     db = SessionLocal()
-    atualizadas = erros = 0
+    cache = RunCache(conta=ml_user_id, job="reconcile", max_itens=RUNCACHE_MAX)
+    contagem: Counter = Counter()      # processadas/erros (normalizador)
+    totais: Counter = Counter()        # verificados/divergentes/atualizadas/blocos (writer)
+    divergencias: Counter = Counter()
+    parar = threading.Event()
+    falhas: List[BaseException] = []
+    inicio = time.monotonic()
+    run_id = _iniciar_run(ml_user_id, "reconcile", dry_run)
+
+    ids: queue.Queue = queue.Queue(maxsize=FILA_MAX)
+    payloads: queue.Queue = queue.Queue(maxsize=FILA_MAX)
+    linhas: queue.Queue = queue.Queue(maxsize=CHUNK_SIZE)
 
     try:
-        token_row: UserToken | None = db.query(UserToken).filter_by(ml_user_id=int(ml_user_id)).first()
-        if not token_row:
+        # Token em cache do gerenciador; só renova perto de expirar
+        if not tokens.obter(ml_user_id):
             raise RuntimeError(f"Usuário {ml_user_id} não possui token válido.")
-        access_token = token_row.access_token or ""
-        novo_token = renovar_access_token(int(ml_user_id))
-        if novo_token:
-            access_token = novo_token
-
-        # ----- Query com intervalo opcional ----- #
-        query = """
-            SELECT order_id
-            FROM sales
-            WHERE ml_user_id = :uid
-              AND date_closed >= :desde
-        """
-        params = {"uid": ml_user_id, "desde": desde}
-        if ate:
-            query += " AND date_closed <= :ate"
-            params["ate"] = ate
-
-        order_ids: List[str] = [r[0] for r in db.execute(text(query), params)]
-
-        if not order_ids:
-            logging.info("Nenhuma venda no período para reconciliar.")
-            return {"atualizadas": 0, "erros": 0}
-
-        mapper = inspect(Sale)
-        cols_to_check = {
-            c.key for c in mapper.attrs
-            if c.key not in {"id", "order_id", "ml_user_id"}
-        }
+        catalogo_sku.atualizar(db, imediato=True)
+
+        etapas = [_etapa("ids", lambda: _produzir_ids(ml_user_id, desde, ate, ids, parar, max_workers), parar, falhas)]
+        etapas += [
+            _etapa(f"fetch{i}", lambda: _buscar_bundles(ml_user_id, cache, ids, payloads, parar), parar, falhas)
+            for i in range(max_workers)
+        ]
+        etapas.append(_etapa(
+            "normalizador",
+            lambda: _normalizar_bundles(ml_user_id, payloads, linhas, parar, max_workers, contagem),
+            parar, falhas,
+        ))
+
+        # ----- Writer: esta thread ----- #
+        buffer: List[Tuple[dict, Sale]] = []
+        ultimo_flush = time.monotonic()
+        while True:
+            try:
+                item = linhas.get(timeout=0.5)
+            except queue.Empty:
+                item = None
+            if item is _FIM or (item is None and parar.is_set()):
+                break
+            if item is not None:
+                buffer.append(item)
+            if buffer and (len(buffer) >= CHUNK_SIZE or time.monotonic() - ultimo_flush >= FLUSH_SEG):
+                _gravar_bloco(db, ml_user_id, buffer, totais, divergencias, run_id, dry_run)
+                buffer = []
+                ultimo_flush = time.monotonic()
 
-        for chunk_idx in range(0, len(order_ids), CHUNK_SIZE):
-            batch = order_ids[chunk_idx:chunk_idx + CHUNK_SIZE]
-            updates: List[Dict[str, Any]] = []
-
-            with ThreadPoolExecutor(max_workers=max_workers) as pool:
-                fut_to_oid = {
-                    pool.submit(_fetch_full_order, oid, access_token): oid
-                    for oid in batch
-                }
-
-                for fut in as_completed(fut_to_oid):
-                    oid = fut_to_oid[fut]
-                    full_order = fut.result()
-                    if full_order is None:
-                        erros += 1
-                        continue
-
-                    db_row: Sale | None = db.query(Sale).filter_by(order_id=oid).first()
-                    if db_row is None:
-                        continue
-
-                    api_sale: Sale = _order_to_sale(full_order, ml_user_id, access_token, db)
-
-                    diff_map = {}
-                    for col in cols_to_check:
-                        db_val  = getattr(db_row, col)
-                        api_val = getattr(api_sale, col)
-                        if _is_different(db_val, api_val):
-                            diff_map[col] = api_val
-
-                    if diff_map:
-                        diff_map["id"] = db_row.id
-                        updates.append(diff_map)
-                        logging.info(f"🔄 Order {oid} divergente – será atualizada.")
-
-            if updates:
-                db.bulk_update_mappings(Sale, updates)
-                db.commit()
-                atualizadas += len(updates)
+        if falhas:
+            raise falhas[0]
+        if buffer:
+            _gravar_bloco(db, ml_user_id, buffer, totais, divergencias, run_id, dry_run)
+        for t in etapas:
+            t.join(timeout=5)
 
     except Exception as e:
+        parar.set()
         db.rollback()
+        _finalizar_run(run_id, totais, erro=str(e))
         raise RuntimeError(f"❌ Erro na reconciliação: {e}") from e
     finally:
         db.close()
+        ledger.flush()
+
+    _finalizar_run(run_id, totais)
+    processadas = contagem["processadas"]
+    segundos = time.monotonic() - inicio
+    logging.info(cache.resumo(processadas))
+    if processadas:
+        iguais = totais["verificados"] - totais["divergentes"]
+        logging.info(
+            f"#️⃣ Sem diferença em {iguais}/{processadas} pedidos "
+            f"({100 * iguais / processadas:.1f}%) | {processadas / segundos:.1f} pedidos/s"
+        )
+    if divergencias:
+        logging.info(f"🧮 Divergências por coluna: {dict(divergencias.most_common())}")
+    logging.info(catalogo_sku.resumo())
+    logging.info(f"🔌 HTTP: {estatisticas_http()}")
+    return {
+        "run_id":       run_id,
+        "dry_run":      dry_run,
+        "divergentes":  totais["divergentes"],
+        "atualizadas":  totais["atualizadas"],
+        "erros":        contagem["erros"],
+        "divergencias": dict(divergencias),
+    }
+
+
+# ------------ Reconciliação pelas páginas da busca ------------ #
+def _triagem_busca(ml_user_id: str):
+    """
+    Compara os pedidos de uma página de /orders/search com o banco, só nas
+    colunas que a busca traz (envio fica de fora). Devolve os pedidos que
+    precisam de /orders/{id} ou /shipments: ausentes no banco, divergentes,
+    incompletos na busca ou com a linha ainda sem dados de envio. Os
+    confirmados pela busca recebem last_verified_at na hora.
+    """
+    from sales import pedido_da_busca_completo
+    from shipments import COLUNAS_ENVIO
+
+    fora = set(COLUNAS_ENVIO) | {"content_hash"}  # o hash da venda parcial nunca bate
+
+    def _triar(db, orders: List[dict]) -> List[dict]:
+        completos, incompletos = [], []
+        for o in orders:
+            (completos if pedido_da_busca_completo(o) else incompletos).append(o)
+        if not completos:
+            return incompletos
+
+        parciais = [
+            _build_sale({"order": o, "shipment": {}, "sla": {}}, ml_user_id, db)
+            for o in completos
+        ]
+        linhas = [{k: v for k, v in _sale_para_linha(v).items() if k not in fora} for v in parciais]
+        banco = _carregar_bloco(db, [int(o["id"]) for o in completos])
+        divergentes, _, _ = diff_colunar(linhas, banco)
+
+        sem_envio = {
+            oid for oid, linha in banco.items()
+            if linha.get("shipping_id") and linha.get("shipment_status") is None
+        }
+        detalhar = divergentes | sem_envio
+        _marcar_verificadas(db, [oid for oid in banco if oid not in detalhar])
+        db.commit()
+        return incompletos + [o for o in completos if int(o["id"]) in detalhar]
+
+    return _triar
+
+
+def _escritor_busca(ml_user_id: str, run_id: str, divergencias: Counter):
+    """Writer da reconciliação por busca: diff completo dos pedidos detalhados (ver `_conferir_vendas`)."""
+
+    def _gravar(db, vendas: List[Sale]) -> Dict[str, int]:
+        res = _conferir_vendas(db, ml_user_id, vendas, divergencias, run_id)
+        return {"novas": res["inseridas"], "atualizadas": res["atualizadas"], "divergentes": res["divergentes"]}
+
+    return _gravar
+
+
+def reconciliar_por_busca(
+    ml_user_id: str,
+    desde: datetime | None = None,
+    ate: datetime | None = None,
+    max_in_flight: int | None = None,
+) -> Dict[str, Any]:
+    """
+    Reconciliação barata: percorre [desde, ate] com páginas de 50 pedidos
+    de /orders/search e compara os dados embutidos com o banco. Só os
+    pedidos que divergem ou faltam campos vão para /orders/{id},
+    /shipments e /sla. Um período limpo custa uma chamada por página em
+    vez de várias por pedido. Mudanças só de envio ficam com o refresher
+    (shipments.py). Datas sem fuso são tratadas como hora de São Paulo,
+    como no banco. Os pedidos conferidos recebem last_verified_at e a
+    execução fica em reconcile_runs/reconcile_diffs como as demais.
+    Retorna {"run_id", "verificados", "divergentes", "atualizadas", "novas",
+    "divergencias", "chamadas_api"}.
+    """
+    from dataclasses import replace
+    from dateutil import tz
+    from ingestion import MAX_IN_FLIGHT, ingerir_vendas, janelas_mensais
+
+    sp = tz.gettz("America/Sao_Paulo")
+    agora = datetime.now(sp)
+    desde = desde or (agora - relativedelta(months=6))
+    ate = ate or agora
+    if desde.tzinfo is None:
+        desde = desde.replace(tzinfo=sp)
+    if ate.tzinfo is None:
+        ate = ate.replace(tzinfo=sp)
+
+    access_token = tokens.obter(ml_user_id)
+    if not access_token:
+        raise RuntimeError(f"Usuário {ml_user_id} não possui token válido.")
+
+    # Janelas mensais recortadas no período pedido
+    janelas = [
+        replace(j, desde=max(j.desde, desde), ate=min(j.ate, ate), somente_busca=True)
+        for j in janelas_mensais(desde, ate)
+    ]
+    divergencias: Counter = Counter()
+    run_id = _iniciar_run(ml_user_id, "reconcile_busca", dry_run=False)
+    try:
+        totais = ingerir_vendas(
+            ml_user_id, access_token, janelas, _escritor_busca(ml_user_id, run_id, divergencias),
+            max_in_flight=max_in_flight or MAX_IN_FLIGHT,
+            renovar_token=lambda rejeitado: tokens.rejeitado(ml_user_id, rejeitado),
+            job="reconcile", triagem=_triagem_busca(ml_user_id),
+        )
+    except Exception as e:
+        _finalizar_run(run_id, Counter(), erro=str(e))
+        raise
+    _finalizar_run(run_id, Counter(totais))
+
+    verificados = totais.get("verificados", 0)
+    detalhados = totais.get("pedidos", 0)
+    logging.info(
+        f"🔎 Reconciliação por busca de {ml_user_id}: {verificados} pedidos verificados, "
+        f"{detalhados} detalhados, {totais.get('divergentes', 0)} divergentes, "
+        f"{totais.get('chamadas_api', 0)} chamadas à API"
+    )
+    if divergencias:
+        logging.info(f"🧮 Divergências por coluna: {dict(divergencias.most_common())}")
+    return {
+        "run_id":       run_id,
+        "verificados":  verificados,
+        "divergentes":  totais.get("divergentes", 0),
+        "atualizadas":  totais.get("atualizadas", 0),
+        "novas":        totais.get("novas", 0),
+        "divergencias": dict(divergencias),
+        "chamadas_api": totais.get("chamadas_api", 0),
+    }
+
+
+# ------------ Verificação contínua com orçamento ------------ #
+_SQL_PRIORIDADE = text("""
+    SELECT order_id
+    FROM sales
+    WHERE ml_user_id = :uid
+      AND (last_verified_at IS NULL OR last_verified_at < now() - make_interval(secs => :reverificar))
+    ORDER BY (
+          CASE WHEN date_closed >= (now() AT TIME ZONE 'America/Sao_Paulo') - make_interval(days => :recente)
+               THEN :p_recente ELSE 0 END
+        + CASE WHEN status IS NULL OR status <> ALL(:status_finais) THEN :p_status ELSE 0 END
+        + CASE WHEN shipping_id IS NOT NULL
+                AND (shipment_status IS NULL OR shipment_status = ANY(:envio_ativos))
+               THEN :p_envio ELSE 0 END
+        + CASE WHEN ml_fee IS NULL THEN :p_fee ELSE 0 END
+        + CASE WHEN seller_sku IS NULL OR custo_unitario IS NULL THEN :p_sku ELSE 0 END
+        + :p_idade * least(1.0, coalesce(
+              extract(epoch FROM now() - last_verified_at) / 86400.0 / :ciclo, 1.0))
+    ) DESC, last_verified_at ASC NULLS FIRST, date_closed DESC
+    LIMIT :limite
+""")
+
+_SQL_GASTO_HORA = text("""
+    SELECT coalesce(sum(chamadas), 0)
+    FROM ml_api_ledger
+    WHERE hora = date_trunc('hour', now() AT TIME ZONE 'utc')
+      AND job = :job AND ml_user_id = :uid
+""")
+
+
+def _orcamento_conta(db, ml_user_id: str, orcamento: Optional[int]) -> int:
+    """Chamadas que a conta ainda pode gastar nesta hora (cota = orçamento / contas)."""
+    if orcamento is None:
+        contas = db.execute(text("SELECT count(*) FROM user_tokens")).scalar() or 1
+        orcamento = ORCAMENTO_HORA // contas
+    # Jobs "verify" da mesma conta nunca rodam juntos (uq_sync_jobs_executando)
+    # e cada rodada descarrega o ledger ao terminar: o gasto lido é completo
+    ledger.flush()  # o que este processo já gastou e ainda não foi gravado
+    gasto = db.execute(_SQL_GASTO_HORA, {"job": JOB_VERIFICACAO, "uid": int(ml_user_id)}).scalar()
+    return max(0, orcamento - int(gasto))
+
+
+_PULADO = object()  # sentinela: pedido não buscado por falta de cota
+
+
+def verificar_por_risco(
+    ml_user_id: str,
+    orcamento: Optional[int] = None,
+    max_workers: int = MAX_WORKERS,
+) -> Dict[str, Any]:
+    """
+    Verificação contínua: gasta no máximo a cota da hora (ORCAMENTO_HORA
+    dividido entre as contas, ou `orcamento`) conferindo com a API as vendas
+    com maior risco de divergência: recentes, status ou envio não finais,
+    sem ml_fee, sem SKU e há mais tempo sem verificação. Cada venda
+    conferida recebe last_verified_at, então, rodada após rodada, todo o
+    histórico volta a ser verificado.
+    Cada requisição (repetições e fallback de payments incluídos) é cobrada
+    da cota antes de sair, então a rodada não passa do orçamento;
+    `max_workers` vem do limite de concorrência do worker.
+    Retorna {"orcamento", "verificadas", "atualizadas", "erros", "puladas", "chamadas_api", "divergencias"}.
+    """
+    from shipments import STATUS_ATIVOS
+
+    db = SessionLocal()
+    totais: Counter = Counter()
+    divergencias: Counter = Counter()
+    erros = pulados = 0
+    run_id = None
+    try:
+        restante = _orcamento_conta(db, ml_user_id, orcamento)
+        cota = Orcamento(restante)
+        cache = RunCache(conta=ml_user_id, job=JOB_VERIFICACAO, orcamento=cota)
+        limite = restante // CHAMADAS_POR_PEDIDO
+        if not limite:
+            logging.info(f"💤 Verificação de {ml_user_id}: orçamento da hora esgotado")
+            return {"orcamento": restante, "verificadas": 0, "atualizadas": 0, "erros": 0,
+                    "puladas": 0, "chamadas_api": 0, "divergencias": {}}
+        if not tokens.obter(ml_user_id):
+            raise RuntimeError(f"Usuário {ml_user_id} não possui token válido.")
+
+        ids = [row[0] for row in db.execute(_SQL_PRIORIDADE, {
+            "uid":           int(ml_user_id),
+            "reverificar":   REVERIFICAR_APOS.total_seconds(),
+            "recente":       RECENTE_DIAS,
+            "ciclo":         CICLO_DIAS,
+            "status_finais": list(STATUS_FINAIS),
+            "envio_ativos":  list(STATUS_ATIVOS),
+            "limite":        limite,
+            **{f"p_{sinal}": peso for sinal, peso in PESOS_RISCO.items()},
+        })]
+        db.commit()  # não segura a transação de leitura durante os GETs
+        catalogo_sku.atualizar(db, imediato=True)
+        run_id = _iniciar_run(ml_user_id, JOB_VERIFICACAO, dry_run=False)
+
+        def _buscar(oid: int) -> dict | None:
+            # Pedidos que não cabem mais na cota ficam para a próxima hora
+            if cota.esgotado:
+                return _PULADO
+            bundle = _fetch_bundle(str(oid), ml_user_id, cache)
+            # Alguma requisição pode ter sido negada no meio do pedido: o
+            # bundle pode estar incompleto e não é gravado
+            return _PULADO if cota.esgotado else bundle
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for i in range(0, len(ids), LOTE_VERIFICACAO):
+                if cota.esgotado:
+                    pulados += len(ids) - i
+                    break
+                lote = ids[i:i + LOTE_VERIFICACAO]
+                bundles = list(executor.map(_buscar, lote))
+                pulados += sum(1 for b in bundles if b is _PULADO)
+                itens = [(b, _build_sale(b, ml_user_id, db)) for b in bundles if b is not None and b is not _PULADO]
+                erros += sum(1 for b in bundles if b is None)
+                if itens:
+                    _gravar_bloco(db, ml_user_id, itens, totais, divergencias, run_id)
+        _finalizar_run(run_id, totais)
+    except Exception as e:
+        db.rollback()
+        if run_id:
+            _finalizar_run(run_id, totais, erro=str(e))
+        raise RuntimeError(f"❌ Erro na verificação de {ml_user_id}: {e}") from e
+    finally:
+        db.close()
+        ledger.flush()
+
+    logging.info(
+        f"🎯 Verificação de {ml_user_id}: {totais['verificados']} vendas conferidas, "
+        f"{totais['atualizadas']} corrigidas, {erros} erros, {pulados} para a próxima hora, "
+        f"{restante - cota.restante}/{restante} chamadas da cota"
+    )
+    return {
+        "orcamento":    restante,
+        "verificadas":  totais["verificados"],
+        "atualizadas":  totais["atualizadas"],
+        "erros":        erros,
+        "puladas":      pulados,
+        "chamadas_api": cache.total_chamadas,
+        "divergencias": dict(divergencias),
+    }
+
 
-    return {"atualizadas": atualizadas, "erros": erros}
+def cobertura(db, ml_user_id: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Vendas por conta: total, nunca verificadas, verificadas no último ciclo e a verificação mais antiga."""
+    linhas = db.execute(text("""
+        SELECT ml_user_id,
+               count(*)                                     AS vendas,
+               count(*) FILTER (WHERE last_verified_at IS NULL) AS nunca,
+               count(*) FILTER (WHERE last_verified_at >= now() - make_interval(days => :ciclo)) AS no_ciclo,
+               min(last_verified_at)                        AS mais_antiga
+        FROM sales
+        WHERE (:uid IS NULL OR ml_user_id = :uid)
+        GROUP BY ml_user_id
+        ORDER BY ml_user_id
+    """), {"ciclo": CICLO_DIAS, "uid": int(ml_user_id) if ml_user_id else None}).mappings()
+    return [
+        {**l, "cobertura_pct": round(100 * l["no_ciclo"] / l["vendas"], 1) if l["vendas"] else None}
+        for l in linhas
+    ]
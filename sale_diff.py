@@ -0,0 +1,133 @@
+# sale_diff.py – comparação coluna a coluna entre a API e as linhas de `sales`
+#
+# Sem acesso ao banco: recebe as linhas montadas por `_build_sale` e as
+# linhas já lidas de `sales`, e diz quais pedidos divergem e em que colunas.
+from __future__ import annotations
+
+from collections import Counter
+from datetime import datetime
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from dateutil import tz
+from sqlalchemy import DateTime, Float, Integer, Numeric, String
+
+from models import Sale
+
+_SP = tz.gettz("America/Sao_Paulo")
+_TIPOS = {c.name: c.type for c in Sale.__table__.columns}
+
+# (order_id, coluna, valor do banco, valor da API), já normalizados
+Celula = Tuple[int, str, Any, Any]
+
+
+def normalizar(valor: Any) -> Any:
+    """Forma canônica usada no hash e no diff: strings sem espaços, números arredondados, datas em UTC."""
+    if valor is None or isinstance(valor, bool):
+        return valor
+    if isinstance(valor, str):
+        return valor.strip()
+    if isinstance(valor, (int, float, Decimal)):
+        return str(round(float(valor), 4))
+    if isinstance(valor, datetime):
+        if valor.tzinfo is not None:
+            valor = valor.astimezone(tz.tzutc())
+        return valor.isoformat()
+    return str(valor)
+
+
+def coagir(coluna: str, valor: Any) -> Any:
+    """
+    Valor vindo da API convertido para o que a coluna guarda (e o banco
+    devolve): int em varchar vira str, Numeric é arredondado na escala da
+    coluna e DateTime sem fuso fica na hora local de São Paulo.
+    """
+    tipo = _TIPOS.get(coluna)
+    if valor is None or tipo is None:
+        return valor
+    try:
+        if isinstance(tipo, String):
+            return str(valor)
+        if isinstance(tipo, Float):  # Float é subclasse de Numeric
+            return float(valor)
+        if isinstance(tipo, Numeric):
+            if tipo.scale is None:
+                return Decimal(str(valor))
+            return Decimal(str(valor)).quantize(Decimal(1).scaleb(-tipo.scale), rounding=ROUND_HALF_UP)
+        if isinstance(tipo, Integer):
+            return int(valor)
+        if isinstance(tipo, DateTime) and isinstance(valor, datetime):
+            if not tipo.timezone and valor.tzinfo is not None:
+                return valor.astimezone(_SP).replace(tzinfo=None)
+    except (TypeError, ValueError, InvalidOperation):
+        pass
+    return valor
+
+
+def valor_api(coluna: str, valor: Any) -> Any:
+    return normalizar(coagir(coluna, valor))
+
+
+def _valor_banco(valor: Any) -> Any:
+    # NaN só aparece nas linhas que o reindex criou (pedido ausente no banco)
+    if valor is None or (isinstance(valor, float) and valor != valor):
+        return None
+    return normalizar(valor)
+
+
+def diff_colunar(
+    api_linhas: List[Dict[str, Any]],
+    banco: Dict[int, Dict[str, Any]],
+    celulas: Optional[List[Celula]] = None,
+) -> Tuple[Set[int], Set[int], Counter]:
+    """
+    Compara API × banco coluna a coluna sobre o bloco inteiro (pandas).
+    Linhas cujo content_hash gravado é igual ao da API nem entram no diff.
+    Retorna (divergentes, só_hash, divergências por coluna): `só_hash` são
+    linhas iguais cujo content_hash gravado está desatualizado. Com
+    `celulas`, cada coluna divergente entra na lista como
+    (order_id, coluna, valor do banco, valor da API), já normalizados.
+    """
+    import pandas as pd
+
+    if not api_linhas:
+        return set(), set(), Counter()
+
+    # dtype=object: sem inferência do pandas (None não vira NaN/NaT), os
+    # valores chegam a `coagir` como o Python os entregou
+    api = pd.DataFrame(api_linhas, dtype=object)
+    api.index = pd.Index([int(oid) for oid in api["order_id"]])
+    atual = pd.DataFrame.from_dict(banco, orient="index", dtype=object).reindex(api.index)
+    colunas = [c for c in api.columns if c not in ("order_id", "content_hash")]
+
+    existe = atual["order_id"].notna() if "order_id" in atual else pd.Series(False, index=api.index)
+    if "content_hash" in atual and "content_hash" in api:
+        mesmo_hash = existe & api["content_hash"].notna() & (api["content_hash"] == atual["content_hash"])
+    else:
+        mesmo_hash = pd.Series(False, index=api.index)
+
+    # Pedido que sumiu do banco no meio do caminho: reescreve
+    divergentes: Set[int] = {int(oid) for oid in api.index[(~existe).to_numpy()]}
+    por_coluna: Counter = Counter()
+    alvo = api.index[(~mesmo_hash).to_numpy()]
+    if len(alvo):
+        api_alvo, atual_alvo = api.loc[alvo], atual.loc[alvo]
+        for c in colunas:
+            a = api_alvo[c].map(lambda v, c=c: valor_api(c, v))
+            b = (
+                atual_alvo[c].map(_valor_banco) if c in atual_alvo
+                else pd.Series([None] * len(alvo), index=alvo, dtype=object)
+            )
+            diff = ~((a == b) | (a.isna() & b.isna()))
+            if c == "ml_fee":
+                diff &= a.notna()  # upsert preserva fee do backfill quando a API não traz
+            marcados = alvo[diff.to_numpy()]
+            if not len(marcados):
+                continue
+            por_coluna[c] = len(marcados)
+            divergentes.update(int(oid) for oid in marcados)
+            if celulas is not None:
+                celulas.extend((int(oid), c, b.at[oid], a.at[oid]) for oid in marcados)
+
+    hash_velho = {int(oid) for oid in api.index[(existe & ~mesmo_hash).to_numpy()]}
+    return divergentes, hash_velho - divergentes, por_coluna
@@ -1,16 +1,14 @@
 import os
-import requests
 from dateutil import parser
 from db import SessionLocal
 from models import Sale
-from sqlalchemy import func, text, create_engine
+from sku_cache import catalogo_sku
+from sale_diff import normalizar
+from ml_api import API_ROOT
+from sqlalchemy import func
 from dotenv import load_dotenv
 from dateutil.tz import tzutc
-from requests.exceptions import HTTPError
-from datetime import datetime
-from concurrent.futures import ThreadPoolExecutor
-from typing import Dict, List, Tuple, Optional
-import time
+from typing import Any, Dict, List, Optional
 
 
 
@@ -18,342 +16,365 @@ import time
 load_dotenv()
 BACKEND_URL = os.getenv("BACKEND_URL")
 
-API_BASE = "https://api.mercadolibre.com/orders/search"
+API_BASE = f"{API_ROOT}/orders/search"
 FULL_PAGE_SIZE = 50
 
-def get_incremental_sales(ml_user_id: str, access_token: str) -> int:
-    from sales import get_full_sales, _order_to_sale
-    import os
-    from concurrent.futures import ThreadPoolExecutor
-    from utils import buscar_ml_fee, engine, DATA_INICIO
-
-
-    API_BASE = "https://api.mercadolibre.com/orders/search"
-    FULL_PAGE_SIZE = 50
-    BACKEND_URL = os.getenv("BACKEND_URL")
+def get_incremental_sales(ml_user_id: str, access_token: str, max_in_flight: Optional[int] = None) -> int:
+    from sales import get_full_sales, upsert_vendas
+    from fees import preencher_fees
+    from ingestion import Janela, ingerir_vendas, MAX_IN_FLIGHT
+    from ml_api import RunCache
+    from sync_state import marca_inicial, iniciar_execucao, avancar_marca
+    from oauth import tokens
 
     db = SessionLocal()
     total_saved = 0
 
+    def _renovar_token(rejeitado: str) -> Optional[str]:
+        print(f"🔐 Token expirado para {ml_user_id}, tentando renovar...")
+        new_token = tokens.rejeitado(ml_user_id, rejeitado)
+        if not new_token:
+            raise RuntimeError("Falha ao obter novo access_token após refresh")
+        return new_token
+
     try:
-        # 🔁 Tenta renovar token inicialmente
-        try:
-            r = requests.post(f"{BACKEND_URL}/auth/refresh", json={"user_id": ml_user_id})
-            r.raise_for_status()
-            new_token = db.execute(
-                text("SELECT access_token FROM user_tokens WHERE ml_user_id = :uid"),
-                {"uid": ml_user_id}
-            ).scalar()
-            if new_token:
-                access_token = new_token
-        except Exception as e:
-            print(f"⚠️ Falha ao renovar token ({ml_user_id}): {e}")
-
-        # Busca a data da última venda registrada
-        last_db_date = db.query(func.max(Sale.date_closed)).filter(Sale.ml_user_id == int(ml_user_id)).scalar()
-        if last_db_date is None:
-            return get_full_sales(ml_user_id, access_token)
-
-        if last_db_date.tzinfo is None:
-            last_db_date = last_db_date.replace(tzinfo=tzutc())
-
-        # Requisição inicial
-        params = {
-            "seller": ml_user_id,
-            "limit": FULL_PAGE_SIZE,
-            "sort": "date_desc",
-            "order.date_closed.from": last_db_date.isoformat(),
-        }
-        headers = {"Authorization": f"Bearer {access_token}"}
-
-        try:
-            resp = requests.get(API_BASE, params=params, headers=headers)
-            resp.raise_for_status()
-        except HTTPError as http_err:
-            if resp.status_code == 401:
-                print(f"🔐 Token expirado para {ml_user_id}, tentando renovar...")
-                r2 = requests.post(f"{BACKEND_URL}/auth/refresh", json={"user_id": ml_user_id})
-                r2.raise_for_status()
-                new_token = db.execute(
-                    text("SELECT access_token FROM user_tokens WHERE ml_user_id = :uid"),
-                    {"uid": ml_user_id}
-                ).scalar()
-                if not new_token:
-                    raise RuntimeError("Falha ao obter novo access_token após refresh")
-                access_token = new_token
-                headers["Authorization"] = f"Bearer {access_token}"
-                resp = requests.get(API_BASE, params=params, headers=headers)
-                resp.raise_for_status()
-            else:
-                raise
-
-        orders = resp.json().get("results", [])
-        if not orders:
+        # 🔁 Token em cache; só renova se estiver perto de expirar
+        access_token = tokens.obter(ml_user_id) or access_token
+
+        # Marca d'água persistida (com janela de sobreposição)
+        desde = marca_inicial(db, ml_user_id)
+        if desde is None:
+            return get_full_sales(ml_user_id, access_token, max_in_flight=max_in_flight)
+
+        iniciar_execucao(db, ml_user_id)
+
+        # Pedidos da busca cujo detalhe falhou: a marca não passa deles
+        falhas: List[Dict[str, Any]] = []
+
+        def _gravar_e_avancar(db_pagina, vendas: List[Sale]) -> Dict[str, int]:
+            res = upsert_vendas(db_pagina, vendas, commit=False)
+            avancar_marca(db_pagina, ml_user_id, vendas, falhas)
+            db_pagina.commit()
+            return {"pedidos_lidos": len(vendas), **res}
+
+        # Pagina até esgotar, em ordem crescente, a partir da marca
+        janela = Janela(desde=desde, sort="date_asc")
+        cache = RunCache(conta=ml_user_id, job="incremental")
+        totais = ingerir_vendas(
+            ml_user_id, access_token, [janela], _gravar_e_avancar,
+            max_in_flight=max_in_flight or MAX_IN_FLIGHT, renovar_token=_renovar_token,
+            cache=cache, job="incremental", paralelo=False,  # em ordem: a marca só avança
+            falhas=falhas,
+        )
+        total_saved = totais.get("inseridas", 0) + totais.get("atualizadas", 0)
+        print(
+            f"📈 Incremental {ml_user_id}: {totais.get('pedidos_lidos', 0)} lidos desde {desde.isoformat()}, "
+            f"{totais.get('inseridas', 0)} novas, {totais.get('atualizadas', 0)} atualizadas"
+        )
+        if not totais.get("pedidos_lidos"):
             return 0
 
-        for o in orders:
-            oid = str(o["id"])
-            existing_sale = db.query(Sale).filter_by(order_id=oid).first()
+        # ✅ Atualização complementar das taxas, reaproveitando o cache da execução
+        print(f"\n📊 Iniciando atualização de taxas pendentes para usuário {ml_user_id}...")
+        preencher_fees(ml_user_id, tokens.obter(ml_user_id) or access_token, cache=cache)
+
+    except Exception as e:
+        db.rollback()
+        raise RuntimeError(f"❌ Erro no incremental: {e}")
+    finally:
+        db.close()
+
+    return total_saved
 
-            full_resp = requests.get(f"https://api.mercadolibre.com/orders/{oid}?access_token={access_token}")
-            if not full_resp.ok:
-                print(f"⚠️ Falha ao buscar ordem completa {oid}: {full_resp.status_code}")
-                continue
 
-            full_order = full_resp.json()
-            nova_venda = _order_to_sale(full_order, ml_user_id, access_token, db)
+def _to_sp_datetime(value: Optional[str]):
+    from dateutil import tz
+    if not value:
+        return None
+    return parser.isoparse(value).astimezone(tz.gettz("America/Sao_Paulo"))
 
-            print(f"📦 Incremental - ordem {oid} processada | ml_fee: {nova_venda.ml_fee}")
 
-            if not existing_sale:
-                db.add(nova_venda)
-            else:
-                for attr, value in nova_venda.__dict__.items():
-                    if attr != "_sa_instance_state":
-                        setattr(existing_sale, attr, value)
+# Campos de /orders/search suficientes para montar o Sale sem /orders/{id}
+CAMPOS_BUSCA = ("order_items", "payments", "buyer", "total_amount", "date_closed", "status")
 
-            total_saved += 1
 
-        db.commit()
+def pedido_da_busca_completo(order: dict) -> bool:
+    """True se o resultado da busca já traz tudo o que `_build_sale` usa."""
+    if any(order.get(campo) is None for campo in CAMPOS_BUSCA):
+        return False
+    if not order["order_items"]:
+        return False
+    return "id" in (order.get("shipping") or {})
 
-        # ✅ Atualização complementar das taxas
-        print(f"\n📊 Iniciando atualização de taxas pendentes para usuário {ml_user_id}...")
 
-        with engine.begin() as conn:
-            pedidos = conn.execute(text("""
-                SELECT order_id FROM sales
-                WHERE ml_user_id = :uid AND ml_fee IS NULL AND date_closed >= :inicio
-            """), {"uid": ml_user_id, "inicio": DATA_INICIO}).fetchall()
+def enriquecer_pedido(order: dict, access_token: str, cache=None) -> Dict[str, Any]:
+    """
+    Completa um pedido já baixado de /orders/{id} com payments (fallback),
+    shipment e SLA. Nunca busca o pedido de novo; as respostas passam
+    pelo `RunCache` da execução quando informado.
+    """
+    from ml_api import API_ROOT, get_json
+
+    order_id = order.get("id")
 
-        pedidos_ids = [row[0] for row in pedidos]
-        if not pedidos_ids:
-            print(f"📭 Nenhuma venda pendente para atualizar fees de {ml_user_id}.")
+    # 🔍 Fallback para buscar payments
+    if not order.get("payments"):
+        payments = get_json(f"{API_ROOT}/orders/{order_id}/payments", access_token, cache=cache)
+        if isinstance(payments, list) and payments:
+            order["payments"] = payments
+            print(f"💳 Payments recuperados separadamente para {order_id}")
         else:
-            print(f"📦 {len(pedidos_ids)} vendas sem fee. Atualizando com até 10 threads...")
-            with ThreadPoolExecutor(max_workers=10) as executor:
-                resultados = list(executor.map(lambda oid: buscar_ml_fee(oid, access_token), pedidos_ids))
-
-            with engine.begin() as conn:
-                atualizadas = 0
-                for i, (order_id, fee) in enumerate(resultados, 1):
-                    if fee is not None:
-                        conn.execute(text("""
-                            UPDATE sales SET ml_fee = :fee WHERE order_id = :oid
-                        """), {"fee": fee, "oid": order_id})
-                        atualizadas += 1
-                        print(f"💾 Atualizado {i}/{len(pedidos_ids)} | Pedido {order_id} | Fee R${fee}")
-                    else:
-                        print(f"⏭️ Pulado {i}/{len(pedidos_ids)} | Pedido {order_id} sem fee.")
-
-            print(f"✅ Atualização de fees concluída: {atualizadas}/{len(pedidos_ids)} vendas.")
+            print(f"⚠️ Nenhum payment encontrado para {order_id}")
 
-    except Exception as e:
-        db.rollback()
-        raise RuntimeError(f"❌ Erro no incremental: {e}")
-    finally:
-        db.close()
+    # 📦 Shipment enrichment
+    shipment_id = (order.get("shipping") or {}).get("id")
+    shipment_data = {}
+    sla_data = {}
 
-    return total_saved
+    if shipment_id:
+        shipment_data = get_json(f"{API_ROOT}/shipments/{shipment_id}", access_token, cache=cache) or {}
+        if shipment_data:
+            sla_data = get_json(f"{API_ROOT}/shipments/{shipment_id}/sla", access_token, cache=cache) or {}
+        else:
+            print(f"⚠️ Falha ao buscar shipment {shipment_id}")
 
+    return {"order": order, "shipment": shipment_data, "sla": sla_data}
 
-def _order_to_sale(order: dict, ml_user_id: str, access_token: str, db: Optional[SessionLocal] = None) -> Sale:
-    from sqlalchemy import text
-    from dateutil import parser, tz
-    def to_sp_datetime(value: Optional[str]):
-        if not value:
-            return None
-        return parser.isoparse(value).astimezone(tz.gettz("America/Sao_Paulo"))
 
+def _order_to_sale(order: dict, ml_user_id: str, access_token: str, db: Optional[SessionLocal] = None, cache=None) -> Sale:
+    """
+    Converte um pedido completo (payload de /orders/{id}) em `Sale`,
+    buscando apenas payments/shipment/SLA que ainda faltam.
+    """
     internal_session = False
     if db is None:
         db = SessionLocal()
         internal_session = True
 
     try:
-        order_id = order.get("id")
-
-        # 🔄 Garante dados completos da ordem
-        try:
-            resp = requests.get(
-                f"https://api.mercadolibre.com/orders/{order_id}?access_token={access_token}"
-            )
-            resp.raise_for_status()
-            order = resp.json()
-            print(f"📦 Order {order_id} complementada com dados completos")
-        except Exception as e:
-            print(f"⚠️ Erro ao complementar order {order_id}: {e}")
-
-        # 🔍 Fallback para buscar payments
-        payments = order.get("payments")
-        if not payments:
-            try:
-                pay_resp = requests.get(
-                    f"https://api.mercadolibre.com/orders/{order_id}/payments?access_token={access_token}"
-                )
-                pay_resp.raise_for_status()
-                payments = pay_resp.json()
-                if isinstance(payments, list) and payments:
-                    order["payments"] = payments
-                    print(f"💳 Payments recuperados separadamente para {order_id}")
-                else:
-                    print(f"⚠️ Nenhum payment encontrado para {order_id}")
-            except Exception as e:
-                print(f"❌ Erro ao buscar payments em fallback: {e}")
-
-        buyer = order.get("buyer", {}) or {}
-        ship = order.get("shipping") or {}
-        
-        # Novo tratamento para order_items com múltiplos formatos e seller_sku
-        order_items = order.get("order_items", [])
-        seller_sku = None
-        item_inf = {}
-        quantity = None
-        unit_price = None
-        
-        for it in order_items:
-            itm = it.get("item", {}) or {}
-        
-            # tenta pegar o SKU direto
-            sku = itm.get("seller_sku") or itm.get("seller_custom_field")
-
-        
-            # se não tiver, tenta buscar dentro de variation_attributes
-            if not sku:
-                for attr in it.get("variation_attributes", []):
-                    if attr.get("name", "").upper() in {"SELLER_SKU", "SELLER_CUSTOM_FIELD"}:
-                        sku = attr.get("value") or attr.get("value_name")
-                        break
-        
-            if sku:
-                seller_sku = sku
-                item_inf = itm
-                quantity = it.get("quantity")
-                unit_price = it.get("unit_price")
-                break  # achou → sai do loop
-        
-        # fallback: se não achou nenhum item com SKU, tenta o primeiro
-        if not item_inf and order_items:
-            item_inf = order_items[0].get("item", {})
-            quantity = order_items[0].get("quantity")
-            unit_price = order_items[0].get("unit_price")
-        
-        quantity_sku = custo_unitario = level1 = level2 = None
-
-
-        if seller_sku:
-            sku_info = db.execute(text("""
-                SELECT quantity, custo_unitario, level1, level2
-                FROM sku
-                WHERE sku = :sku
-                ORDER BY date_created DESC
-                LIMIT 1
-            """), {"sku": seller_sku}).fetchone()
-
-            if sku_info:
-                quantity_sku, custo_unitario, level1, level2 = sku_info
-
-        payment_info = (order.get("payments") or [{}])[0]
-        payment_id = payment_info.get("id")
-        marketplace_fee = payment_info.get("marketplace_fee")
-
-        # 📦 Shipment enrichment
-        shipment_id = ship.get("id")
-        shipment_data = {}
-        shipment_delivery_sla = None  
-        order_cost = None
-        base_cost = None
-        shipment_cost = None
-
-        if shipment_id:
-            try:
-                shipment_resp = requests.get(
-                    f"https://api.mercadolibre.com/shipments/{shipment_id}?access_token={access_token}"
-                )
-                shipment_resp.raise_for_status()
-                shipment_data = shipment_resp.json()
-                order_cost    = shipment_data.get("order_cost")
-                base_cost     = shipment_data.get("base_cost")
-                shipment_cost = shipment_data.get("shipping_option", {}).get("cost")
-                print(f"📮 Dados logísticos carregados para order {order_id}")
-
-                try:
-                    sla_resp = requests.get(
-                        f"https://api.mercadolibre.com/shipments/{shipment_id}/sla",
-                        headers={"Authorization": f"Bearer {access_token}"}
-                    )
-                    if sla_resp.ok:
-                        sla_data = sla_resp.json()
-                        shipment_delivery_sla_raw = sla_data.get("expected_date")
-                        print(f"📦 SLA bruto retornado: {sla_data}")
-                        print(f"📅 SLA estimado: {shipment_delivery_sla_raw}")
-                        shipment_delivery_sla = to_sp_datetime(shipment_delivery_sla_raw)
-                    else:
-                        print(f"⚠️ SLA não disponível para shipment {shipment_id}: {sla_resp.status_code}")
-                except Exception as e:
-                    print(f"❌ Erro ao buscar SLA de shipment {shipment_id}: {e}")
-
-
-            except Exception as e:
-                print(f"⚠️ Falha ao buscar shipment {shipment_id}: {e}")
-
-        
-        print(f"✅ shipment_delivery_sla final (já convertido): {shipment_delivery_sla}")
-        return Sale(
-            order_id         = str(order_id),
-            ml_user_id       = int(ml_user_id),
-            buyer_id         = buyer.get("id"),
-            buyer_nickname   = buyer.get("nickname"),
-            total_amount     = order.get("total_amount"),
-            status = order.get("status"),
-            date_closed      = to_sp_datetime(order.get("date_closed")),
-            item_id          = item_inf.get("id"),
-            item_title       = item_inf.get("title"),
-            quantity         = quantity,
-            unit_price       = unit_price,
-            shipping_id      = shipment_id,
-            seller_sku       = seller_sku,
-            quantity_sku     = quantity_sku,
-            custo_unitario   = custo_unitario,
-            level1           = level1,
-            level2           = level2,
-            ml_fee           = marketplace_fee,
-            payment_id       = payment_id,
-            
-
-            # 🆕 Dados de envio
-            shipment_status             = shipment_data.get("status"),
-            shipment_substatus          = shipment_data.get("substatus"),
-            shipment_last_updated       = to_sp_datetime(shipment_data.get("last_updated")),
-            shipment_mode               = shipment_data.get("mode"),
-            shipment_logistic_type      = shipment_data.get("logistic_type"),
-            shipment_list_cost          = shipment_data.get("shipping_option", {}).get("list_cost"),
-            shipment_delivery_type      = shipment_data.get("shipping_option", {}).get("delivery_type"),
-            shipment_receiver_name      = shipment_data.get("receiver_address", {}).get("receiver_name"),
-            order_cost    = order_cost,
-            base_cost     = base_cost,
-            shipment_cost = shipment_cost,
-            shipment_delivery_sla = shipment_delivery_sla
-        )
-
+        return _build_sale(enriquecer_pedido(order, access_token, cache), ml_user_id, db)
     finally:
         if internal_session:
             db.close()
 
 
+def _build_sale(bundle: Dict[str, Any], ml_user_id: str, db) -> Sale:
+    """
+    Monta o `Sale` a partir dos payloads já baixados
+    ({"order", "shipment", "sla"}), sem nenhuma chamada à API.
+    """
+    order = bundle.get("order") or {}
+    shipment_data = bundle.get("shipment") or {}
+    sla_data = bundle.get("sla") or {}
+
+    order_id = order.get("id")
+    buyer = order.get("buyer", {}) or {}
+    ship = order.get("shipping") or {}
+
+    # Novo tratamento para order_items com múltiplos formatos e seller_sku
+    order_items = order.get("order_items", [])
+    seller_sku = None
+    item_inf = {}
+    quantity = None
+    unit_price = None
+
+    for it in order_items:
+        itm = it.get("item", {}) or {}
+
+        # tenta pegar o SKU direto
+        sku = itm.get("seller_sku") or itm.get("seller_custom_field")
+
+
+        # se não tiver, tenta buscar dentro de variation_attributes
+        if not sku:
+            for attr in it.get("variation_attributes", []):
+                if attr.get("name", "").upper() in {"SELLER_SKU", "SELLER_CUSTOM_FIELD"}:
+                    sku = attr.get("value") or attr.get("value_name")
+                    break
+
+        if sku:
+            seller_sku = sku
+            item_inf = itm
+            quantity = it.get("quantity")
+            unit_price = it.get("unit_price")
+            break  # achou → sai do loop
+
+    # fallback: se não achou nenhum item com SKU, tenta o primeiro
+    if not item_inf and order_items:
+        item_inf = order_items[0].get("item", {})
+        quantity = order_items[0].get("quantity")
+        unit_price = order_items[0].get("unit_price")
+
+    quantity_sku = custo_unitario = level1 = level2 = None
+
+
+    if seller_sku:
+        sku_info = catalogo_sku.buscar(db, seller_sku)
+        if sku_info:
+            quantity_sku, custo_unitario, level1, level2 = sku_info
+
+    payment_info = (order.get("payments") or [{}])[0]
+    payment_id = payment_info.get("id")
+    marketplace_fee = payment_info.get("marketplace_fee")
+
+    venda = Sale(
+        order_id         = str(order_id),
+        ml_user_id       = int(ml_user_id),
+        buyer_id         = buyer.get("id"),
+        buyer_nickname   = buyer.get("nickname"),
+        total_amount     = order.get("total_amount"),
+        status = order.get("status"),
+        date_closed      = _to_sp_datetime(order.get("date_closed")),
+        item_id          = item_inf.get("id"),
+        item_title       = item_inf.get("title"),
+        quantity         = quantity,
+        unit_price       = unit_price,
+        shipping_id      = ship.get("id"),
+        seller_sku       = seller_sku,
+        quantity_sku     = quantity_sku,
+        custo_unitario   = custo_unitario,
+        level1           = level1,
+        level2           = level2,
+        ml_fee           = marketplace_fee,
+        payment_id       = payment_id,
+
+        # 🆕 Dados de envio
+        **campos_envio(shipment_data, sla_data),
+    )
+    venda.content_hash = hash_venda(_sale_para_linha(venda))
+    return venda
+
+
+def campos_envio(shipment_data: Dict[str, Any], sla_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Colunas de `sales` que vêm de /shipments/{id} e /shipments/{id}/sla."""
+    shipping_option = shipment_data.get("shipping_option") or {}
+    return {
+        "shipment_status":        shipment_data.get("status"),
+        "shipment_substatus":     shipment_data.get("substatus"),
+        "shipment_last_updated":  _to_sp_datetime(shipment_data.get("last_updated")),
+        "shipment_mode":          shipment_data.get("mode"),
+        "shipment_logistic_type": shipment_data.get("logistic_type"),
+        "shipment_list_cost":     shipping_option.get("list_cost"),
+        "shipment_delivery_type": shipping_option.get("delivery_type"),
+        "shipment_receiver_name": (shipment_data.get("receiver_address") or {}).get("receiver_name"),
+        "order_cost":             shipment_data.get("order_cost"),
+        "base_cost":              shipment_data.get("base_cost"),
+        "shipment_cost":          shipping_option.get("cost"),
+        "shipment_delivery_sla":  _to_sp_datetime(sla_data.get("expected_date")),
+    }
+
+
+def _sale_para_linha(sale: Sale) -> Dict[str, Any]:
+    """Só as colunas preenchidas por `_build_sale` (ex.: `ads` fica de fora)."""
+    return {k: v for k, v in vars(sale).items() if not k.startswith("_")}
+
+
+def hash_venda(linha: Dict[str, Any]) -> str:
+    """
+    Impressão digital dos campos que `_build_sale` produz, já normalizados
+    (strings sem espaços, números arredondados, datas em UTC).
+    """
+    import hashlib
+    import json
+
+    normalizada = {k: normalizar(v) for k, v in linha.items() if k != "content_hash"}
+    bruto = json.dumps(normalizada, sort_keys=True, separators=(",", ":"))
+    return hashlib.blake2b(bruto.encode(), digest_size=16).hexdigest()
+
+
+def upsert_vendas(db, vendas: List[Sale], commit: bool = True, pular_iguais: bool = True) -> Dict[str, int]:
+    """
+    Grava um lote inteiro com um único INSERT ... ON CONFLICT (order_id)
+    DO UPDATE. Com `pular_iguais`, pedidos cujo content_hash bate com o do
+    banco nem entram no comando; entre os demais, linhas idênticas às do
+    banco não são reescritas.
+    Retorna {"inseridas", "atualizadas", "inalteradas", "puladas_hash"}.
+    """
+    from sqlalchemy import literal_column, or_, select
+    from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+    # Um mesmo order_id não pode aparecer duas vezes no mesmo comando
+    linhas = list({str(v.order_id): _sale_para_linha(v) for v in vendas}.values())
+    total = len(linhas)
+    tabela = Sale.__table__
+
+    puladas = 0
+    if pular_iguais and linhas:
+        ids = [int(l["order_id"]) for l in linhas]
+        hashes = dict(db.execute(
+            select(tabela.c.order_id, tabela.c.content_hash).where(tabela.c.order_id.in_(ids))
+        ).all())
+        linhas = [
+            l for l in linhas
+            if l.get("content_hash") is None or hashes.get(int(l["order_id"])) != l["content_hash"]
+        ]
+        puladas = total - len(linhas)
+
+    if not linhas:
+        if commit:
+            db.commit()  # o que mais estiver na transação (ex.: arquivo de payloads)
+        return {"inseridas": 0, "atualizadas": 0, "inalteradas": total, "puladas_hash": puladas}
+
+    colunas = [c for c in linhas[0] if c != "order_id"]
+
+    stmt = pg_insert(tabela).values(linhas)
+    # ml_fee preenchida pelo backfill (fees.py) não é apagada por um payload sem fee
+    novos = {
+        c: func.coalesce(stmt.excluded[c], tabela.c[c]) if c == "ml_fee" else stmt.excluded[c]
+        for c in colunas
+    }
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[tabela.c.order_id],
+        set_=novos,
+        where=or_(*(tabela.c[c].is_distinct_from(novos[c]) for c in colunas)),
+    ).returning(tabela.c.order_id, literal_column("(xmax = 0)").label("inserida"))
+
+    gravadas = db.execute(stmt).fetchall()
+    if commit:
+        db.commit()
+
+    inseridas = sum(1 for r in gravadas if r.inserida)
+    return {
+        "inseridas":    inseridas,
+        "atualizadas":  len(gravadas) - inseridas,
+        "inalteradas":  total - len(gravadas),
+        "puladas_hash": puladas,
+    }
+
+
+def _gravar_vendas(db, vendas: List[Sale]) -> Dict[str, int]:
+    """Writer do sync: upsert da página inteira."""
+    res = upsert_vendas(db, vendas)
+    print(
+        f"📦 Página gravada: {res['inseridas']} novas, {res['atualizadas']} atualizadas, "
+        f"{res['inalteradas']} inalteradas"
+    )
+    return {"salvas": len(vendas), **res}
+
+
+def _revisar_vendas(db, vendas: List[Sale]) -> Dict[str, int]:
+    """Writer da revisão: mesmo upsert, contando novas e atualizadas."""
+    res = upsert_vendas(db, vendas)
+    if res["inseridas"] or res["atualizadas"]:
+        print(f"🔄 Revisão: {res['inseridas']} inseridas, {res['atualizadas']} atualizadas")
+    return {
+        "novas":        res["inseridas"],
+        "atualizadas":  res["atualizadas"],
+        "inalteradas":  res["inalteradas"],
+        "puladas_hash": res["puladas_hash"],
+    }
+
+
 def revisar_banco_de_dados(ml_user_id: str, access_token: str) -> Dict[str, int]:
-    from datetime import timedelta
-    from dateutil.relativedelta import relativedelta
-    from sales import _order_to_sale
     from sqlalchemy import func
     from dateutil.tz import tzutc
-    import requests
     from db import SessionLocal
     from models import Sale
+    from ingestion import janelas_mensais, ingerir_vendas
+    from oauth import tokens
 
     print(f"🔁 Iniciando revisão histórica para usuário {ml_user_id}")
     db = SessionLocal()
-    novas = 0
-    atualizadas = 0
 
     try:
         data_min = db.query(func.min(Sale.date_closed)).filter(Sale.ml_user_id == int(ml_user_id)).scalar()
@@ -361,7 +382,7 @@ def revisar_banco_de_dados(ml_user_id: str, access_token: str) -> Dict[str, int]
 
         # 1.1 – debug: confira os bounds antes de qualquer lógica
         print(f"DEBUG data_min: {data_min!r}, data_max: {data_max!r}")
-        
+
         if not data_min or not data_max:
             print("⚠️ Nenhuma venda encontrada no histórico para revisar.")
             return {"novas": 0, "atualizadas": 0}
@@ -371,92 +392,15 @@ def revisar_banco_de_dados(ml_user_id: str, access_token: str) -> Dict[str, int]
             data_min = data_min.replace(tzinfo=tzutc())
         if data_max.tzinfo is None:
             data_max = data_max.replace(tzinfo=tzutc())
-     
-        # 2) normalize para o primeiro dia do mês à meia-noite
-        data_min_month = data_min.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-        current_start  = data_max.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-
-        print(f"DEBUG start_month: {data_min_month.date()}, current_start inicial: {current_start.date()}")
-
-        while current_start >= data_min_month:
-            current_end = (current_start + relativedelta(months=1)) - timedelta(seconds=1)
-            print(f"📅 Revisando intervalo: {current_start.date()} → {current_end.date()}")
-            offset = 0
-
-            while offset < 10000:
-                params = {
-                    "seller": ml_user_id,
-                    "offset": offset,
-                    "limit": 50,
-                    "sort": "date_desc",
-                    "order.date_closed.from": current_start.isoformat(),
-                    "order.date_closed.to": current_end.isoformat()
-                }
-                headers = {"Authorization": f"Bearer {access_token}"}
-                resp = requests.get("https://api.mercadolibre.com/orders/search", headers=headers, params=params)
-
-                if not resp.ok:
-                    print(f"❌ Falha ao buscar lista de orders (offset {offset}): {resp.status_code}")
-                    break
 
-                orders = resp.json().get("results", [])
-                if not orders:
-                    break
-
-                commit_necessario = False
-
-                for order in orders:
-                    oid = str(order["id"])
-                    existing_sale = db.query(Sale).filter_by(order_id=oid).first()
-
-                    full_resp = requests.get(f"https://api.mercadolibre.com/orders/{oid}?access_token={access_token}")
-                    if not full_resp.ok:
-                        print(f"⚠️ Falha ao buscar dados completos da venda {oid}: {full_resp.status_code}")
-                        continue
-
-                    full_order = full_resp.json()
-                    nova_venda = _order_to_sale(full_order, ml_user_id, access_token, db)
-
-                    if not existing_sale:
-                        db.add(nova_venda)
-                        novas += 1
-                        commit_necessario = True
-                        print(f"🟢 Venda {oid} inserida.")
-                        continue
-
-                    houve_mudanca = False
-                    for attr, value in nova_venda.__dict__.items():
-                        if attr in ["_sa_instance_state", "id"]:
-                            continue
-                        from sqlalchemy.orm.attributes import flag_modified
-                        
-                        antigo = getattr(existing_sale, attr, None)
-                        
-                        # Normalização de strings e nulos
-                        if isinstance(antigo, str):
-                            antigo = antigo.strip()
-                        if isinstance(value, str):
-                            value = value.strip()
-                        
-                        if antigo != value:
-                            setattr(existing_sale, attr, value)
-                            flag_modified(existing_sale, attr)  # força o SQLAlchemy a reconhecer mudança
-                            houve_mudanca = True
-
-
-                    if houve_mudanca:
-                        atualizadas += 1
-                        commit_necessario = True
-                        print(f"🔄 Venda {oid} atualizada.")
-
-                if commit_necessario:
-                    db.commit()
-
-                if len(orders) < 50:
-                    break
-                offset += 50
+        # 2) uma janela por mês, do mais recente ao mais antigo; meses
+        #    acima do limite de offset são divididos pelo planejador
+        janelas = janelas_mensais(data_min, data_max, sort="date_desc")
 
-            current_start -= relativedelta(months=1)
+        totais = ingerir_vendas(
+            ml_user_id, access_token, janelas, _revisar_vendas, job="revisao",
+            renovar_token=lambda t: tokens.rejeitado(ml_user_id, t),
+        )
 
     except Exception as e:
         db.rollback()
@@ -465,128 +409,125 @@ def revisar_banco_de_dados(ml_user_id: str, access_token: str) -> Dict[str, int]
     finally:
         db.close()
 
+    novas = totais.get("novas", 0)
+    atualizadas = totais.get("atualizadas", 0)
+    pedidos = totais.get("pedidos", 0)
+    puladas = totais.get("puladas_hash", 0)
     print(f"✅ Revisão finalizada. Novas: {novas}, Atualizadas: {atualizadas}")
+    if pedidos:
+        print(f"#️⃣ Hash igual em {puladas}/{pedidos} pedidos ({100 * puladas / pedidos:.1f}% sem diff)")
     return {"novas": novas, "atualizadas": atualizadas}
 
 
 
-def sync_all_accounts() -> int:
+def sync_all_accounts(esperar: bool = True, timeout: float = 3600.0) -> Dict[str, Any]:
     """
-    Sincroniza todas as contas cadastradas na tabela user_tokens,
-    utilizando a função incremental para buscar novas vendas.
+    Sincroniza todas as contas cadastradas na tabela user_tokens: enfileira
+    um job incremental por conta (jobs.py) e, com `esperar`, acompanha a
+    fila até todos terminarem ou `timeout` segundos.
+
+    O worker roda até SYNC_JOBS_PARALELOS jobs ao mesmo tempo, no máximo um
+    por conta, cada um com sua fatia do limite global de requisições; as
+    contas com menos pedidos na última execução entram primeiro na fila.
+    Retorna {"total", "segundos", "pendentes", "contas": [{ml_user_id, job_id,
+    status, vendas, espera_segundos, segundos, erro}]}.
     """
-    from sqlalchemy import text
-    from sales import get_incremental_sales
-
-    db = SessionLocal()
-    total = 0
-
-    try:
-        print("🔁 Iniciando sincronização de todas as contas...")
-
-        rows = db.execute(text("SELECT ml_user_id, access_token FROM user_tokens")).fetchall()
-
-        for ml_user_id, access_token in rows:
-            try:
-                print(f"➡️ Sincronizando conta {ml_user_id}...")
-                novas_vendas = get_incremental_sales(str(ml_user_id), access_token)
-                total += novas_vendas
-                print(f"✅ Conta {ml_user_id} sincronizada: {novas_vendas} novas vendas.")
-            except Exception as e:
-                print(f"❌ Erro ao sincronizar conta {ml_user_id}: {e}")
-
-        print(f"📦 Sincronização concluída. Total de vendas importadas/atualizadas: {total}")
-
-    finally:
-        db.close()
-
-    return total
-
-def get_full_sales(ml_user_id: str, access_token: str) -> int:
-    from datetime import datetime, timedelta
+    import time
+    from jobs import enfileirar_contas, obter_job
+
+    inicio = time.monotonic()
+    job_ids = enfileirar_contas("incremental")
+    print(f"🔁 Sincronização de {len(job_ids)} contas enfileirada")
+
+    while True:
+        jobs = [j for j in (obter_job(i) for i in job_ids) if j is not None]
+        abertos = [j for j in jobs if j["status"] not in ("concluido", "falhou")]
+        if not esperar or not abertos or time.monotonic() - inicio >= timeout:
+            break
+        time.sleep(2.0)
+
+    contas = [
+        {
+            "ml_user_id":      str(j["ml_user_id"]),
+            "job_id":          j["id"],
+            "status":          j["status"],
+            "vendas":          (j["resultado"] or {}).get("vendas", 0),
+            "espera_segundos": j.get("espera_segundos"),
+            "segundos":        j["segundos"],
+            "erro":            j["erro"],
+        }
+        for j in jobs
+    ]
+    total = sum(c["vendas"] for c in contas)
+    print(f"📦 Sincronização: {total} vendas importadas/atualizadas, {len(abertos)} contas ainda na fila")
+
+    return {
+        "total":     total,
+        "segundos":  round(time.monotonic() - inicio, 2),
+        "pendentes": len(abertos),
+        "contas":    sorted(contas, key=lambda c: c["segundos"] or 0, reverse=True),
+    }
+
+
+def get_full_sales(
+    ml_user_id: str,
+    access_token: str,
+    somente_busca: bool = False,
+    max_in_flight: Optional[int] = None,
+) -> int:
+    """
+    Importa o histórico mês a mês. Com `somente_busca`, os pedidos são
+    montados direto das páginas de /orders/search (fallback para
+    /orders/{id} só quando falta algum campo): uma chamada a menos por
+    pedido, mas o resultado da busca é um resumo do /orders/{id} (itens
+    e payments podem vir com menos detalhe, e o fee fica para o
+    preencher_fees). Por isso é opt-in, para importações em massa.
+    Shipment e SLA são buscados nos dois modos. Cada página gravada salva
+    um checkpoint; se a importação anterior parou no meio, esta retoma
+    as janelas pendentes de onde pararam.
+    """
+    from datetime import datetime
     from dateutil.relativedelta import relativedelta
-    from sales import _order_to_sale
     from sqlalchemy import func
-
-    API_BASE = "https://api.mercadolibre.com/orders/search"
-    FULL_PAGE_SIZE = 50
+    from ingestion import janelas_mensais, ingerir_vendas, MAX_IN_FLIGHT
+    from sync_state import plano_pendente, encerrar_plano
+    from oauth import tokens
 
     db = SessionLocal()
-    total_saved = 0
 
     try:
-        # Determina o intervalo de datas com base nas vendas registradas
-        data_min = db.query(func.min(Sale.date_closed)).filter(Sale.ml_user_id == int(ml_user_id)).scalar()
-        data_max = db.query(func.max(Sale.date_closed)).filter(Sale.ml_user_id == int(ml_user_id)).scalar()
-
-        if not data_min or not data_max:
-            data_max = datetime.utcnow().replace(tzinfo=tzutc())
-            data_min = data_max - relativedelta(years=1)
-
-        if data_min.tzinfo is None:
-            data_min = data_min.replace(tzinfo=tzutc())
-        if data_max.tzinfo is None:
-            data_max = data_max.replace(tzinfo=tzutc())
-
-        current_start = data_max.replace(day=1)
-
-        while current_start >= data_min:
-            current_end = (current_start + relativedelta(months=1)) - timedelta(seconds=1)
-            offset = 0
-
-            while True:
-                params = {
-                    "seller": ml_user_id,
-                    "offset": offset,
-                    "limit": FULL_PAGE_SIZE,
-                    "sort": "date_asc",
-                    "order.date_closed.from": current_start.isoformat(),
-                    "order.date_closed.to": current_end.isoformat()
-                }
-                headers = {"Authorization": f"Bearer {access_token}"}
-
-                resp = requests.get(API_BASE, params=params, headers=headers)
-                if not resp.ok:
-                    print(f"❌ Falha ao buscar pedidos no intervalo {current_start.date()} - {current_end.date()} (offset {offset}): {resp.status_code}")
-                    break
-
-                orders = resp.json().get("results", [])
-                if not orders:
-                    break
-
-                for order in orders:
-                    order_id = str(order["id"])
-                    try:
-                        full_resp = requests.get(f"https://api.mercadolibre.com/orders/{order_id}?access_token={access_token}")
-                        if not full_resp.ok:
-                            print(f"⚠️ Falha ao buscar ordem completa {order_id}: {full_resp.status_code}")
-                            continue
-
-                        full_order = full_resp.json()
-                        nova_venda = _order_to_sale(full_order, ml_user_id, access_token, db)
-                        print(f"📦 FULL - ordem {order_id} processada | ml_fee: {nova_venda.ml_fee}")
-
-                        existing_sale = db.query(Sale).filter_by(order_id=order_id).first()
-                        if not existing_sale:
-                            db.add(nova_venda)
-                        else:
-                            for attr, value in nova_venda.__dict__.items():
-                                if attr != "_sa_instance_state":
-                                    setattr(existing_sale, attr, value)
-
-                        total_saved += 1
-
-                    except Exception as e:
-                        print(f"❌ Erro ao processar venda {order_id}: {e}")
-
-                db.commit()
-
-                if len(orders) < FULL_PAGE_SIZE:
-                    break
-
-                offset += FULL_PAGE_SIZE
-
-            current_start -= relativedelta(months=1)
+        # ⏯️ Importação interrompida: retoma as janelas pendentes do offset salvo
+        janelas = plano_pendente(db, ml_user_id)
+        retomada = bool(janelas)
+        if retomada:
+            feitas = sum(j.offset_inicial for j in janelas)
+            print(f"⏯️ Retomando importação de {ml_user_id}: {len(janelas)} janelas pendentes ({feitas} pedidos já lidos nelas)")
+        else:
+            # Determina o intervalo de datas com base nas vendas registradas
+            data_min = db.query(func.min(Sale.date_closed)).filter(Sale.ml_user_id == int(ml_user_id)).scalar()
+            data_max = db.query(func.max(Sale.date_closed)).filter(Sale.ml_user_id == int(ml_user_id)).scalar()
+
+            if not data_min or not data_max:
+                data_max = datetime.utcnow().replace(tzinfo=tzutc())
+                data_min = data_max - relativedelta(years=1)
+
+            if data_min.tzinfo is None:
+                data_min = data_min.replace(tzinfo=tzutc())
+            if data_max.tzinfo is None:
+                data_max = data_max.replace(tzinfo=tzutc())
+
+            janelas = janelas_mensais(data_min, data_max, sort="date_asc")
+
+        for janela in janelas:
+            janela.somente_busca = somente_busca
+        totais = ingerir_vendas(
+            ml_user_id, access_token, janelas, _gravar_vendas,
+            max_in_flight=max_in_flight or MAX_IN_FLIGHT, job="full",
+            renovar_token=lambda t: tokens.rejeitado(ml_user_id, t),
+            planejar=not retomada, acompanhar=True, checkpoint=True,
+        )
+        if not encerrar_plano(db, ml_user_id):
+            print(f"⚠️ Importação de {ml_user_id} com janelas pendentes; a próxima execução retoma delas")
 
     except Exception as e:
         db.rollback()
@@ -594,7 +535,7 @@ def get_full_sales(ml_user_id: str, access_token: str) -> int:
     finally:
         db.close()
 
-    return total_saved
+    return totais.get("salvas", 0)
 
 from typing import Optional
 
@@ -0,0 +1,174 @@
+# shipments.py – atualização dirigida dos envios ainda em andamento
+from __future__ import annotations
+
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.dialects import postgresql
+
+from models import Sale
+
+# ---------------- Configurações --------------- #
+LIMITE_POR_CICLO = int(os.getenv("ML_ENVIOS_POR_CICLO", "500"))
+MAX_WORKERS      = 16
+JANELA_PEDIDOS   = timedelta(days=60)      # envios mais antigos que isso não são seguidos
+INTERVALO_MINIMO = timedelta(minutes=15)   # entre duas buscas do mesmo envio com SLA próximo
+INTERVALO_PADRAO = timedelta(hours=2)      # ... e dos demais envios ativos
+SLA_PROXIMO      = timedelta(days=1)       # SLA a menos disso de agora (antes ou depois)
+
+# Estados do ML que ainda podem mudar (delivered, not_delivered e cancelled são finais)
+STATUS_ATIVOS = ("pending", "handling", "ready_to_ship", "shipped")
+
+COLUNAS_ENVIO = (
+    "shipment_status", "shipment_substatus", "shipment_last_updated", "shipment_mode",
+    "shipment_logistic_type", "shipment_list_cost", "shipment_delivery_type",
+    "shipment_receiver_name", "order_cost", "base_cost", "shipment_cost", "shipment_delivery_sla",
+)
+
+# SLA mais perto de agora primeiro, depois os buscados há mais tempo. A rotação
+# vem da elegibilidade: cada envio só volta depois do intervalo (mais curto com
+# SLA próximo). O mesmo shipment pode ter vários pedidos (carrinho)
+_SQL_CANDIDATOS = text("""
+    SELECT shipping_id, ml_user_id, array_agg(order_id) AS order_ids, min(shipment_delivery_sla) AS sla
+    FROM sales
+    WHERE shipment_status = ANY(:ativos)
+      AND shipping_id IS NOT NULL
+      AND (:uid IS NULL OR ml_user_id = :uid)
+      AND date_closed >= (now() AT TIME ZONE 'America/Sao_Paulo') - make_interval(days => :dias)
+      AND (shipments_refreshed_at IS NULL
+           OR shipments_refreshed_at < now() - make_interval(secs =>
+                CASE WHEN shipment_delivery_sla BETWEEN now() - make_interval(secs => :proximo)
+                                                    AND now() + make_interval(secs => :proximo)
+                     THEN :minimo ELSE :padrao END))
+    GROUP BY shipping_id, ml_user_id
+    ORDER BY abs(extract(epoch FROM min(shipment_delivery_sla) - now())) ASC NULLS LAST,
+             min(shipments_refreshed_at) ASC NULLS FIRST
+    LIMIT :limite
+""")
+
+
+def _tipo_sql(coluna: str) -> str:
+    return Sale.__table__.c[coluna].type.compile(dialect=postgresql.dialect())
+
+
+def _gravar_envios(db, linhas: List[Dict[str, Any]]) -> int:
+    """
+    Um UPDATE ... FROM (VALUES ...) com as colunas de envio de todos os
+    shipments. O content_hash é limpo: a linha deixou de refletir o
+    payload que o gerou, então o próximo upsert a regrava.
+    """
+    if not linhas:
+        return 0
+    colunas = ("shipping_id",) + COLUNAS_ENVIO
+    tipos = {c: _tipo_sql(c) for c in colunas}
+    valores = ", ".join(
+        "(" + ", ".join(f"CAST(:{c}_{i} AS {tipos[c]})" for c in colunas) + ")"
+        for i in range(len(linhas))
+    )
+    params = {f"{c}_{i}": linha[c] for i, linha in enumerate(linhas) for c in colunas}
+    atribuicoes = ", ".join(f"{c} = v.{c}" for c in COLUNAS_ENVIO)
+    res = db.execute(text(f"""
+        UPDATE sales AS s SET {atribuicoes}, content_hash = NULL
+        FROM (VALUES {valores}) AS v({", ".join(colunas)})
+        WHERE s.shipping_id = v.shipping_id
+          AND ({" OR ".join(f"s.{c} IS DISTINCT FROM v.{c}" for c in COLUNAS_ENVIO)})
+    """), params)
+    return res.rowcount
+
+
+def _marcar_buscados(db, shipping_ids: List[str]) -> None:
+    """shipments_refreshed_at = agora em todas as linhas dos shipments consultados."""
+    if shipping_ids:
+        db.execute(
+            text("UPDATE sales SET shipments_refreshed_at = now() WHERE shipping_id = ANY(:ids)"),
+            {"ids": shipping_ids},
+        )
+
+
+def atualizar_envios(ml_user_id: Optional[str] = None, limite: int = LIMITE_POR_CICLO) -> Dict[str, int]:
+    """
+    Um ciclo do refresher: pega até `limite` shipments não finais (SLA mais
+    perto de agora primeiro, entre os que não buscamos há pouco), busca /shipments/{id} e /sla em paralelo e grava
+    tudo em um único UPDATE. Retorna {"envios", "buscados", "linhas", "erros"}.
+    """
+    from db import SessionLocal, engine
+    from archive import atualizar_bundles
+    from ml_api import API_ROOT, RunCache, get_json, ledger
+    from oauth import tokens
+    from sales import campos_envio
+
+    inicio = time.monotonic()
+    with engine.connect() as conn:
+        candidatos = conn.execute(_SQL_CANDIDATOS, {
+            "ativos": list(STATUS_ATIVOS),
+            "uid":    int(ml_user_id) if ml_user_id else None,
+            "dias":    JANELA_PEDIDOS.days,
+            "minimo":  INTERVALO_MINIMO.total_seconds(),
+            "padrao":  INTERVALO_PADRAO.total_seconds(),
+            "proximo": SLA_PROXIMO.total_seconds(),
+            "limite": limite,
+        }).fetchall()
+    if not candidatos:
+        return {"envios": 0, "buscados": 0, "linhas": 0, "erros": 0}
+
+    contas = {str(c.ml_user_id) for c in candidatos}
+    acessos = {uid: tokens.obter(uid) for uid in contas}
+    caches = {uid: RunCache(conta=uid, job="envios") for uid in contas}
+
+    def _buscar(candidato) -> Optional[Tuple[Any, Dict[str, Any], Dict[str, Any]]]:
+        uid = str(candidato.ml_user_id)
+        token = acessos.get(uid)
+        if not token:
+            return None
+        base = f"{API_ROOT}/shipments/{candidato.shipping_id}"
+        shipment = get_json(base, token, cache=caches[uid])
+        if not shipment:
+            return None
+        sla = get_json(f"{base}/sla", token, cache=caches[uid]) or {}
+        return candidato, shipment, sla
+
+    try:
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            resultados = list(executor.map(_buscar, candidatos))
+    finally:
+        ledger.flush()
+
+    linhas: List[Dict[str, Any]] = []
+    mudancas: Dict[int, Dict[str, Any]] = {}
+    for r in resultados:
+        if r is None:
+            continue
+        candidato, shipment, sla = r
+        linhas.append({"shipping_id": str(candidato.shipping_id), **campos_envio(shipment, sla)})
+        for order_id in candidato.order_ids:
+            mudancas[int(order_id)] = {"shipment": shipment, "sla": sla}
+
+    # Colunas, arquivo de payloads e marca de busca no mesmo commit (o rebuild
+    # não volta ao envio antigo). Falhas também são marcadas: voltam no próximo
+    # intervalo em vez de ocupar o topo da fila a cada ciclo
+    db = SessionLocal.session_factory()
+    try:
+        gravadas = _gravar_envios(db, linhas)
+        atualizar_bundles(db, mudancas)
+        _marcar_buscados(db, [str(c.shipping_id) for c in candidatos])
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+    erros = len(candidatos) - len(linhas)
+    print(
+        f"🚚 Envios: {len(candidatos)} shipments em andamento, "
+        f"{gravadas} linhas alteradas, {erros} erros em {time.monotonic() - inicio:.1f}s"
+    )
+    return {"envios": len(candidatos), "buscados": len(linhas), "linhas": gravadas, "erros": erros}
+
+
+if __name__ == "__main__":
+    atualizar_envios()
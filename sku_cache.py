@@ -0,0 +1,85 @@
+# sku_cache.py – catálogo de SKUs em memória
+from __future__ import annotations
+
+import time
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+from sqlalchemy import text
+
+# ---------------- Configurações --------------- #
+VERIFICAR_A_CADA = 60  # segundos entre checagens de versão da tabela sku
+
+# (quantity, custo_unitario, level1, level2)
+SkuInfo = Tuple[Any, Any, Any, Any]
+
+_SQL_VERSAO = text("""
+    SELECT (SELECT count(*) FROM sku),
+           (SELECT max(date_created) FROM sku),
+           (SELECT n_tup_ins + n_tup_upd + n_tup_del
+              FROM pg_stat_user_tables WHERE relname = 'sku')
+""")
+
+# Mesmo critério da consulta antiga: registro mais recente de cada SKU
+_SQL_CATALOGO = text("""
+    SELECT DISTINCT ON (sku) sku, quantity, custo_unitario, level1, level2
+    FROM sku
+    ORDER BY sku, date_created DESC
+""")
+
+
+class CatalogoSku:
+    """
+    Índice sku -> (quantity, custo_unitario, level1, level2) carregado
+    de uma vez. A versão da tabela (contagem, último date_created e
+    contadores de escrita do Postgres) é checada no máximo a cada
+    VERIFICAR_A_CADA segundos; se mudou, o índice é recarregado.
+    """
+
+    def __init__(self, verificar_a_cada: float = VERIFICAR_A_CADA):
+        self.verificar_a_cada = verificar_a_cada
+        self._indice: Dict[str, SkuInfo] = {}
+        self._versao: Optional[tuple] = None
+        self._checado_em = 0.0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.recargas = 0
+
+    def atualizar(self, db, imediato: bool = False) -> None:
+        """
+        Recarrega o índice se a tabela sku mudou. Com `imediato` a versão
+        é checada na hora (início de cada sync), sem esperar o intervalo.
+        """
+        with self._lock:
+            agora = time.monotonic()
+            if not imediato and self._versao is not None and agora - self._checado_em < self.verificar_a_cada:
+                return
+            versao = tuple(db.execute(_SQL_VERSAO).fetchone())
+            self._checado_em = agora
+            if versao == self._versao:
+                return
+            self._indice = {
+                row[0]: tuple(row[1:]) for row in db.execute(_SQL_CATALOGO)
+            }
+            self._versao = versao
+            self.recargas += 1
+
+    def buscar(self, db, sku: str) -> Optional[SkuInfo]:
+        self.atualizar(db)
+        info = self._indice.get(sku)
+        if info is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return info
+
+    def resumo(self) -> str:
+        return (
+            f"🏷️ Catálogo SKU: {len(self._indice)} SKUs, {self.hits} hits, "
+            f"{self.misses} misses, {self.recargas} recargas"
+        )
+
+
+# Instância única do processo
+catalogo_sku = CatalogoSku()
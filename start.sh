@@ -3,5 +3,8 @@
 # Inicia o FastAPI em segundo plano na porta 8501
 uvicorn api:app --host 0.0.0.0 --port 8501 &
 
+# Worker da fila de jobs (sync, revisão, reconciliação, fees) e das notificações do ML
+python jobs.py &
+
 # Inicia o Streamlit como serviço principal (na porta 8000, visível)
 streamlit run app.py --server.port 8000 --server.address=0.0.0.0 --server.enableXsrfProtection false
@@ -0,0 +1,263 @@
+# sync_state.py – marca d'água do sync incremental; progresso e checkpoints da importação
+from __future__ import annotations
+
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from dateutil import parser
+from dateutil.tz import tzutc
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from models import ImportCheckpoint, Sale, SyncProgresso, SyncState
+
+# ---------------- Configurações --------------- #
+# Pedidos que fecham "atrasados" aparecem na busca com date_closed
+# um pouco anterior à marca; reler essa janela evita perdê-los.
+OVERLAP = timedelta(hours=1)
+# A marca fica este tanto antes do primeiro pedido que não pôde ser gravado
+ANTES_DA_FALHA = timedelta(seconds=1)
+
+
+def marca_inicial(db, ml_user_id: str) -> Optional[datetime]:
+    """
+    Ponto de partida do incremental: a marca gravada em sync_state ou,
+    para contas que ainda não têm estado, o maior date_closed em sales.
+    """
+    marca = db.query(SyncState.high_water_mark).filter_by(ml_user_id=int(ml_user_id)).scalar()
+    if marca is None:
+        marca = db.query(func.max(Sale.date_closed)).filter(Sale.ml_user_id == int(ml_user_id)).scalar()
+    if marca is None:
+        return None
+    if marca.tzinfo is None:
+        marca = marca.replace(tzinfo=tzutc())
+    return marca - OVERLAP
+
+
+def iniciar_execucao(db, ml_user_id: str) -> None:
+    """Zera o contador da execução corrente (a marca é preservada)."""
+    stmt = pg_insert(SyncState.__table__).values(
+        ml_user_id=int(ml_user_id),
+        last_run_at=datetime.now(tzutc()),
+        last_run_orders=0,
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[SyncState.__table__.c.ml_user_id],
+        set_={"last_run_at": stmt.excluded.last_run_at, "last_run_orders": 0},
+    )
+    db.execute(stmt)
+    db.commit()
+
+
+def avancar_marca(db, ml_user_id: str, vendas: List[Sale], falhas: Optional[List[Dict[str, Any]]] = None) -> None:
+    """
+    Avança a marca para o maior date_closed da página, na mesma transação
+    da gravação das vendas (o commit fica com quem chama). A marca nunca
+    retrocede, mesmo que as páginas cheguem fora de ordem. `falhas` são os
+    pedidos da busca que não puderam ser detalhados nesta execução: a marca
+    não passa do mais antigo deles, então a próxima execução os relê.
+    """
+    if not any(v.date_closed is not None for v in vendas):
+        return
+    teto = _teto_das_falhas(falhas or [])
+    ultima = max(
+        (v for v in vendas if v.date_closed is not None and (teto is None or v.date_closed <= teto)),
+        key=lambda v: v.date_closed,
+        default=None,
+    )
+
+    # Página toda depois de uma falha: só o contador anda (greatest ignora NULL)
+    stmt = pg_insert(SyncState.__table__).values(
+        ml_user_id=int(ml_user_id),
+        high_water_mark=ultima.date_closed if ultima else None,
+        cursor_order_id=int(ultima.order_id) if ultima else None,
+        last_run_at=datetime.now(tzutc()),
+        last_run_orders=len(vendas),
+    )
+    tabela = SyncState.__table__
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[tabela.c.ml_user_id],
+        set_={
+            "high_water_mark": func.greatest(tabela.c.high_water_mark, stmt.excluded.high_water_mark),
+            "cursor_order_id": func.coalesce(stmt.excluded.cursor_order_id, tabela.c.cursor_order_id),
+            "last_run_at":     stmt.excluded.last_run_at,
+            "last_run_orders": func.coalesce(tabela.c.last_run_orders, 0) + stmt.excluded.last_run_orders,
+        },
+    )
+    db.execute(stmt)
+
+
+def _teto_das_falhas(falhas: List[Dict[str, Any]]) -> Optional[datetime]:
+    """Limite da marca: um instante antes do pedido com falha mais antigo (None sem falhas)."""
+    datas = [parser.isoparse(o["date_closed"]) for o in falhas if o.get("date_closed")]
+    return min(datas) - ANTES_DA_FALHA if datas else None
+
+
+# ------------- Progresso da importação ------------- #
+def iniciar_progresso(ml_user_id: str, job: str) -> None:
+    """Zera o progresso da conta no início de uma importação acompanhada."""
+    from db import engine
+
+    agora = datetime.now(tzutc())
+    linha = {
+        "ml_user_id": int(ml_user_id), "job": job, "status": "executando",
+        "iniciado_em": agora, "atualizado_em": agora, "concluido_em": None,
+        "janelas_total": None, "janelas_feitas": 0, "paginas": 0, "pedidos": 0,
+        "pedidos_estimados": None, "erro": None,
+    }
+    stmt = pg_insert(SyncProgresso.__table__).values(**linha)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[SyncProgresso.__table__.c.ml_user_id],
+        set_={k: stmt.excluded[k] for k in linha if k != "ml_user_id"},
+    )
+    with engine.begin() as conn:
+        conn.execute(stmt)
+
+
+def registrar_progresso(
+    ml_user_id: str,
+    paginas: int = 0,
+    pedidos: int = 0,
+    janelas: int = 0,
+    janelas_total: Optional[int] = None,
+    pedidos_estimados: Optional[int] = None,
+) -> None:
+    """Soma páginas/pedidos/janelas feitos; totais planejados substituem os anteriores."""
+    from db import engine
+
+    tabela = SyncProgresso.__table__
+    valores = {
+        "paginas":        tabela.c.paginas + paginas,
+        "pedidos":        tabela.c.pedidos + pedidos,
+        "janelas_feitas": tabela.c.janelas_feitas + janelas,
+        "atualizado_em":  datetime.now(tzutc()),
+    }
+    if janelas_total is not None:
+        valores["janelas_total"] = janelas_total
+    if pedidos_estimados is not None:
+        valores["pedidos_estimados"] = pedidos_estimados
+    with engine.begin() as conn:
+        conn.execute(tabela.update().where(tabela.c.ml_user_id == int(ml_user_id)).values(**valores))
+
+
+def finalizar_progresso(ml_user_id: str, erro: Optional[str] = None) -> None:
+    from db import engine
+
+    agora = datetime.now(tzutc())
+    tabela = SyncProgresso.__table__
+    with engine.begin() as conn:
+        conn.execute(tabela.update().where(tabela.c.ml_user_id == int(ml_user_id)).values(
+            status="falhou" if erro else "concluido",
+            erro=erro,
+            atualizado_em=agora,
+            concluido_em=agora,
+        ))
+
+
+def progresso(db, ml_user_id: str) -> Optional[dict]:
+    """
+    Progresso com vazão (pedidos/s desde o início) e ETA estimado a partir
+    do total planejado das janelas.
+    """
+    p = db.query(SyncProgresso).filter_by(ml_user_id=int(ml_user_id)).first()
+    if p is None:
+        return None
+
+    fim = p.concluido_em or datetime.now(tzutc())
+    decorrido = max((fim - p.iniciado_em).total_seconds(), 0.001)
+    vazao = p.pedidos / decorrido
+    eta = None
+    pct = None
+    if p.pedidos_estimados:
+        pct = round(min(100.0, 100 * p.pedidos / p.pedidos_estimados), 1)
+        if p.status == "executando" and vazao > 0:
+            eta = round(max(0, p.pedidos_estimados - p.pedidos) / vazao)
+
+    return {
+        "ml_user_id":        p.ml_user_id,
+        "job":               p.job,
+        "status":            p.status,
+        "iniciado_em":       p.iniciado_em,
+        "atualizado_em":     p.atualizado_em,
+        "concluido_em":      p.concluido_em,
+        "janelas_feitas":    p.janelas_feitas,
+        "janelas_total":     p.janelas_total,
+        "paginas":           p.paginas,
+        "pedidos":           p.pedidos,
+        "pedidos_estimados": p.pedidos_estimados,
+        "percentual":        pct,
+        "pedidos_por_seg":   round(vazao, 2),
+        "segundos":          round(decorrido, 1),
+        "eta_segundos":      eta,
+        "erro":              p.erro,
+    }
+
+
+# ------------- Checkpoints da importação ------------- #
+def salvar_plano(db, ml_user_id: str, janelas) -> None:
+    """Grava as janelas planejadas (sem commit); janelas já gravadas ficam como estão."""
+    if not janelas:
+        return
+    agora = datetime.now(tzutc())
+    tabela = ImportCheckpoint.__table__
+    stmt = pg_insert(tabela).values([
+        {
+            "ml_user_id": int(ml_user_id), "desde": j.desde, "ate": j.ate, "sort": j.sort,
+            "estimado": j.estimado, "proximo_offset": j.offset_inicial, "concluida": False,
+            "atualizado_em": agora,
+        }
+        for j in janelas
+    ]).on_conflict_do_nothing(index_elements=[tabela.c.ml_user_id, tabela.c.desde])
+    db.execute(stmt)
+
+
+def salvar_checkpoint(
+    db,
+    ml_user_id: str,
+    desde: datetime,
+    proximo_offset: int,
+    last_order_id: Optional[int],
+    concluida: bool,
+) -> None:
+    """Avança o checkpoint da janela na transação da página (o commit fica com o writer)."""
+    tabela = ImportCheckpoint.__table__
+    valores = {"proximo_offset": proximo_offset, "concluida": concluida, "atualizado_em": datetime.now(tzutc())}
+    if last_order_id is not None:
+        valores["last_order_id"] = int(last_order_id)
+    db.execute(
+        tabela.update()
+        .where(tabela.c.ml_user_id == int(ml_user_id), tabela.c.desde == desde)
+        .values(**valores)
+    )
+
+
+def plano_pendente(db, ml_user_id: str) -> list:
+    """
+    Janelas ainda não concluídas da última importação, cada uma a partir
+    do offset salvo. Lista vazia se não há importação interrompida.
+    """
+    from ingestion import Janela
+
+    linhas = (
+        db.query(ImportCheckpoint)
+        .filter_by(ml_user_id=int(ml_user_id), concluida=False)
+        .order_by(ImportCheckpoint.desde)
+        .all()
+    )
+    return [
+        Janela(
+            desde=c.desde, ate=c.ate, sort=c.sort,
+            estimado=c.estimado, offset_inicial=c.proximo_offset,
+        )
+        for c in linhas
+    ]
+
+
+def encerrar_plano(db, ml_user_id: str) -> bool:
+    """Apaga o plano se todas as janelas foram concluídas (a próxima importação recomeça)."""
+    pendentes = db.query(ImportCheckpoint).filter_by(ml_user_id=int(ml_user_id), concluida=False).count()
+    if pendentes:
+        return False
+    db.query(ImportCheckpoint).filter_by(ml_user_id=int(ml_user_id)).delete()
+    db.commit()
+    return True
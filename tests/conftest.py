@@ -0,0 +1,17 @@
+# Testes unitários: nenhum abre conexão com o banco.
+#
+# db.py cria o engine e roda init_db() no import, e ingestion, oauth e sales
+# importam `db` no topo. Aqui eles recebem um `db` sem engine; quem precisa
+# de sessão monta a sua no próprio teste.
+import os
+import sys
+import types
+
+os.environ.setdefault("ML_CLIENT_ID", "teste")
+os.environ.setdefault("ML_CLIENT_SECRET", "teste")
+os.environ.setdefault("BACKEND_URL", "http://localhost:8000")
+
+_db = types.ModuleType("db")
+_db.engine = None
+_db.SessionLocal = None
+sys.modules["db"] = _db
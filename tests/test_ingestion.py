@@ -0,0 +1,145 @@
+# ingestion: janelas mensais, cliente assíncrono (uma requisição por URL) e divisão pelo limite de offset.
+import asyncio
+import threading
+from datetime import datetime, timedelta
+
+from dateutil.tz import tzutc
+
+import ingestion
+from ingestion import _Fetcher, janelas_mensais
+from ml_api import RunCache
+
+
+class _Resposta:
+    def __init__(self, status: int, dados=None):
+        self.status_code = status
+        self.ok = status < 400
+        self._dados = dados
+
+    def json(self):
+        return self._dados
+
+
+def test_janelas_mensais_cobrem_o_periodo_do_mais_recente_ao_mais_antigo():
+    janelas = janelas_mensais(
+        datetime(2024, 11, 20, 15, tzinfo=tzutc()), datetime(2025, 2, 3, 8, tzinfo=tzutc()),
+    )
+
+    assert [(j.desde.year, j.desde.month) for j in janelas] == [(2025, 2), (2025, 1), (2024, 12), (2024, 11)]
+    assert janelas[-1].desde == datetime(2024, 11, 1, tzinfo=tzutc())
+    assert janelas[0].ate == datetime(2025, 3, 1, tzinfo=tzutc()) - timedelta(milliseconds=1)
+    for recente, antiga in zip(janelas, janelas[1:]):
+        assert antiga.ate + timedelta(milliseconds=1) == recente.desde  # sem buraco nem sobreposição
+
+
+def test_fetcher_baixa_cada_url_uma_vez(monkeypatch):
+    chamadas = []
+    liberar = threading.Event()
+
+    def _requisitar(metodo, url, **kwargs):
+        chamadas.append(url)
+        liberar.wait(2)
+        return _Resposta(200, {"id": 42})
+
+    monkeypatch.setattr(ingestion, "requisitar", _requisitar)
+
+    async def _rodar():
+        fetcher = _Fetcher("token", max_in_flight=4, cache=RunCache(conta="1001", job="teste"))
+        try:
+            tarefas = [asyncio.ensure_future(fetcher.get_json(f"{ingestion.API_ROOT}/shipments/42")) for _ in range(5)]
+            await asyncio.sleep(0.05)
+            liberar.set()
+            em_paralelo = await asyncio.gather(*tarefas)
+            do_cache = await fetcher.get_json(f"{ingestion.API_ROOT}/shipments/42")
+        finally:
+            fetcher.close()
+        return em_paralelo, do_cache
+
+    em_paralelo, do_cache = asyncio.run(_rodar())
+
+    assert em_paralelo == [{"id": 42}] * 5
+    assert do_cache == {"id": 42}
+    assert len(chamadas) == 1
+
+
+def test_fetcher_renova_token_no_401_e_repete(monkeypatch):
+    tokens_usados = []
+
+    def _requisitar(metodo, url, access_token=None, **kwargs):
+        tokens_usados.append(access_token)
+        return _Resposta(401) if access_token == "velho" else _Resposta(200, {"id": 7})
+
+    monkeypatch.setattr(ingestion, "requisitar", _requisitar)
+
+    async def _rodar():
+        fetcher = _Fetcher("velho", max_in_flight=2, renovar_token=lambda rejeitado: "novo")
+        try:
+            return await fetcher.get_json(f"{ingestion.API_ROOT}/orders/7"), fetcher.access_token
+        finally:
+            fetcher.close()
+
+    dados, token = asyncio.run(_rodar())
+
+    assert dados == {"id": 7}
+    assert token == "novo"
+    assert tokens_usados == ["velho", "novo"]
+
+
+# ---------------- Planejamento das janelas (limite de offset) ---------------- #
+class _BuscaFalsa:
+    """/orders/search que só responde paging.total dos pedidos em [from, to]."""
+
+    def __init__(self, datas):
+        self.datas = datas
+        self.buscas = 0
+
+    async def get_json(self, url, params=None):
+        from dateutil import parser
+
+        self.buscas += 1
+        desde = parser.isoparse(params["order.date_closed.from"])
+        ate = parser.isoparse(params["order.date_closed.to"])
+        return {"paging": {"total": sum(1 for d in self.datas if desde <= d <= ate)}, "results": []}
+
+
+def _planejar(datas, janela):
+    busca = _BuscaFalsa(datas)
+    return asyncio.run(ingestion._planejar(busca, janela, "1001")), busca
+
+
+def test_janela_acima_do_limite_e_dividida_sem_perder_pedidos():
+    inicio = datetime(2025, 1, 1, tzinfo=tzutc())
+    # 25 mil pedidos concentrados na primeira semana, poucos no resto do mês
+    datas = [inicio + timedelta(seconds=24 * i) for i in range(25_000)]
+    datas += [inicio + timedelta(days=10, hours=i) for i in range(300)]
+    janela = ingestion.Janela(desde=inicio, ate=datetime(2025, 2, 1, tzinfo=tzutc()) - timedelta(milliseconds=1))
+
+    partes, _ = _planejar(datas, janela)
+
+    assert len(partes) > 1
+    assert all(p.estimado <= ingestion.LIMITE_OFFSET for p in partes)
+    assert sum(p.estimado for p in partes) == len(datas)
+    for anterior, seguinte in zip(partes, partes[1:]):
+        assert anterior.ate < seguinte.desde  # em ordem e sem sobreposição
+    assert all(any(p.desde <= d <= p.ate for p in partes) for d in datas[::97])
+
+
+def test_janela_pequena_nao_e_dividida_e_vazia_some():
+    inicio = datetime(2025, 1, 1, tzinfo=tzutc())
+    janela = ingestion.Janela(desde=inicio, ate=inicio + timedelta(days=1))
+
+    partes, busca = _planejar([inicio + timedelta(hours=1)] * 3, janela)
+    assert [(p.desde, p.ate, p.estimado) for p in partes] == [(janela.desde, janela.ate, 3)]
+    assert busca.buscas == 1
+
+    assert _planejar([], janela)[0] == []
+
+
+def test_janela_minima_acima_do_limite_fica_com_o_teto():
+    inicio = datetime(2025, 1, 1, tzinfo=tzutc())
+    janela = ingestion.Janela(desde=inicio, ate=inicio + timedelta(seconds=30))
+
+    partes, _ = _planejar([inicio] * (ingestion.LIMITE_OFFSET + 1), janela)
+
+    assert len(partes) == 1
+    assert partes[0].estimado == ingestion.LIMITE_OFFSET
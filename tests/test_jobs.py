@@ -0,0 +1,100 @@
+# jobs: dedupe da fila e o ciclo reservar → executar → concluir/falhar (sem banco).
+import json
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy.exc import IntegrityError
+
+import db
+import jobs
+
+
+def test_chave_ignora_a_ordem_dos_params():
+    a = jobs._chave("reconcile", "1001", {"desde": "2025-01-01", "modo": "busca"})
+    b = jobs._chave("reconcile", "1001", {"modo": "busca", "desde": "2025-01-01"})
+    assert a == b
+    assert a != jobs._chave("reconcile", "1001", {"modo": "pedido", "desde": "2025-01-01"})
+    assert a != jobs._chave("reconcile", "1002", {"desde": "2025-01-01", "modo": "busca"})
+    assert jobs._chave("shipments", None, None) == "shipments:-"
+
+
+def test_tipo_desconhecido_nem_chega_ao_banco():
+    with pytest.raises(ValueError):
+        jobs.enfileirar("apagar_tudo", "1001")
+
+
+class _Engine:
+    """Cada begin() é uma transação; `reservas` é o que o UPDATE de reserva devolve, em ordem."""
+
+    def __init__(self, reservas):
+        self.reservas = list(reservas)
+        self.comandos = []
+
+    @contextmanager
+    def begin(self):
+        yield self
+
+    def execute(self, stmt, params=None):
+        self.comandos.append((stmt, params))
+        if stmt is jobs._SQL_RESERVAR:
+            reserva = self.reservas.pop(0)
+            if isinstance(reserva, Exception):
+                raise reserva
+            return SimpleNamespace(first=lambda: reserva)
+        return None
+
+    def params_de(self, stmt):
+        return [p for s, p in self.comandos if s is stmt]
+
+
+def _job(tentativas=1):
+    return SimpleNamespace(id=7, tipo="fees", ml_user_id=1001, params=None, tentativas=tentativas, max_tentativas=3)
+
+
+@pytest.fixture
+def engine(monkeypatch):
+    def _montar(*reservas):
+        e = _Engine(reservas)
+        monkeypatch.setattr(db, "engine", e, raising=False)
+        return e
+    return _montar
+
+
+def test_job_concluido_grava_o_resultado(engine, monkeypatch):
+    e = engine(_job())
+    monkeypatch.setitem(jobs.HANDLERS, "fees", lambda uid, params, mif: {"atualizadas": 3, "conta": uid})
+    ativos = jobs._Ativos()
+
+    assert jobs.executar_um("w1", ativos, 8) is True
+    (concluido,) = e.params_de(jobs._SQL_CONCLUIR)
+    assert concluido["id"] == 7
+    assert json.loads(concluido["resultado"]) == {"atualizadas": 3, "conta": "1001"}
+    assert ativos.lista() == []  # heartbeat para de renovar o job
+
+
+def test_job_que_falha_volta_com_backoff_exponencial(engine, monkeypatch):
+    def _quebra(uid, params, mif):
+        raise RuntimeError("ML fora do ar")
+
+    monkeypatch.setitem(jobs.HANDLERS, "fees", _quebra)
+    for tentativa, espera in ((1, jobs.BACKOFF_BASE), (2, 2 * jobs.BACKOFF_BASE), (3, 4 * jobs.BACKOFF_BASE)):
+        e = engine(_job(tentativas=tentativa))
+        jobs.executar_um("w1", jobs._Ativos(), 8)
+        (falha,) = e.params_de(jobs._SQL_FALHAR)
+        assert falha["espera"] == espera
+        assert "ML fora do ar" in falha["erro"]
+
+
+def test_fila_vazia(engine):
+    engine(None)
+    assert jobs.executar_um("w1", jobs._Ativos(), 8) is False
+
+
+def test_conta_ja_em_execucao_por_outro_worker_nao_roda_o_job(engine, monkeypatch):
+    # o índice uq_sync_jobs_executando rejeita a segunda reserva da mesma conta
+    e = engine(IntegrityError("UPDATE sync_jobs", {}, Exception("uq_sync_jobs_executando")))
+    monkeypatch.setitem(jobs.HANDLERS, "fees", lambda *a: pytest.fail("job rodou sem reserva"))
+
+    assert jobs.executar_um("w1", jobs._Ativos(), 8) is True  # tenta de novo em seguida
+    assert e.params_de(jobs._SQL_CONCLUIR) == [] and e.params_de(jobs._SQL_FALHAR) == []
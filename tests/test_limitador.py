@@ -0,0 +1,74 @@
+# Limitador de ml_api: balde de tokens com reserva e concorrência adaptativa (AIMD).
+import pytest
+
+import ml_api
+from ml_api import LimiteAdaptativo, TokenBucket
+
+
+class _Relogio:
+    def __init__(self):
+        self.agora = 1000.0
+
+    def __call__(self) -> float:
+        return self.agora
+
+
+@pytest.fixture
+def relogio(monkeypatch):
+    r = _Relogio()
+    monkeypatch.setattr(ml_api.time, "monotonic", r)
+    return r
+
+
+def test_balde_cheio_libera_a_rajada_e_depois_espaca(relogio):
+    balde = TokenBucket(taxa=2.0)  # capacidade = taxa
+
+    assert balde.reservar() == 0.0
+    assert balde.reservar() == 0.0
+    # sem tokens: cada reserva espera a sua vez na fila (1/taxa a mais)
+    assert balde.reservar() == pytest.approx(0.5)
+    assert balde.reservar() == pytest.approx(1.0)
+
+
+def test_balde_reabastece_com_o_tempo_sem_passar_da_capacidade(relogio):
+    balde = TokenBucket(taxa=2.0)
+    balde.reservar()
+    balde.reservar()
+
+    relogio.agora += 60  # muito tempo parado não acumula além da capacidade
+    assert [balde.reservar() for _ in range(2)] == [0.0, 0.0]
+    assert balde.reservar() == pytest.approx(0.5)
+
+
+def test_limite_cai_pela_metade_em_429_e_5xx():
+    limite = LimiteAdaptativo(16)
+    for status, esperado in ((503, 8), (None, 4), (500, 2), (502, 1), (429, 1)):
+        limite.entrar()
+        limite.sair(status, retry_after=None)
+        assert limite.limite == esperado  # nunca abaixo de 1
+
+
+def test_limite_sobe_devagar_com_sucesso_ate_o_maximo():
+    limite = LimiteAdaptativo(4)
+    limite.limite = 2.0
+
+    limite.entrar()
+    limite.sair(200, None)
+    assert limite.limite == pytest.approx(2.5)  # +1/limite por sucesso
+
+    for _ in range(20):
+        limite.entrar()
+        limite.sair(200, None)
+    assert limite.limite == 4.0
+
+
+def test_429_pausa_todo_mundo_pelo_retry_after(relogio):
+    limite = LimiteAdaptativo(4)
+    limite.entrar()
+    limite.sair(429, retry_after=7.0)
+    assert limite._pausa_ate == pytest.approx(relogio.agora + 7.0)
+
+    limite._em_uso += 1  # (entrar() esperaria a pausa)
+    limite.sair(429, retry_after=None)  # sem Retry-After: pausa padrão, sem encurtar a anterior
+    assert limite._pausa_ate == pytest.approx(relogio.agora + 7.0)
+    assert ml_api.BACKOFF_PADRAO < 7.0
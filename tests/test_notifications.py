@@ -0,0 +1,59 @@
+# notifications.validar: o que entra na fila de notificações e com que forma.
+from datetime import datetime, timedelta
+
+from dateutil.tz import tzutc
+
+from notifications import validar
+
+
+def _evento(**campos) -> dict:
+    evento = {
+        "topic":          "orders_v2",
+        "resource":       "/orders/2000009876543210",
+        "user_id":        123456789,
+        "application_id": 555,
+        "sent":           "2025-03-12T20:05:07.123Z",
+        "attempts":       1,
+    }
+    evento.update(campos)
+    return evento
+
+
+def test_pedido_normalizado():
+    ev = validar(_evento(), application_id="555")
+
+    assert ev["topic"] == "orders_v2"
+    assert ev["resource_id"] == 2000009876543210
+    assert ev["ml_user_id"] == 123456789
+    assert ev["sent_at"] == datetime(2025, 3, 12, 20, 5, 7, 123000, tzinfo=tzutc())
+    assert ev["received_at"] >= ev["sent_at"]
+
+
+def test_envio_com_subrecurso():
+    ev = validar(_evento(topic="shipments", resource="/shipments/44001122/sla"))
+    assert ev["topic"] == "shipments"
+    assert ev["resource_id"] == 44001122
+
+
+def test_eventos_ignorados():
+    assert validar(_evento(topic="questions", resource="/questions/1")) is None
+    assert validar(_evento(), application_id="999") is None                  # outra aplicação
+    assert validar(_evento(resource="/items/MLB123")) is None                # recurso desconhecido
+    assert validar(_evento(resource="/shipments/44001122")) is None          # tópico × recurso trocados
+    assert validar(_evento(topic="shipments")) is None
+    assert validar(_evento(user_id=None)) is None
+    assert validar(_evento(user_id="abc")) is None
+
+
+def test_sent_invalido_ou_no_futuro_vira_agora():
+    agora = datetime.now(tzutc())
+
+    sem_data = validar(_evento(sent="ontem"))
+    assert sem_data["sent_at"] == sem_data["received_at"]
+
+    futuro = (agora + timedelta(hours=3)).isoformat()
+    adiantado = validar(_evento(sent=futuro))
+    assert adiantado["sent_at"] == adiantado["received_at"]  # relógio do remetente não gera lag negativo
+
+    sem_fuso = validar(_evento(sent="2025-03-12T20:05:07"))
+    assert sem_fuso["sent_at"].tzinfo is not None
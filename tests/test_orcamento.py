@@ -0,0 +1,30 @@
+# Orcamento: a cota é cobrada antes de cada requisição sair, nunca depois.
+import pytest
+
+from ml_api import Orcamento, OrcamentoEsgotado, RunCache, get_json, requisitar
+
+
+def test_orcamento_nao_passa_da_cota():
+    cota = Orcamento(2)
+    assert [cota.consumir() for _ in range(4)] == [True, True, False, False]
+    assert cota.esgotado
+    assert cota.restante == 0
+
+
+def test_requisicao_negada_nao_sai(monkeypatch):
+    import ml_api
+
+    def _nao_chamar(*args, **kwargs):
+        raise AssertionError("requisição saiu sem cota")
+
+    monkeypatch.setattr(ml_api.sessao, "request", _nao_chamar)
+    with pytest.raises(OrcamentoEsgotado):
+        requisitar("GET", f"{ml_api.API_ROOT}/orders/1", conta="1001", job="verify", orcamento=Orcamento(0))
+
+
+def test_get_json_com_cota_esgotada_devolve_none(monkeypatch):
+    import ml_api
+
+    monkeypatch.setattr(ml_api.sessao, "request", lambda *a, **k: pytest.fail("requisição saiu sem cota"))
+    cache = RunCache(conta="1001", job="verify", orcamento=Orcamento(0))
+    assert get_json(f"{ml_api.API_ROOT}/shipments/42", "token", cache=cache) is None
@@ -0,0 +1,32 @@
+# RunCache: LRU quando limitado (varreduras longas); sem limite quando o fee relê os pedidos.
+from ml_api import RunCache
+
+
+def test_cache_descarta_o_menos_usado():
+    cache = RunCache(conta="1001", job="teste", max_itens=2)
+    cache.put("/orders/1", {"id": 1})
+    cache.put("/orders/2", {"id": 2})
+    assert cache.get("/orders/1") == {"id": 1}    # 1 passa a ser o mais recente
+
+    cache.put("/orders/3", {"id": 3})
+
+    assert cache.get("/orders/2") is None
+    assert cache.get("/orders/1") == {"id": 1}
+    assert cache.get("/orders/3") == {"id": 3}
+    assert cache.hits == 3
+
+
+def test_cache_nao_passa_do_limite():
+    cache = RunCache(max_itens=100)
+    for i in range(10_000):
+        cache.put(f"/shipments/{i}", {"id": i})
+    assert len(cache._dados) == 100
+
+
+def test_cache_sem_limite_guarda_tudo():
+    # o incremental entrega o cache ao preencher_fees, que relê os /orders/{id}
+    cache = RunCache(conta="1001", job="incremental")
+    for i in range(5_000):
+        cache.put(f"/orders/{i}", {"id": i})
+    assert cache.get("/orders/0") == {"id": 0}
+    assert len(cache._dados) == 5_000
@@ -0,0 +1,177 @@
+# Diff API × banco (sale_diff) sem banco de dados: linhas da API como
+# `_build_sale` as monta e linhas do banco como o psycopg2 as devolve.
+from datetime import datetime
+from decimal import Decimal
+
+from dateutil import tz
+
+from sale_diff import coagir, diff_colunar
+
+SP = tz.gettz("America/Sao_Paulo")
+UTC = tz.tzutc()
+ORDER_ID = 2000000123
+
+
+def _linha_api(**mudancas):
+    linha = {
+        "order_id":               str(ORDER_ID),
+        "ml_user_id":             1001,
+        "buyer_id":               8123456,
+        "buyer_nickname":         "COMPRADOR42 ",
+        "total_amount":           239.8,
+        "status":                 "paid",
+        "date_closed":            datetime(2025, 3, 10, 14, 5, 7, 123000, tzinfo=SP),
+        "item_id":                "MLB1234567",
+        "item_title":             "Produto SKU-0042",
+        "quantity":               2,
+        "unit_price":             119.9,
+        "shipping_id":            40010010005,        # int no payload, varchar no banco
+        "seller_sku":             "SKU-0042",
+        "quantity_sku":           1,
+        "custo_unitario":         Decimal("35.50"),
+        "level1":                 "Casa",
+        "level2":                 "Cozinha",
+        "ml_fee":                 33.572,              # 3 casas; a coluna é Numeric(10, 2)
+        "payment_id":             5002000000123,
+        "shipment_status":        "delivered",
+        "shipment_substatus":     None,
+        "shipment_last_updated":  datetime(2025, 3, 12, 17, 5, 7, 123000, tzinfo=SP),
+        "shipment_mode":          "me2",
+        "shipment_logistic_type": "fulfillment",
+        "shipment_list_cost":     24.9,
+        "shipment_delivery_type": "estimated",
+        "shipment_receiver_name": "Cliente 77",
+        "order_cost":             239.8,
+        "base_cost":              19.9,
+        "shipment_cost":          0,
+        "shipment_delivery_sla":  datetime(2025, 3, 11, 14, 5, 7, 123000, tzinfo=SP),
+        "content_hash":           "hash-da-api",
+    }
+    linha.update(mudancas)
+    return linha
+
+
+def _linha_banco(**mudancas):
+    linha = {
+        "id":                     1,
+        "order_id":               ORDER_ID,
+        "ml_user_id":             1001,
+        "buyer_id":               8123456,
+        "buyer_nickname":         "COMPRADOR42",
+        "total_amount":           239.8,
+        "status":                 "paid",
+        "date_closed":            datetime(2025, 3, 10, 14, 5, 7, 123000),   # hora de SP, sem fuso
+        "item_id":                "MLB1234567",
+        "item_title":             "Produto SKU-0042",
+        "quantity":               2,
+        "unit_price":             119.9,
+        "shipping_id":            "40010010005",
+        "seller_sku":             "SKU-0042",
+        "quantity_sku":           1,
+        "custo_unitario":         Decimal("35.50"),
+        "level1":                 "Casa",
+        "level2":                 "Cozinha",
+        "ads":                    None,
+        "ml_fee":                 Decimal("33.57"),
+        "payment_id":             5002000000123,
+        "shipment_status":        "delivered",
+        "shipment_substatus":     None,
+        "shipment_last_updated":  datetime(2025, 3, 12, 17, 5, 7, 123000),
+        "shipment_mode":          "me2",
+        "shipment_logistic_type": "fulfillment",
+        "shipment_list_cost":     24.9,
+        "shipment_delivery_type": "estimated",
+        "shipment_receiver_name": "Cliente 77",
+        "order_cost":             Decimal("239.80"),
+        "base_cost":              Decimal("19.90"),
+        "shipment_cost":          Decimal("0.00"),
+        "shipment_delivery_sla":  datetime(2025, 3, 11, 17, 5, 7, 123000, tzinfo=UTC),
+        "content_hash":           "hash-antigo",       # força o diff coluna a coluna
+        "last_verified_at":       None,
+    }
+    linha.update(mudancas)
+    return linha
+
+
+def test_coagir_segue_o_tipo_da_coluna():
+    assert coagir("shipping_id", 40010010005) == "40010010005"
+    assert coagir("ml_fee", 33.575) == Decimal("33.58")
+    assert coagir("quantity", "2") == 2
+    assert coagir("date_closed", datetime(2025, 3, 10, 17, 0, tzinfo=UTC)) == datetime(2025, 3, 10, 14, 0)
+
+
+def test_pedido_inalterado_nao_diverge():
+    divergentes, so_hash, por_coluna = diff_colunar([_linha_api()], {ORDER_ID: _linha_banco()})
+
+    assert divergentes == set()
+    assert por_coluna == {}
+    assert so_hash == {ORDER_ID}     # só o hash gravado está velho
+
+
+def test_hash_igual_pula_o_diff():
+    banco = _linha_banco(content_hash="hash-da-api", status="cancelled")
+    divergentes, so_hash, por_coluna = diff_colunar([_linha_api()], {ORDER_ID: banco})
+
+    assert (divergentes, so_hash, por_coluna) == (set(), set(), {})
+
+
+def test_mudanca_real_diverge():
+    api = _linha_api(shipment_status="not_delivered", shipping_id=40010010099)
+    divergentes, so_hash, por_coluna = diff_colunar([api], {ORDER_ID: _linha_banco()})
+
+    assert divergentes == {ORDER_ID}
+    assert so_hash == set()
+    assert por_coluna == {"shipment_status": 1, "shipping_id": 1}
+
+
+def test_fee_ausente_na_api_nao_diverge():
+    divergentes, _, _ = diff_colunar([_linha_api(ml_fee=None)], {ORDER_ID: _linha_banco()})
+    assert divergentes == set()
+
+
+def test_pedido_ausente_no_banco_diverge():
+    divergentes, so_hash, _ = diff_colunar([_linha_api()], {})
+
+    assert divergentes == {ORDER_ID}
+    assert so_hash == set()
+
+
+def test_linha_da_busca_inalterada_nao_diverge():
+    # Triagem da reconciliação por busca: sem colunas de envio e sem hash
+    envio = {c for c in _linha_api() if c.startswith("shipment_") or c in ("order_cost", "base_cost")}
+    parcial = {k: v for k, v in _linha_api().items() if k not in envio | {"content_hash"}}
+    divergentes, so_hash, por_coluna = diff_colunar([parcial], {ORDER_ID: _linha_banco()})
+
+    assert (divergentes, por_coluna) == (set(), {})
+
+
+# ---- Células gravadas em reconcile_diffs (relatório / dry-run) ---- #
+def test_pedido_inalterado_nao_gera_celulas():
+    celulas = []
+    diff_colunar([_linha_api()], {ORDER_ID: _linha_banco()}, celulas)
+    assert celulas == []
+
+
+def test_hash_igual_nao_gera_celulas():
+    celulas = []
+    banco = _linha_banco(content_hash="hash-da-api", status="cancelled")
+    diff_colunar([_linha_api()], {ORDER_ID: banco}, celulas)
+    assert celulas == []
+
+
+def test_mudanca_real_gera_uma_celula_por_coluna():
+    celulas = []
+    api = _linha_api(shipment_status="not_delivered", shipping_id=40010010099, ml_fee=35.004)
+    diff_colunar([api], {ORDER_ID: _linha_banco()}, celulas)
+
+    assert sorted(celulas) == [
+        (ORDER_ID, "ml_fee", "33.57", "35.0"),
+        (ORDER_ID, "shipment_status", "delivered", "not_delivered"),
+        (ORDER_ID, "shipping_id", "40010010005", "40010010099"),
+    ]
+
+
+def test_pedido_ausente_no_banco_grava_valor_antigo_nulo():
+    celulas = []
+    diff_colunar([_linha_api()], {}, celulas)
+    assert celulas and all(antigo is None for _, _, antigo, _ in celulas)
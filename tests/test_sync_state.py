@@ -0,0 +1,185 @@
+# sync_state: marca d'água do incremental e checkpoints da importação (sem banco).
+from datetime import datetime
+
+from dateutil import tz
+from sqlalchemy.dialects import postgresql
+
+from ingestion import Janela
+from models import ImportCheckpoint, Sale
+from sync_state import (
+    ANTES_DA_FALHA, avancar_marca, encerrar_plano, plano_pendente, salvar_checkpoint, salvar_plano,
+)
+
+SP = tz.gettz("America/Sao_Paulo")
+
+
+class _Sessao:
+    def __init__(self):
+        self.comandos = []
+
+    def execute(self, stmt, params=None):
+        self.comandos.append(stmt)
+
+
+def _params(stmt) -> dict:
+    return stmt.compile(dialect=postgresql.dialect()).params
+
+
+def _venda(order_id: int, minuto: int) -> Sale:
+    return Sale(order_id=order_id, ml_user_id=1001, date_closed=datetime(2025, 3, 12, 10, minuto, tzinfo=SP))
+
+
+def _falha(order_id: int, minuto: int) -> dict:
+    return {"id": order_id, "date_closed": f"2025-03-12T10:{minuto:02d}:00.000-03:00"}
+
+
+def test_marca_vai_ao_maior_date_closed_da_pagina():
+    db = _Sessao()
+    avancar_marca(db, "1001", [_venda(1, 5), _venda(2, 40), _venda(3, 20)])
+
+    params = _params(db.comandos[0])
+    assert params["high_water_mark"] == datetime(2025, 3, 12, 10, 40, tzinfo=SP)
+    assert params["cursor_order_id"] == 2
+    assert params["last_run_orders"] == 3
+
+
+def test_marca_nao_passa_do_pedido_que_falhou():
+    db = _Sessao()
+    falhas = [_falha(9, 30), _falha(8, 50)]
+    avancar_marca(db, "1001", [_venda(1, 5), _venda(2, 40), _venda(3, 20)], falhas)
+
+    params = _params(db.comandos[0])
+    assert params["high_water_mark"] == datetime(2025, 3, 12, 10, 20, tzinfo=SP)
+    assert params["high_water_mark"] <= datetime(2025, 3, 12, 10, 30, tzinfo=SP) - ANTES_DA_FALHA
+    assert params["cursor_order_id"] == 3
+
+
+def test_pagina_toda_depois_da_falha_so_conta_pedidos():
+    db = _Sessao()
+    avancar_marca(db, "1001", [_venda(1, 40), _venda(2, 45)], [_falha(9, 30)])
+
+    params = _params(db.comandos[0])
+    assert params["high_water_mark"] is None  # greatest() mantém a marca gravada
+    assert params["last_run_orders"] == 2
+
+
+def test_falha_de_pagina_anterior_continua_valendo():
+    # a lista de falhas é da execução inteira: páginas seguintes também respeitam o teto
+    db = _Sessao()
+    falhas = [_falha(9, 10)]
+    avancar_marca(db, "1001", [_venda(1, 5)], falhas)
+    avancar_marca(db, "1001", [_venda(2, 50)], falhas)
+
+    assert _params(db.comandos[0])["high_water_mark"] == datetime(2025, 3, 12, 10, 5, tzinfo=SP)
+    assert _params(db.comandos[1])["high_water_mark"] is None
+
+
+# ---------------- Checkpoints da importação ---------------- #
+class _Checkpoints:
+    """import_checkpoints em memória: aplica o INSERT ... DO NOTHING, o UPDATE e as consultas do ORM."""
+
+    def __init__(self):
+        self.linhas = {}  # (ml_user_id, desde) -> ImportCheckpoint
+        self.comandos = []
+        self.commits = 0
+
+    def execute(self, stmt, params=None):
+        self.comandos.append(stmt)
+        params = _params(stmt)
+        if stmt.is_insert:
+            for i in range(len(params) // 8):
+                linha = ImportCheckpoint(**{c: params[f"{c}_m{i}"] for c in _COLUNAS})
+                self.linhas.setdefault((linha.ml_user_id, linha.desde), linha)  # conflito: fica o que estava
+        else:
+            linha = self.linhas.get((params["ml_user_id_1"], params["desde_1"]))
+            for coluna in ("proximo_offset", "concluida", "last_order_id"):
+                if linha is not None and coluna in params:
+                    setattr(linha, coluna, params[coluna])
+
+    def query(self, modelo):
+        return _Consulta(self)
+
+    def commit(self):
+        self.commits += 1
+
+
+_COLUNAS = ("ml_user_id", "desde", "ate", "sort", "estimado", "proximo_offset", "concluida", "atualizado_em")
+
+
+class _Consulta:
+    def __init__(self, banco, filtros=None):
+        self.banco = banco
+        self.filtros = filtros or {}
+
+    def filter_by(self, **kwargs):
+        return _Consulta(self.banco, {**self.filtros, **kwargs})
+
+    def order_by(self, coluna):
+        return self
+
+    def _linhas(self):
+        return [
+            (chave, l) for chave, l in self.banco.linhas.items()
+            if all(getattr(l, k) == v for k, v in self.filtros.items())
+        ]
+
+    def all(self):
+        return [l for _, l in sorted(self._linhas(), key=lambda par: par[0][1])]
+
+    def count(self):
+        return len(self._linhas())
+
+    def delete(self):
+        for chave, _ in self._linhas():
+            del self.banco.linhas[chave]
+
+
+def _plano():
+    return [
+        Janela(desde=datetime(2025, mes, 1, tzinfo=SP), ate=datetime(2025, mes, 28, tzinfo=SP), estimado=300)
+        for mes in (3, 1, 2)
+    ]
+
+
+def test_importacao_interrompida_retoma_do_offset_salvo():
+    db = _Checkpoints()
+    jan, fev, mar = sorted(_plano(), key=lambda j: j.desde)
+    salvar_plano(db, "1001", _plano())
+    salvar_checkpoint(db, "1001", jan.desde, 300, 111, concluida=True)
+    salvar_checkpoint(db, "1001", fev.desde, 150, 222, concluida=False)  # caiu no meio de fevereiro
+
+    pendentes = plano_pendente(db, "1001")
+
+    assert [(j.desde, j.ate, j.offset_inicial) for j in pendentes] == [(fev.desde, fev.ate, 150), (mar.desde, mar.ate, 0)]
+    assert all(j.estimado == 300 for j in pendentes)
+    assert plano_pendente(db, "2002") == []  # outra conta não tem importação interrompida
+
+
+def test_replanejar_nao_zera_o_progresso():
+    db = _Checkpoints()
+    fev = sorted(_plano(), key=lambda j: j.desde)[1]
+    salvar_plano(db, "1001", _plano())
+    salvar_checkpoint(db, "1001", fev.desde, 150, None, concluida=False)
+
+    salvar_plano(db, "1001", _plano())  # nova chamada com o plano da mesma importação
+
+    assert "ON CONFLICT (ml_user_id, desde) DO NOTHING" in str(db.comandos[-1].compile(dialect=postgresql.dialect()))
+
+    assert [j.offset_inicial for j in plano_pendente(db, "1001")] == [0, 150, 0]
+    assert db.linhas[(1001, fev.desde)].last_order_id is None  # sem pedido na página não apaga o cursor
+
+
+def test_plano_so_e_apagado_quando_todas_as_janelas_terminam():
+    db = _Checkpoints()
+    janelas = _plano()
+    salvar_plano(db, "1001", janelas)
+    for j in janelas[:2]:
+        salvar_checkpoint(db, "1001", j.desde, 300, 1, concluida=True)
+
+    assert encerrar_plano(db, "1001") is False
+    assert len(db.linhas) == 3 and db.commits == 0
+
+    salvar_checkpoint(db, "1001", janelas[2].desde, 300, 1, concluida=True)
+    assert encerrar_plano(db, "1001") is True
+    assert db.linhas == {} and db.commits == 1
+    assert plano_pendente(db, "1001") == []  # a próxima importação recomeça do zero
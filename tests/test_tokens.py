@@ -0,0 +1,124 @@
+# GerenciadorTokens: cache até perto de expirar, renovação única e a linha do banco como fonte.
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+import oauth
+from oauth import GerenciadorTokens
+
+
+class _Token:
+    def __init__(self, access_token: str, expira_em: timedelta):
+        self.access_token = access_token
+        self.refresh_token = "refresh-1"
+        self.expires_at = datetime.utcnow() + expira_em
+
+
+class _Consulta:
+    def __init__(self, token):
+        self._token = token
+
+    def filter_by(self, **kwargs):
+        return self
+
+    def with_for_update(self):
+        return self
+
+    def first(self):
+        return self._token
+
+
+class _Sessao:
+    def __init__(self, token):
+        self.token = token
+
+    def query(self, modelo):
+        return _Consulta(self.token)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def banco(monkeypatch):
+    """Linha de user_tokens compartilhada e as trocas de refresh_token feitas no ML."""
+    linha = _Token("do-banco", timedelta(hours=6))
+    trocas = []
+
+    def _trocar(refresh_token, uid):
+        time.sleep(0.05)  # dá tempo para as outras threads se acumularem no lock
+        trocas.append(refresh_token)
+        return {"access_token": f"novo-{len(trocas)}", "refresh_token": f"refresh-{len(trocas) + 1}", "expires_in": 21600}
+
+    class _SessionLocal:
+        @staticmethod
+        def session_factory():
+            return _Sessao(linha)
+
+    monkeypatch.setattr(oauth, "SessionLocal", _SessionLocal)
+    monkeypatch.setattr(oauth, "_trocar_refresh_token", _trocar)
+    return linha, trocas
+
+
+def test_token_em_cache_nao_vai_ao_banco(banco):
+    linha, trocas = banco
+    tokens = GerenciadorTokens()
+    tokens.guardar(1001, "em-cache", datetime.utcnow() + timedelta(hours=1))
+
+    assert tokens.obter("1001") == "em-cache"
+    assert trocas == []
+
+
+def test_perto_de_expirar_renova(banco):
+    linha, trocas = banco
+    linha.expires_at = datetime.utcnow() + timedelta(minutes=2)  # dentro da margem de 5 min
+    tokens = GerenciadorTokens(margem=timedelta(minutes=5))
+    tokens.guardar(1001, "do-banco", linha.expires_at)
+
+    assert tokens.obter("1001") == "novo-1"
+    assert trocas == ["refresh-1"]
+    assert linha.access_token == "novo-1" and linha.refresh_token == "refresh-2"
+
+
+def test_outro_processo_ja_renovou_usa_o_do_banco(banco):
+    linha, trocas = banco
+    tokens = GerenciadorTokens()
+    tokens.guardar(1001, "velho", datetime.utcnow() - timedelta(minutes=1))
+
+    assert tokens.obter("1001") == "do-banco"
+    assert trocas == []
+
+
+def test_varios_401_simultaneos_viram_uma_renovacao(banco):
+    linha, trocas = banco
+    tokens = GerenciadorTokens()
+    linha.access_token = "rejeitado"
+    tokens.guardar(1001, "rejeitado", linha.expires_at)
+
+    resultados = []
+    threads = [threading.Thread(target=lambda: resultados.append(tokens.rejeitado(1001, "rejeitado"))) for _ in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert resultados == ["novo-1"] * 5
+    assert trocas == ["refresh-1"]
+
+
+def test_renovar_forcado_troca_mesmo_com_token_valido(banco):
+    linha, trocas = banco
+    tokens = GerenciadorTokens()
+
+    assert tokens.renovar(1001) == "do-banco"            # sem forcar: só lê a linha
+    assert tokens.renovar(1001, forcar=True) == "novo-1"
+    assert tokens.renovar(1001, forcar=True) == "novo-2"
+    assert trocas == ["refresh-1", "refresh-2"]          # sempre o refresh_token gravado na linha
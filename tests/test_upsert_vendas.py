@@ -0,0 +1,106 @@
+# upsert_vendas: um INSERT ... ON CONFLICT por página (sem banco: a sessão responde o que o teste manda).
+from decimal import Decimal
+
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.sql.dml import Insert
+
+from models import Sale
+from sales import upsert_vendas
+
+
+class _Linha:
+    def __init__(self, order_id: int, inserida: bool):
+        self.order_id = order_id
+        self.inserida = inserida
+
+
+class _Resultado:
+    def __init__(self, linhas):
+        self._linhas = linhas
+
+    def all(self):
+        return self._linhas
+
+    def fetchall(self):
+        return self._linhas
+
+
+class _Sessao:
+    """`banco` = {order_id: content_hash} já gravados; o upsert devolve todos como gravados."""
+
+    def __init__(self, banco=None):
+        self.banco = banco or {}
+        self.comandos = []
+        self.commits = 0
+
+    def execute(self, stmt, params=None):
+        self.comandos.append(stmt)
+        if isinstance(stmt, Insert):
+            ids = [int(v) for k, v in stmt.compile(dialect=postgresql.dialect()).params.items() if k.startswith("order_id")]
+            return _Resultado([_Linha(oid, oid not in self.banco) for oid in ids])
+        return _Resultado(list(self.banco.items()))
+
+    def commit(self):
+        self.commits += 1
+
+    @property
+    def inserts(self):
+        return [c for c in self.comandos if isinstance(c, Insert)]
+
+
+def _venda(order_id: int, hash_: str = "h", total: str = "10.00") -> Sale:
+    return Sale(
+        order_id=str(order_id), ml_user_id=1001, status="paid",
+        total_amount=Decimal(total), ml_fee=None, content_hash=hash_,
+    )
+
+
+def test_pagina_inteira_em_um_comando_com_ids_repetidos_colapsados():
+    db = _Sessao(banco={2: "velho"})
+    res = upsert_vendas(db, [_venda(1), _venda(2), _venda(1, total="12.00")])
+
+    assert len(db.inserts) == 1
+    compilado = db.inserts[0].compile(dialect=postgresql.dialect())
+    valores = {k: v for k, v in compilado.params.items() if k.startswith(("order_id", "total_amount"))}
+    assert sorted(v for k, v in valores.items() if k.startswith("order_id")) == ["1", "2"]
+    assert Decimal("12.00") in valores.values()            # a última ocorrência do pedido vale
+    sql = str(compilado)
+    assert "ON CONFLICT (order_id) DO UPDATE" in sql
+    assert "IS DISTINCT FROM" in sql                      # linha idêntica não é reescrita
+    assert "coalesce(excluded.ml_fee, sales.ml_fee)" in sql  # payload sem fee não apaga o backfill
+    assert res == {"inseridas": 1, "atualizadas": 1, "inalteradas": 0, "puladas_hash": 0}
+    assert db.commits == 1
+
+
+def test_sem_commit_quem_chama_fecha_a_transacao():
+    db = _Sessao()
+    upsert_vendas(db, [_venda(1)], commit=False)
+    assert db.commits == 0
+
+
+def test_pedidos_com_o_mesmo_hash_nem_entram_no_insert():
+    db = _Sessao(banco={1: "igual", 2: "velho"})
+    res = upsert_vendas(db, [_venda(1, "igual"), _venda(2, "novo"), _venda(3, "novo")])
+
+    compilado = db.inserts[0].compile(dialect=postgresql.dialect())
+    ids = sorted(v for k, v in compilado.params.items() if k.startswith("order_id"))
+    assert ids == ["2", "3"]
+    assert res == {"inseridas": 1, "atualizadas": 1, "inalteradas": 1, "puladas_hash": 1}
+
+
+def test_pagina_toda_igual_nao_gera_insert_mas_fecha_a_transacao():
+    # o commit leva junto o resto da transação (ex.: arquivo de payloads)
+    db = _Sessao(banco={1: "a", 2: "b"})
+    res = upsert_vendas(db, [_venda(1, "a"), _venda(2, "b")])
+
+    assert db.inserts == []
+    assert res == {"inseridas": 0, "atualizadas": 0, "inalteradas": 2, "puladas_hash": 2}
+    assert db.commits == 1
+
+
+def test_sem_pular_iguais_nao_consulta_os_hashes():
+    db = _Sessao(banco={1: "a"})
+    res = upsert_vendas(db, [_venda(1, "a")], pular_iguais=False)
+
+    assert len(db.comandos) == 1 and len(db.inserts) == 1
+    assert res["puladas_hash"] == 0
@@ -2,7 +2,6 @@ import os
 from dotenv import load_dotenv
 from sqlalchemy import create_engine
 from datetime import datetime
-import requests
 
 # Carregar variáveis de ambiente
 load_dotenv()
@@ -20,10 +19,12 @@ engine = create_engine(
 DATA_INICIO = datetime(2024, 5, 16)
 
 # Função para buscar taxa de comissão no Mercado Livre
-def buscar_ml_fee(order_id: str, access_token: str):
-    url = f"https://api.mercadolibre.com/orders/{order_id}?access_token={access_token}"
+def buscar_ml_fee(order_id: str, access_token: str, ml_user_id: str | None = None):
+    from ml_api import API_ROOT, requisitar
+
+    url = f"{API_ROOT}/orders/{order_id}"
     try:
-        resp = requests.get(url, timeout=10)
+        resp = requisitar("GET", url, conta=ml_user_id, job="fees", access_token=access_token)
         if resp.ok:
             full_order = resp.json()
             payments = full_order.get("payments", [])